@@ -174,6 +174,19 @@ do
   cd ..
 done
 
+# the trigger replicates records directly by the replication functions
+echo "adding replication functions to sfn-iot-mr-dynamo-trigger.zip"
+rm -rf dispatch
+mkdir dispatch
+cp sfn-iot-mr-thing-crud/lambda_function.py dispatch/thing_crud.py
+cp sfn-iot-mr-thing-group-crud/lambda_function.py dispatch/thing_group_crud.py
+cp sfn-iot-mr-thing-type-crud/lambda_function.py dispatch/thing_type_crud.py
+cp sfn-iot-mr-shadow-syncer/lambda_function.py dispatch/shadow_syncer.py
+cd dispatch
+zip -q ../sfn-iot-mr-dynamo-trigger.zip *.py
+cd ..
+rm -rf dispatch
+
 # layer
 cd iot-dr-layer
 rm -rf python
@@ -185,7 +198,7 @@ pip3 install dynamodb-json==1.3 --no-deps -t python -q
 echo pip3 install simplejson==3.17.2 -t python -q
 pip3 install simplejson==3.17.2 -t python -q
 
-cp device_replication.py python/
+cp *.py python/
 
 rm -f ../iot-dr-layer.zip
 zip ../iot-dr-layer.zip -r python
@@ -27,6 +27,19 @@ do
   cd ..
 done
 
+# the trigger replicates records directly by the replication functions
+echo "adding replication functions to sfn-iot-mr-dynamo-trigger.zip"
+rm -rf dispatch
+mkdir dispatch
+cp sfn-iot-mr-thing-crud/lambda_function.py dispatch/thing_crud.py
+cp sfn-iot-mr-thing-group-crud/lambda_function.py dispatch/thing_group_crud.py
+cp sfn-iot-mr-thing-type-crud/lambda_function.py dispatch/thing_type_crud.py
+cp sfn-iot-mr-shadow-syncer/lambda_function.py dispatch/shadow_syncer.py
+cd dispatch
+zip ../sfn-iot-mr-dynamo-trigger.zip *.py
+cd ..
+rm -rf dispatch
+
 # layer
 echo "creating lambda layer installation package"
 cd iot-dr-layer
@@ -34,9 +47,9 @@ rm -rf python
 mkdir python
 pip install dynamodb-json==1.3 --no-deps -t python
 pip install simplejson==3.17.2 -t python
-python -m py_compile device_replication.py
+python -m py_compile *.py
 rm -rf __pycache__
-cp device_replication.py python/
+cp *.py python/
 
 rm -f ../iot-dr-layer.zip
 zip ../iot-dr-layer.zip -r python
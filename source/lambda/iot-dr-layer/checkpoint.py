@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# checkpoint - resume interrupted registry syncs
+#
+"""IoT DR: checkpoints of registry syncs in a local
+file or a DynamoDB item.
+Will be deployed as Lambda layer."""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from client_pool import get_client
+
+logger = logging.getLogger()
+
+# errors of a list operation called with an invalid or expired nextToken
+INVALID_TOKEN_ERROR_CODES = ['InvalidRequestException', 'InvalidNextTokenException']
+
+
+class CheckpointException(Exception): pass
+
+
+class PageTracker(object):
+    """Tracks the completion of the things of paginated results.
+
+    A page is registered with the token it has been read with. The
+    resume token is the token of the first page with things not yet
+    processed, so a resumed sync never skips a thing. The token of the
+    first page is None, a tracker is only finished when all pages have
+    been read and no page is in flight.
+
+    The outcomes of the things of a page, e.g. things_synced, are
+    counted when the page and all pages before it are done. These
+    counts match the resume token: the things of a page processed again
+    after a resume are not counted twice.
+
+    A page with a failed thing is never committed: the resume token
+    stays at it and the tracker doesn't finish, a resumed sync
+    processes the page again."""
+
+    def __init__(self, start_token=None, counts=None):
+        self.pages = collections.OrderedDict()
+        self.num_pages = 0
+        self.next_token = start_token
+        self.counts = dict(counts or {})
+        self.completed = False
+        self.lock = threading.Lock()
+
+    def add_page(self, token, num_items, next_token):
+        """Register a page, returns the page id for done()."""
+        with self.lock:
+            page = self.num_pages
+            self.num_pages += 1
+            self.pages[page] = [token, num_items, {}, False]
+            self.next_token = next_token
+            return page
+
+    def done(self, page, outcome=None, failed=False):
+        """A thing of page has been processed with outcome, e.g. the
+        name of the counter it incremented, failed if it has to be
+        processed again."""
+        with self.lock:
+            self.pages[page][1] -= 1
+            if failed:
+                self.pages[page][3] = True
+            if outcome:
+                self.pages[page][2][outcome] = self.pages[page][2].get(outcome, 0) + 1
+
+    def _commit(self):
+        # completed pages at the start are not needed anymore, called with the lock
+        while self.pages:
+            _, num_items, _, failed = next(iter(self.pages.values()))
+            if num_items > 0 or failed:
+                break
+            _, (_, _, counts, _) = self.pages.popitem(last=False)
+            for outcome, count in counts.items():
+                self.counts[outcome] = self.counts.get(outcome, 0) + count
+
+    def resume_token(self):
+        with self.lock:
+            self._commit()
+            if self.pages:
+                return next(iter(self.pages.values()))[0]
+            return self.next_token
+
+    def get_counts(self):
+        """Outcomes of the things before the resume token."""
+        with self.lock:
+            self._commit()
+            return dict(self.counts)
+
+    def complete(self):
+        """All pages have been read."""
+        self.completed = True
+
+    def finished(self):
+        """All pages have been read and all things processed."""
+        with self.lock:
+            self._commit()
+            return self.completed and not self.pages
+
+
+def get_trackers(cursors, cursors_state=None):
+    """PageTracker per cursor name, e.g. a shard query string, started
+    at the tokens and counts of cursors_state. Trackers of cursors
+    finished before are returned finished."""
+    trackers = {}
+    for cursor in cursors:
+        cursor_state = (cursors_state or {}).get(cursor, {})
+        trackers[cursor] = PageTracker(cursor_state.get('next_token'), cursor_state.get('counts'))
+        if cursor_state.get('finished'):
+            logger.info('cursor: {}: finished'.format(cursor))
+            trackers[cursor].complete()
+
+    return trackers
+
+
+def get_cursors_state(trackers):
+    state = {}
+    for cursor, tracker in trackers.items():
+        # the counts first, they commit the pages done
+        counts = tracker.get_counts()
+        state[cursor] = {
+            'next_token': tracker.resume_token(),
+            'finished': tracker.finished(),
+            'counts': counts
+        }
+    return state
+
+
+def get_cursors_counts(cursors_state):
+    """Sum of the counts of all cursors, None for a checkpoint saved
+    without counts."""
+    totals = {}
+    for cursor_state in cursors_state.values():
+        if 'counts' not in cursor_state:
+            return None
+        for outcome, count in cursor_state['counts'].items():
+            totals[outcome] = totals.get(outcome, 0) + count
+    return totals
+
+
+def iter_pages(operation, start_token=None, **kwargs):
+    """Yield (token, items, next_token) for the pages of an IoT list
+    operation with nextToken, e.g. search_index or list_things, starting
+    at start_token. A start token rejected as invalid, e.g. an expired
+    one, restarts from the first page, other errors are raised."""
+    token = start_token
+    while True:
+        if token:
+            kwargs['nextToken'] = token
+        else:
+            kwargs.pop('nextToken', None)
+
+        try:
+            response = operation(**kwargs)
+        except Exception as e:
+            error_code = getattr(e, 'response', {}).get('Error', {}).get('Code')
+            if not token or token != start_token or error_code not in INVALID_TOKEN_ERROR_CODES:
+                raise
+            logger.warning('start token rejected: {} - starting from the first page'.format(e))
+            start_token = token = None
+            continue
+
+        next_token = response.get('nextToken')
+        yield token, response['things'], next_token
+        if not next_token:
+            return
+        token = next_token
+
+
+class Checkpoint(object):
+    """Sync state saved at most every interval seconds to a local
+    file (path) or to an item of a DynamoDB table (table_name) with
+    the string hash key sync_id."""
+
+    def __init__(self, sync_id, path=None, table_name=None, region_name=None, interval=60):
+        if not path and not table_name:
+            raise CheckpointException('path or table_name required')
+        self.sync_id = sync_id
+        self.path = path
+        self.table_name = table_name
+        self.region_name = region_name
+        self.interval = interval
+        self.last_save = time.time()
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Saved state of this sync or None."""
+        try:
+            if self.path:
+                if not os.path.exists(self.path):
+                    return None
+                with open(self.path) as f:
+                    checkpoint = json.load(f)
+            else:
+                c_dynamodb = get_client('dynamodb', region_name=self.region_name)
+                response = c_dynamodb.get_item(
+                    TableName=self.table_name,
+                    Key={'sync_id': {'S': self.sync_id}},
+                    ConsistentRead=True
+                )
+                if 'Item' not in response:
+                    return None
+                checkpoint = json.loads(response['Item']['checkpoint']['S'])
+        except Exception as e:
+            logger.error('checkpoint: load: {}'.format(e))
+            raise CheckpointException(e)
+
+        if checkpoint.get('sync_id') != self.sync_id:
+            logger.warning('checkpoint: sync_id: {} does not match: {} - ignoring'.format(
+                checkpoint.get('sync_id'), self.sync_id))
+            return None
+
+        logger.info('checkpoint: loaded: {}'.format(checkpoint))
+        return checkpoint['state']
+
+    def save(self, state):
+        checkpoint = {'sync_id': self.sync_id, 'saved': int(time.time()), 'state': state}
+        try:
+            with self.lock:
+                if self.path:
+                    tmp_path = '{}.tmp'.format(self.path)
+                    with open(tmp_path, 'w') as f:
+                        json.dump(checkpoint, f)
+                    os.replace(tmp_path, self.path)
+                else:
+                    c_dynamodb = get_client('dynamodb', region_name=self.region_name)
+                    c_dynamodb.put_item(
+                        TableName=self.table_name,
+                        Item={
+                            'sync_id': {'S': self.sync_id},
+                            'checkpoint': {'S': json.dumps(checkpoint)}
+                        }
+                    )
+                self.last_save = time.time()
+            logger.info('checkpoint: saved: {}'.format(checkpoint))
+        except Exception as e:
+            # a missed checkpoint only costs repeated work after a restart
+            logger.error('checkpoint: save: {}'.format(e))
+
+    def save_due(self, get_state):
+        """Save the state returned by get_state() if interval seconds
+        have passed since the last save."""
+        if time.time() - self.last_save >= self.interval:
+            self.save(get_state())
+
+    def delete(self):
+        """Remove the checkpoint after a complete sync."""
+        try:
+            if self.path:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+            else:
+                c_dynamodb = get_client('dynamodb', region_name=self.region_name)
+                c_dynamodb.delete_item(
+                    TableName=self.table_name,
+                    Key={'sync_id': {'S': self.sync_id}}
+                )
+            logger.info('checkpoint: deleted: sync_id: {}'.format(self.sync_id))
+        except Exception as e:
+            logger.error('checkpoint: delete: {}'.format(e))
+
+
+def get_sync_id(*args):
+    return hashlib.sha256(':'.join([str(arg) for arg in args]).encode()).hexdigest()[:32]
+
+
+def get_checkpoint(sync_id, region_name=None):
+    """Checkpoint configured by the env vars CHECKPOINT_FILE or
+    CHECKPOINT_TABLE and CHECKPOINT_INTERVAL (seconds, default 60),
+    None if checkpointing is not configured."""
+    path = os.environ.get('CHECKPOINT_FILE')
+    table_name = os.environ.get('CHECKPOINT_TABLE')
+    interval = int(os.environ.get('CHECKPOINT_INTERVAL', 60))
+    if not path and not table_name:
+        return None
+
+    logger.info('checkpoint: sync_id: {} path: {} table_name: {} interval: {}'.format(
+        sync_id, path, table_name, interval))
+    return Checkpoint(sync_id, path=path, table_name=table_name,
+        region_name=region_name, interval=interval)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# client pool - boto3 clients shared across invocations
+#
+"""IoT DR: region keyed pool of boto3 clients.
+Clients are created once per container and
+reused by warm Lambda invocations and threads.
+Will be deployed as Lambda layer."""
+
+import logging
+import threading
+
+import boto3
+
+from botocore.config import Config
+
+import rate_limiter
+
+logger = logging.getLogger()
+
+_CLIENTS = {}
+_LOCK = threading.Lock()
+_SESSION = None
+
+
+def get_max_pool_connections(max_workers):
+    max_pool_connections = 10
+    if max_workers and max_workers >= 10:
+        max_pool_connections = round(max_workers*1.2)
+
+    return max_pool_connections
+
+
+def get_client(service, region_name=None, endpoint_url=None, max_workers=None, **config):
+    """Return a cached boto3 client.
+
+    Clients are keyed by service, region, endpoint and configuration.
+    config is passed to botocore.config.Config, e.g.
+    retries={'max_attempts': 12, 'mode': 'standard'}.
+    The connection pool is sized for max_workers threads.
+    Calls of IoT clients go through the shared rate limiter."""
+    global _SESSION
+    max_pool_connections = get_max_pool_connections(max_workers)
+    key = (
+        service, region_name, endpoint_url, max_pool_connections,
+        repr(sorted(config.items()))
+    )
+
+    client = _CLIENTS.get(key)
+    if client is not None:
+        return client
+
+    with _LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            # sessions are not thread safe, clients are created under the lock
+            if _SESSION is None:
+                _SESSION = boto3.session.Session()
+
+            logger.info(
+                'creating client: service: {} region_name: {} endpoint_url: {} \
+                max_pool_connections: {} config: {}'.format(
+                    service, region_name, endpoint_url, max_pool_connections, config
+                )
+            )
+            client = _SESSION.client(
+                service,
+                region_name=region_name,
+                endpoint_url=endpoint_url,
+                config=Config(max_pool_connections=max_pool_connections, **config)
+            )
+            rate_limiter.register(client, service)
+            _CLIENTS[key] = client
+
+    return client
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# concurrency - adaptive concurrency, bounded pipelines and prefetching
+#
+"""IoT DR: adaptive concurrency control and bounded pipelines
+for the region syncers.
+Will be deployed as Lambda layer."""
+
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger()
+
+THROTTLING_ERROR_CODES = [
+    'Throttling', 'ThrottlingException', 'ThrottledException',
+    'RequestLimitExceeded', 'TooManyRequestsException'
+]
+
+_CONTROLLERS = []
+_WATCHED_CLIENTS = set()
+_LATENCY_CLIENTS = set()
+_LOCK = threading.Lock()
+
+
+class AIMDController(object):
+    """Additive increase, multiplicative decrease of the number of
+    concurrent tasks.
+
+    Every successful task grows the window by increase/window, i.e. by
+    increase per window of completed tasks. The window is multiplied
+    by decrease on a throttling error or when the average latency of
+    an API exceeds latency_tolerance times the lowest average seen for
+    it. Latencies are those of the API calls, see watch_latency, not of
+    the tasks, which include waits for the rate limiter. At most one
+    decrease happens per cooldown seconds."""
+
+    def __init__(self, initial, minimum=1, maximum=200, increase=1.0, decrease=0.5,
+        latency_tolerance=2.0, cooldown=1.0, name='aimd'):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = float(min(max(initial, minimum), maximum))
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.latency_avg = {}
+        self.latency_min = {}
+        self.last_decrease = 0
+        self.window_min = self.window
+        self.window_max = self.window
+        self.num_increases = 0
+        self.num_decreases = 0
+        self.num_throttles = 0
+        self.condition = threading.Condition()
+
+    def get_window(self):
+        return int(self.window)
+
+    def acquire(self):
+        """Block until the number of tasks in flight is below the window."""
+        with self.condition:
+            while self.in_flight >= int(self.window):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, success=False):
+        """A task has finished, success is False if it failed or did no
+        work worth growing the window for."""
+        with self.condition:
+            self.in_flight -= 1
+            if success:
+                self._increase()
+            self.condition.notify_all()
+
+    def throttled(self):
+        with self.condition:
+            self.num_throttles += 1
+            self._decrease('throttling')
+
+    def observe_latency(self, api_name, latency):
+        """An attempt of an API call took latency seconds."""
+        with self.condition:
+            avg = self.latency_avg.get(api_name)
+            avg = latency if avg is None else 0.8 * avg + 0.2 * latency
+            self.latency_avg[api_name] = avg
+            if api_name not in self.latency_min or avg < self.latency_min[api_name]:
+                self.latency_min[api_name] = avg
+            elif avg > self.latency_min[api_name] * self.latency_tolerance:
+                self._decrease('latency: api: {} avg: {:.3f}s min: {:.3f}s'.format(
+                    api_name, avg, self.latency_min[api_name]))
+
+    def _increase(self):
+        window = min(self.maximum, self.window + self.increase / self.window)
+        if int(window) > int(self.window):
+            self.num_increases += 1
+        self.window = window
+        self.window_max = max(self.window_max, self.window)
+
+    def _decrease(self, reason):
+        now = time.monotonic()
+        if now - self.last_decrease < self.cooldown:
+            return
+        self.last_decrease = now
+        self.window = max(self.minimum, self.window * self.decrease)
+        self.window_min = min(self.window_min, self.window)
+        self.num_decreases += 1
+        # the latency baseline is measured again at the lower window
+        self.latency_avg = {}
+        self.latency_min = {}
+        logger.info('{}: decrease: reason: {}: window: {}'.format(
+            self.name, reason, self.get_window()))
+        self.condition.notify_all()
+
+    def start(self):
+        with _LOCK:
+            _CONTROLLERS.append(self)
+        return self
+
+    def stop(self):
+        with _LOCK:
+            if self in _CONTROLLERS:
+                _CONTROLLERS.remove(self)
+
+    def stats(self):
+        return 'window: {} min: {} max: {} increases: {} decreases: {} throttles: {}'.format(
+            self.get_window(), int(self.window_min), int(self.window_max),
+            self.num_increases, self.num_decreases, self.num_throttles
+        )
+
+
+class Pipeline(object):
+    """Bounded producer/consumer pipeline.
+
+    put() blocks while queue_size items are waiting, so a producer
+    like a paginator never runs far ahead of the workers and memory
+    stays flat. workers threads call worker(item). With a controller
+    a worker waits for a slot of its window before calling worker
+    and reports a true return value of worker as success."""
+
+    _STOP = object()
+
+    def __init__(self, worker, workers, queue_size, controller=None, name='pipeline'):
+        self.worker = worker
+        self.controller = controller
+        self.name = name
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = [
+            threading.Thread(target=self._run, name='{}-{}'.format(name, i), daemon=True)
+            for i in range(workers)
+        ]
+        logger.info('{}: workers: {} queue_size: {}'.format(name, workers, queue_size))
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is self._STOP:
+                    return
+                self._process(item)
+            finally:
+                self.queue.task_done()
+
+    def _process(self, item):
+        success = False
+        if self.controller is not None:
+            self.controller.acquire()
+        try:
+            success = bool(self.worker(item))
+        except Exception as e:
+            logger.error('{}: {}'.format(self.name, e))
+        finally:
+            if self.controller is not None:
+                self.controller.release(success)
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def close(self):
+        """Wait until all items have been processed and stop the workers."""
+        for _ in self.threads:
+            self.queue.put(self._STOP)
+        for thread in self.threads:
+            thread.join()
+        logger.info('{}: closed'.format(self.name))
+
+
+def prefetch(iterable, depth=1, name='prefetch'):
+    """Iterate iterable on a background thread up to depth items ahead
+    of the consumer, e.g. to read the next page of a paginator while
+    the current one is processed. Exceptions of iterable are raised to
+    the consumer."""
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except Exception as e:
+            put((end, e))
+
+    thread = threading.Thread(target=produce, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        # a consumer stopping early releases the producer
+        stop.set()
+
+
+def notify_throttled():
+    with _LOCK:
+        controllers = list(_CONTROLLERS)
+    for controller in controllers:
+        controller.throttled()
+
+
+def watch_throttling(client):
+    """Report throttling errors of a boto3 client, including the ones
+    hidden by botocore retries, to all started controllers."""
+    with _LOCK:
+        if id(client) in _WATCHED_CLIENTS:
+            return
+        _WATCHED_CLIENTS.add(id(client))
+
+    def needs_retry(response=None, **kwargs):
+        if response is None:
+            return
+        error_code = response[1].get('Error', {}).get('Code')
+        if error_code in THROTTLING_ERROR_CODES:
+            logger.debug('throttling: {}'.format(error_code))
+            notify_throttled()
+
+    client.meta.events.register('needs-retry', needs_retry)
+
+
+def notify_latency(api_name, latency):
+    with _LOCK:
+        controllers = list(_CONTROLLERS)
+    for controller in controllers:
+        controller.observe_latency(api_name, latency)
+
+
+def watch_latency(client):
+    """Report the latency of every attempt of an API call of a boto3
+    client to all started controllers. Has to be called after the rate
+    limiter is registered, so that the time waiting for it is not
+    measured. Throttled attempts are reported by watch_throttling."""
+    with _LOCK:
+        if id(client) in _LATENCY_CLIENTS:
+            return
+        _LATENCY_CLIENTS.add(id(client))
+
+    # a thread sends one request of a boto3 client at a time
+    started = threading.local()
+
+    def before_send(**kwargs):
+        started.time = time.monotonic()
+
+    def needs_retry(event_name, response=None, **kwargs):
+        start_time = getattr(started, 'time', None)
+        started.time = None
+        if start_time is None or response is None:
+            return
+        if response[1].get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+            return
+        notify_latency(event_name.split('.')[-1], time.monotonic() - start_time)
+
+    client.meta.events.register('before-send', before_send)
+    client.meta.events.register('needs-retry', needs_retry)
@@ -9,11 +9,20 @@
 """IoT DR: device registry functions.
 Will be deployed as Lambda layer."""
 
+import collections
+import hashlib
+import json
 import logging
+import os
+import random
+import string
 import sys
+import threading
 import time
 
-import boto3
+from concurrent import futures
+
+from client_pool import get_client
 
 logger = logging.getLogger()
 for h in logger.handlers:
@@ -34,6 +43,189 @@ class DeviceReplicationUpdateThingException(Exception): pass
 class DeviceReplicationGeneralException(Exception): pass
 
 
+# check_first: describe/get before create
+# optimistic: create directly, an existing resource counts as success.
+# Policies are always checked first: creating an existing policy needs
+# its document from the primary region and fails, costing two round trips
+WRITE_MODES = ['check_first', 'optimistic']
+WRITE_MODE = 'check_first'
+ROUND_TRIPS_SAVED = 0
+# optimistic creates of existing resources, they cost a write call
+# instead of the lookup and save nothing
+FAILED_CREATES = 0
+ROUND_TRIPS_SAVED_LOCK = threading.Lock()
+
+
+def set_write_mode(write_mode):
+    global WRITE_MODE
+    if write_mode not in WRITE_MODES:
+        raise DeviceReplicationGeneralException(
+            'invalid write_mode: {} allowed: {}'.format(write_mode, WRITE_MODES))
+    logger.info('write_mode: {}'.format(write_mode))
+    WRITE_MODE = write_mode
+
+
+def optimistic_writes():
+    return WRITE_MODE == 'optimistic'
+
+
+def round_trip_saved():
+    global ROUND_TRIPS_SAVED
+    with ROUND_TRIPS_SAVED_LOCK:
+        ROUND_TRIPS_SAVED += 1
+
+
+def create_failed():
+    global FAILED_CREATES
+    with ROUND_TRIPS_SAVED_LOCK:
+        FAILED_CREATES += 1
+
+
+def get_round_trips_saved():
+    return ROUND_TRIPS_SAVED
+
+
+def get_failed_creates():
+    return FAILED_CREATES
+
+
+class RetryPolicy(object):
+    """Retries for lookups in the primary region which might return
+    empty results while a device is still being provisioned.
+
+    No wait after a non empty result. After an empty result the wait
+    grows exponentially from wait seconds with full jitter. Retrying
+    stops when the next wait would pass the deadline (epoch seconds)."""
+
+    def __init__(self, retries, wait, deadline=None):
+        self.retries = retries
+        self.wait = wait
+        self.deadline = deadline
+
+    def time_left(self):
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
+
+    def call(self, description, func, *args):
+        result = None
+        for attempt in range(1, self.retries+1):
+            logger.info('{}: {}'.format(attempt, description))
+            result = func(*args)
+            if result or attempt == self.retries:
+                break
+
+            backoff = random.uniform(0, self.wait*2**(attempt-1))
+            time_left = self.time_left()
+            if time_left is not None and backoff >= time_left:
+                logger.warning('{}: time budget exhausted, not retrying'.format(description))
+                break
+
+            logger.info('{}: empty result, retrying in {:.3f}s'.format(description, backoff))
+            time.sleep(backoff)
+
+        return result
+
+
+class TTLCache(object):
+    """Thread safe cache, entries expire after ttl seconds,
+    least recently used entries are evicted above max_size."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+
+            expires, value = item
+            if expires < time.time():
+                del self._items[key]
+                return None
+
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = (time.time() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def __len__(self):
+        return len(self._items)
+
+
+# policies are shared by many devices, cache them for the lifetime of the container:
+# (primary_region, secondary_region, policy_name) -> translated policy document
+# (secondary_region, policy_name) -> policy exists in secondary region
+POLICY_CACHE_SIZE = int(os.environ.get('POLICY_CACHE_SIZE', 1000))
+POLICY_CACHE_TTL = int(os.environ.get('POLICY_CACHE_TTL', 300))
+POLICY_DOCUMENTS = TTLCache(POLICY_CACHE_SIZE, POLICY_CACHE_TTL)
+POLICIES_SECONDARY = TTLCache(POLICY_CACHE_SIZE, POLICY_CACHE_TTL)
+
+# certificates of a replication cache, most of them belong to one thing,
+# so only the recently used ones are kept
+CERTIFICATE_CACHE_SIZE = int(os.environ.get('CERTIFICATE_CACHE_SIZE', 10000))
+CERTIFICATE_CACHE_TTL = int(os.environ.get('CERTIFICATE_CACHE_TTL', 3600))
+
+
+class ThingIndex(object):
+    """Compact index of the thing names in a region.
+
+    Thing names are stored as 64 bit digests in a set. The probability
+    of a digest collision is about number_of_things/2**64 and can be
+    neglected. With with_contents the content digest of every thing is
+    kept for drift detection."""
+
+    def __init__(self, with_contents=False):
+        self._digests = set()
+        self._contents = {} if with_contents else None
+
+    @staticmethod
+    def _digest(thing_name):
+        return int.from_bytes(
+            hashlib.blake2b(thing_name.encode(), digest_size=8).digest(), 'big'
+        )
+
+    def add(self, thing_name, content_digest=None):
+        digest = self._digest(thing_name)
+        self._digests.add(digest)
+        if self._contents is not None:
+            self._contents[digest] = content_digest
+
+    def get_content_digest(self, thing_name):
+        """Content digest of an indexed thing, None if unknown."""
+        if self._contents is None:
+            return None
+        return self._contents.get(self._digest(thing_name))
+
+    def __contains__(self, thing_name):
+        return self._digest(thing_name) in self._digests
+
+    def __len__(self):
+        return len(self._digests)
+
+
+def get_deadline(context, reserve_ms=5000):
+    """Deadline in epoch seconds for a Lambda invocation leaving
+    reserve_ms for error handling. None if there is no context."""
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+
+    return time.time() + (context.get_remaining_time_in_millis() - reserve_ms)/1000
+
+
 def get_iot_data_endpoint(region, iot_endpoints):
     try:
         logger.info('region: {} iot_endpoints: {}'.format(region, iot_endpoints))
@@ -47,7 +239,7 @@ def get_iot_data_endpoint(region, iot_endpoints):
         if iot_data_endpoint is None:
             logger.info('iot_data_endpoint not found calling describe_endpoint')
             iot_data_endpoint = (
-                boto3.client('iot').
+                get_client('iot').
                 describe_endpoint(endpointType='iot:Data-ATS')['endpointAddress']
             )
             logger.info('iot_data_endpoint from describe_endpoint: {}'.format(iot_data_endpoint))
@@ -77,6 +269,196 @@ def thing_exists(c_iot, thing_name):
         raise DeviceReplicationGeneralException(e)
 
 
+def get_thing_content_digest(thing):
+    """Digest of thing type and attributes of a thing descriptor like
+    returned by search_index, list_things or describe_thing. The version
+    is left out, it is counted independently in every region."""
+    content = json.dumps(
+        [thing.get('thingTypeName') or '', thing.get('attributes') or {}], sort_keys=True
+    )
+    return int.from_bytes(hashlib.blake2b(content.encode(), digest_size=8).digest(), 'big')
+
+
+def build_thing_index(c_iot, use_search_index, query_string='thingName:*', with_contents=False):
+    """Index all thing names in the region of c_iot with a single
+    paginated scan, search_index if registry indexing is enabled
+    otherwise list_things. with_contents also indexes the content
+    digests of the things."""
+    logger.info('region: {} use_search_index: {} with_contents: {}'.format(
+        c_iot.meta.region_name, use_search_index, with_contents))
+    try:
+        start_time = int(time.time()*1000)
+        thing_index = ThingIndex(with_contents=with_contents)
+        num_pages = 0
+        kwargs = {}
+        while True:
+            if use_search_index:
+                response = c_iot.search_index(
+                    indexName='AWS_Things', queryString=query_string, maxResults=500, **kwargs
+                )
+            else:
+                response = c_iot.list_things(maxResults=250, **kwargs)
+            num_pages += 1
+
+            for thing in response['things']:
+                thing_index.add(
+                    thing['thingName'],
+                    get_thing_content_digest(thing) if with_contents else None
+                )
+
+            if not response.get('nextToken'):
+                break
+            kwargs = {'nextToken': response['nextToken']}
+
+        logger.info('region: {} things indexed: {} pages: {} duration: {}ms'.format(
+            c_iot.meta.region_name, len(thing_index), num_pages, int(time.time()*1000) - start_time))
+        return thing_index
+    except Exception as e:
+        logger.error('build_thing_index: {}'.format(e))
+        raise DeviceReplicationGeneralException(e)
+
+
+# characters a thing name can start with
+THING_NAME_FIRST_CHARS = string.ascii_letters + string.digits + ':_-'
+# prefixes of more things than a shard should get are split by their next
+# character, down to SHARD_PREFIX_MAX_LENGTH characters; prefixes of fewer
+# than SHARD_SPLIT_MIN_THINGS things are never split
+SHARD_PREFIX_MAX_LENGTH = int(os.environ.get('SHARD_PREFIX_MAX_LENGTH', 16))
+SHARD_SPLIT_MIN_THINGS = int(os.environ.get('SHARD_SPLIT_MIN_THINGS', 1000))
+
+
+def get_prefix_term(prefix, exact=False):
+    """Query term for the thing names starting with prefix, or for the
+    thing named prefix with exact."""
+    escaped = ''.join('\\' + c if c in ':-' else c for c in prefix)
+    return 'thingName:{}{}'.format(escaped, '' if exact else '*')
+
+
+def count_prefix_things(c_iot, query_string, term):
+    response = c_iot.get_statistics(
+        indexName='AWS_Things', queryString='({}) AND {}'.format(query_string, term))
+    return response['statistics']['count']
+
+
+def get_common_prefix(c_iot, query_string, prefix, count):
+    """Longest prefix, up to SHARD_PREFIX_MAX_LENGTH characters, shared by
+    all count things starting with prefix. The candidate is the common
+    prefix of a page of names, its length is found by a binary search on
+    the counts."""
+    response = c_iot.search_index(
+        indexName='AWS_Things', maxResults=100,
+        queryString='({}) AND {}'.format(query_string, get_prefix_term(prefix)))
+    names = [thing['thingName'] for thing in response['things']]
+    candidate = os.path.commonprefix(names)[:SHARD_PREFIX_MAX_LENGTH] if names else prefix
+
+    low, high = len(prefix), len(candidate)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_prefix_things(c_iot, query_string, get_prefix_term(candidate[:middle])) == count:
+            low = middle
+        else:
+            high = middle - 1
+    return candidate[:low]
+
+
+def split_shard_prefixes(c_iot, query_string, chars, shards):
+    """Query terms and their number of things for the things matched by
+    query_string starting with one of chars. Prefixes with more things
+    than a shard of shards should get are split recursively by their next
+    character, a thing named like the prefix gets an exact term."""
+    counts = {
+        get_prefix_term(c): count_prefix_things(c_iot, query_string, get_prefix_term(c))
+        for c in chars
+    }
+    limit = max(sum(counts.values()) // shards, SHARD_SPLIT_MIN_THINGS)
+
+    terms = {}
+    pending = [(c, counts[get_prefix_term(c)]) for c in chars]
+    while pending:
+        prefix, count = pending.pop()
+        if count == 0:
+            continue
+        if count <= limit or len(prefix) >= SHARD_PREFIX_MAX_LENGTH:
+            terms[get_prefix_term(prefix)] = count
+            continue
+
+        # names sharing a longer prefix, e.g. device-, are split after it
+        # instead of one character at a time
+        prefix = get_common_prefix(c_iot, query_string, prefix, count)
+        if len(prefix) >= SHARD_PREFIX_MAX_LENGTH:
+            terms[get_prefix_term(prefix)] = count
+            continue
+
+        logger.info('split prefix: {} things: {} limit: {}'.format(prefix, count, limit))
+        exact = get_prefix_term(prefix, exact=True)
+        terms[exact] = count_prefix_things(c_iot, query_string, exact)
+        for c in THING_NAME_FIRST_CHARS:
+            pending.append((
+                prefix + c,
+                count_prefix_things(c_iot, query_string, get_prefix_term(prefix + c))
+            ))
+
+    return {term: count for term, count in terms.items() if count}
+
+
+def get_shard_query_strings(query_string, shard_index=0, shard_count=1, shards=1, c_iot=None):
+    """Split the things matched by query_string by the prefixes of their
+    names. The first characters are dealt round robin to shard_count
+    shards, so how even the tasks are loaded depends on the distribution
+    of the first characters. The things of shard shard_index are split
+    again to shards query strings with one search_index cursor each: with
+    c_iot the prefixes are split by the counts of the fleet index and dealt
+    to the query strings by their number of things, without it, or if the
+    things can't be counted, the first characters are dealt round robin."""
+    if shard_count == 1 and shards == 1:
+        return [query_string]
+
+    chars = [
+        c for i, c in enumerate(THING_NAME_FIRST_CHARS) if i % shard_count == shard_index
+    ]
+
+    terms = None
+    if c_iot is not None and shards > 1:
+        try:
+            terms = split_shard_prefixes(c_iot, query_string, chars, shards)
+        except Exception as e:
+            logger.warning('split shard prefixes: {}'.format(e))
+
+    if terms is None:
+        shard_terms = [[get_prefix_term(c) for c in chars[i::shards]] for i in range(shards)]
+    else:
+        # the largest prefixes first, each to the query string with the fewest things
+        shard_terms = [[] for i in range(shards)]
+        loads = [0] * shards
+        for term in sorted(terms, key=terms.get, reverse=True):
+            i = loads.index(min(loads))
+            shard_terms[i].append(term)
+            loads[i] += terms[term]
+        logger.info('shard loads: {}'.format(loads))
+
+    query_strings = []
+    for prefixes in shard_terms:
+        if prefixes:
+            query_strings.append('({}) AND ({})'.format(query_string, ' OR '.join(prefixes)))
+
+    return query_strings
+
+
+def count_things(c_iot, query_strings):
+    """Number of things matched by query_strings according to the fleet
+    index, None if it can't be determined."""
+    try:
+        num_things = 0
+        for query_string in query_strings:
+            response = c_iot.get_statistics(indexName='AWS_Things', queryString=query_string)
+            num_things += response['statistics']['count']
+        logger.info('query_strings: {} num_things: {}'.format(query_strings, num_things))
+        return num_things
+    except Exception as e:
+        logger.warning('count things: {}'.format(e))
+        return None
+
+
 def policy_exists(c_iot, policy_name):
     logger.info("policy_exists: policy_name: {}".format(policy_name))
     try:
@@ -128,18 +510,52 @@ def thing_type_exists(c_iot, thing_type_name):
         raise DeviceReplicationGeneralException(e)
 
 
-def create_thing_type(c_iot, thing_type_name):
+def new_replication_cache():
+    """Lookups shared by all things of a replication batch.
+
+    Certificates and attached policies are read once from the primary
+    region, certificates, policies and thing types are checked once
+    in the secondary region. The certificate lookups are bounded
+    TTLCaches, the sets of policies and thing types are small and kept
+    for the whole batch."""
+    return {
+        'certificates': TTLCache(CERTIFICATE_CACHE_SIZE, CERTIFICATE_CACHE_TTL),
+        'attached_policies': TTLCache(CERTIFICATE_CACHE_SIZE, CERTIFICATE_CACHE_TTL),
+        'certificates_secondary': TTLCache(CERTIFICATE_CACHE_SIZE, CERTIFICATE_CACHE_TTL),
+        'policies_secondary': set(),
+        'thing_types_secondary': set()
+    }
+
+
+def create_thing_type(c_iot, thing_type_name, cache=None):
     logger.info('create_thing_type: thing_type_name: {}'.format(thing_type_name))
     try:
-        if not thing_type_exists(c_iot, thing_type_name):
+        if cache is not None and thing_type_name in cache['thing_types_secondary']:
+            logger.info('thing_type_name "{}" exists (cached)'.format(thing_type_name))
+            return
+
+        if optimistic_writes():
+            response = c_iot.create_thing_type(thingTypeName=thing_type_name)
+            logger.info('create_thing_type: response: {}'.format(response))
+            round_trip_saved()
+        elif not thing_type_exists(c_iot, thing_type_name):
             response = c_iot.create_thing_type(thingTypeName=thing_type_name)
             logger.info('create_thing_type: response: {}'.format(response))
+
+        if cache is not None:
+            cache['thing_types_secondary'].add(thing_type_name)
+    except c_iot.exceptions.ResourceAlreadyExistsException:
+        logger.info('thing_type_name "{}" exists already'.format(thing_type_name))
+        if optimistic_writes():
+            create_failed()
+        if cache is not None:
+            cache['thing_types_secondary'].add(thing_type_name)
     except Exception as e:
         logger.error('create_thing_type: {}'.format(e))
         raise DeviceReplicationCreateThingException(e)
 
 
-def create_thing(c_iot, c_iot_primary, thing_name, thing_type_name, attrs):
+def create_thing(c_iot, c_iot_primary, thing_name, thing_type_name, attrs, cache=None):
     logger.info('create_thing: thing_name: {} thing_type_name: {} attrs: {}'.
         format(thing_name, thing_type_name, attrs))
     try:
@@ -149,10 +565,10 @@ def create_thing(c_iot, c_iot_primary, thing_name, thing_type_name, attrs):
                 format(thing_name, c_iot_primary.meta.region_name))
             return
 
-        if not thing_exists(c_iot, thing_name):
+        if optimistic_writes() or not thing_exists(c_iot, thing_name):
             if thing_type_name and attrs:
                 logger.info('thing_name: {}: thing_type_name and attrs'.format(thing_name))
-                create_thing_type(c_iot, thing_type_name)
+                create_thing_type(c_iot, thing_type_name, cache=cache)
                 response = c_iot.create_thing(
                     thingName=thing_name,
                     thingTypeName=thing_type_name,
@@ -166,7 +582,7 @@ def create_thing(c_iot, c_iot_primary, thing_name, thing_type_name, attrs):
                 )
             elif thing_type_name and not attrs:
                 logger.info('thing_name: {}: thing_type_name and not attrs'.format(thing_name))
-                create_thing_type(c_iot, thing_type_name)
+                create_thing_type(c_iot, thing_type_name, cache=cache)
                 response = c_iot.create_thing(
                     thingName=thing_name,
                     thingTypeName=thing_type_name
@@ -177,19 +593,80 @@ def create_thing(c_iot, c_iot_primary, thing_name, thing_type_name, attrs):
                     thingName=thing_name
                 )
             logger.info('thing_name: {}: create_thing: response: {}'.format(thing_name, response))
+            if optimistic_writes():
+                round_trip_saved()
         else:
             logger.info('thing_name: {}: thing exists already'.format(thing_name))
+    except c_iot.exceptions.ResourceAlreadyExistsException:
+        logger.info('thing_name: {}: thing exists already'.format(thing_name))
+        if optimistic_writes():
+            create_failed()
     except Exception as e:
         logger.error('thing_name: {}: create_thing: {}'.format(thing_name, e))
         raise DeviceReplicationCreateThingException(e)
 
 
+# maximum page size of the IoT list APIs
+MAX_PAGE_SIZE = 250
+
+
+def paginate(operation, result_key, page_size_key, token_key, next_token_key, **kwargs):
+    """Yield the items of all pages of an IoT list operation.
+    The next page is only requested when the consumer iterates
+    beyond the current one, so a caller can stop early."""
+    kwargs[page_size_key] = MAX_PAGE_SIZE
+    while True:
+        response = operation(**kwargs)
+        logger.debug(response)
+        for item in response[result_key]:
+            yield item
+
+        next_token = response.get(next_token_key)
+        if not next_token:
+            return
+        kwargs[token_key] = next_token
+
+
+def iter_thing_principals(c_iot, thing_name):
+    return paginate(
+        c_iot.list_thing_principals, 'principals', 'maxResults', 'nextToken', 'nextToken',
+        thingName=thing_name
+    )
+
+
+def iter_principal_things(c_iot, principal):
+    return paginate(
+        c_iot.list_principal_things, 'things', 'maxResults', 'nextToken', 'nextToken',
+        principal=principal
+    )
+
+
+def iter_attached_policies(c_iot, target):
+    return paginate(
+        c_iot.list_attached_policies, 'policies', 'pageSize', 'marker', 'nextMarker',
+        target=target, recursive=False
+    )
+
+
+def iter_principal_policies(c_iot, principal):
+    return paginate(
+        c_iot.list_principal_policies, 'policies', 'pageSize', 'marker', 'nextMarker',
+        principal=principal
+    )
+
+
+def iter_targets_for_policy(c_iot, policy_name):
+    return paginate(
+        c_iot.list_targets_for_policy, 'targets', 'pageSize', 'marker', 'nextMarker',
+        policyName=policy_name
+    )
+
+
 def get_thing_principals(c_iot_primary, thing_name):
     try:
-        response = c_iot_primary.list_thing_principals(thingName=thing_name)
-        logger.debug(response)
-        logger.info('thing_name: {}: principals: {}'.format(thing_name, response['principals']))
-        return response['principals']
+        principals = list(iter_thing_principals(c_iot_primary, thing_name))
+        logger.info('thing_name: {}: principals: {}'.format(thing_name, principals))
+        return principals
     except Exception as e:
         logger.error('thing_name: {}: get_thing_principals: {}'.format(thing_name, e))
         raise DeviceReplicationGeneralException(e)
@@ -197,9 +674,9 @@ def get_thing_principals(c_iot_primary, thing_name):
 
 def get_principal_things(c_iot, principal):
     try:
-        response = c_iot.list_principal_things(maxResults=10, principal=principal)
-        logger.info('principal: {} things attached: {}'.format(principal, response['things']))
-        return response['things']
+        things = list(iter_principal_things(c_iot, principal))
+        logger.info('principal: {} things attached: {}'.format(principal, things))
+        return things
     except Exception as e:
         logger.error('{}'.format(e))
         raise DeviceReplicationGeneralException(e)
@@ -207,17 +684,64 @@ def get_principal_things(c_iot, principal):
 
 def get_attached_policies(c_iot_primary, cert_arn):
     try:
-        response = c_iot_primary.list_attached_policies(
-            target=cert_arn, recursive=False, pageSize=10
-        )
-        logger.debug(response)
-        logger.info('cert_arn: {}: policies: {}'.format(cert_arn, response['policies']))
-        return response['policies']
+        policies = list(iter_attached_policies(c_iot_primary, cert_arn))
+        logger.info('cert_arn: {}: policies: {}'.format(cert_arn, policies))
+        return policies
     except Exception as e:
         logger.error('cert_arn: {}: get_attached_policies: {}'.format(cert_arn, e))
         raise DeviceReplicationGeneralException(e)
 
 
+def get_translated_policy(c_iot, c_iot_primary, policy_name):
+    """Policy document from the primary region with region names
+    replaced for the secondary region, cached with its default version id."""
+    primary_region = c_iot_primary.meta.region_name
+    secondary_region = c_iot.meta.region_name
+    key = (primary_region, secondary_region, policy_name)
+
+    policy = POLICY_DOCUMENTS.get(key)
+    if policy is not None:
+        logger.info('policy_name: {}: default_version_id: {}: translated policy cached'.format(
+            policy_name, policy['default_version_id']))
+        return policy
+
+    response = c_iot_primary.get_policy(policyName=policy_name)
+    logger.debug(response)
+    logger.info('primary_region: {} policy_document: {}'.format(
+        primary_region, response['policyDocument']))
+    return put_translated_policy(key, response)
+
+
+def put_translated_policy(key, response):
+    """Cache the policy document of a get_policy response of the primary
+    region translated for the secondary region, key is (primary_region,
+    secondary_region, policy_name)."""
+    primary_region, secondary_region, _ = key
+    policy = {
+        'default_version_id': response.get('defaultVersionId'),
+        'policy_document': response['policyDocument'].replace(primary_region, secondary_region)
+    }
+    logger.info('secondary_region: {} policy_document: {}'.format(
+        secondary_region, policy['policy_document']))
+    POLICY_DOCUMENTS.put(key, policy)
+    return policy
+
+
+def policy_exists_cached(c_iot, policy_name):
+    """policy_exists backed by the container wide cache, also with
+    optimistic writes."""
+    key = (c_iot.meta.region_name, policy_name)
+    if POLICIES_SECONDARY.get(key):
+        logger.info('policy_name: {}: exists (cached)'.format(policy_name))
+        return True
+
+    if policy_exists(c_iot, policy_name):
+        POLICIES_SECONDARY.put(key, True)
+        return True
+
+    return False
+
+
 def get_and_create_policy(c_iot, c_iot_primary, policy_name):
     try:
         primary_region = c_iot_primary.meta.region_name
@@ -228,26 +752,20 @@ def get_and_create_policy(c_iot, c_iot_primary, policy_name):
             )
         )
 
-        response = c_iot_primary.get_policy(policyName=policy_name)
-        logger.debug(response)
-        logger.info('primary_region: {} policy_document: {}'.format(
-            primary_region, response['policyDocument']))
-        policy_document_this_region = response['policyDocument'].replace(
-            primary_region, secondary_region
-        )
-        logger.info('secondary_region: {} policy_document: {}'.format(
-            secondary_region, policy_document_this_region))
+        policy = get_translated_policy(c_iot, c_iot_primary, policy_name)
         response = c_iot.create_policy(
             policyName=policy_name,
-            policyDocument=policy_document_this_region
+            policyDocument=policy['policy_document']
         )
         logger.info('policy_name: {}: create_policy: response: {}'.format(policy_name, response))
+        POLICIES_SECONDARY.put((secondary_region, policy_name), True)
     except c_iot.exceptions.ResourceAlreadyExistsException:
         logger.warning(
             'policy_name {}: exists already - might have been created in a parallel thread'.format(
                 policy_name
             )
         )
+        POLICIES_SECONDARY.put((secondary_region, policy_name), True)
     except Exception as e:
         logger.error('policy_name: {}: get_and_create_policy: {}'.format(policy_name, e))
         raise DeviceReplicationCreateThingException(e)
@@ -257,17 +775,200 @@ def register_cert(c_iot, cert_pem):
     try:
         response = c_iot.register_certificate_without_ca(certificatePem=cert_pem, status='ACTIVE')
         logger.info(response)
+        if optimistic_writes():
+            round_trip_saved()
     except c_iot.exceptions.ResourceAlreadyExistsException:
         logger.warning(
             'certificate exists already - might be created in another thread'
         )
+        if optimistic_writes():
+            create_failed()
     except Exception as e:
         logger.error('register_cert: {}'.format(e))
         raise DeviceReplicationCreateThingException(e)
 
 
+# bounded executor for the independent steps of a single thing replication
+FANOUT_WORKERS = int(os.environ.get('FANOUT_WORKERS', 8))
+FANOUT_EXECUTOR = None
+FANOUT_EXECUTOR_LOCK = threading.Lock()
+FANOUT_SLOTS = threading.BoundedSemaphore(FANOUT_WORKERS)
+
+
+def get_fanout_executor():
+    global FANOUT_EXECUTOR
+    if FANOUT_EXECUTOR is None:
+        with FANOUT_EXECUTOR_LOCK:
+            if FANOUT_EXECUTOR is None:
+                logger.info('creating fan-out executor: max_workers: {}'.format(FANOUT_WORKERS))
+                FANOUT_EXECUTOR = futures.ThreadPoolExecutor(
+                    max_workers=FANOUT_WORKERS, thread_name_prefix='fanout'
+                )
+    return FANOUT_EXECUTOR
+
+
+def run_fanout_call(func, args):
+    try:
+        return func(*args)
+    finally:
+        FANOUT_SLOTS.release()
+
+
+def run_parallel(calls):
+    """Run independent calls [(func, args), ...] and return their results
+    in order. The first exception is raised after all calls have finished.
+
+    The calling thread runs the first call and every call for which no
+    fan-out worker is free, so that callers never queue behind each other
+    when many things are replicated concurrently."""
+    fs = {}
+    for i, (func, args) in enumerate(calls[1:], 1):
+        if FANOUT_SLOTS.acquire(blocking=False):
+            fs[i] = get_fanout_executor().submit(run_fanout_call, func, args)
+
+    outcomes = []
+    for i, (func, args) in enumerate(calls):
+        if i in fs:
+            continue
+        try:
+            outcomes.append((i, func(*args), None))
+        except Exception as e:
+            outcomes.append((i, None, e))
+
+    for i, f in fs.items():
+        try:
+            outcomes.append((i, f.result(), None))
+        except Exception as e:
+            outcomes.append((i, None, e))
+
+    outcomes.sort(key=lambda outcome: outcome[0])
+    for _, _, e in outcomes:
+        if e is not None:
+            raise e
+    return [result for _, result, _ in outcomes]
+
+
+def replicate_certificate(c_iot, c_iot_primary, thing_name, cert_id, cache):
+    """Register the certificate from the primary region in the secondary
+    region if it doesn't exist. Returns the certificate arn in the primary region."""
+    certificate = cache['certificates'].get(cert_id)
+    if certificate is not None:
+        cert_arn, cert_pem = certificate
+    else:
+        response = c_iot_primary.describe_certificate(certificateId=cert_id)
+        cert_arn = response['certificateDescription']['certificateArn']
+        cert_pem = response['certificateDescription']['certificatePem']
+        cache['certificates'].put(cert_id, (cert_arn, cert_pem))
+    logger.info('thing_name: {}: cert_arn: {}'.format(thing_name, cert_arn))
+
+    if not cache['certificates_secondary'].get(cert_id):
+        if optimistic_writes() or not certificate_exists(c_iot, cert_id):
+            logger.info('thing_name: {}: register certificate without CA'.format(thing_name))
+            register_cert(c_iot, cert_pem)
+        cache['certificates_secondary'].put(cert_id, True)
+
+    return cert_arn
+
+
+def get_cert_policies(c_iot_primary, thing_name, cert_arn, retry_policy, cache):
+    policies = cache['attached_policies'].get(cert_arn)
+    if not policies:
+        policies = retry_policy.call(
+            'thing_name: {}: get_attached_policies for cert_arn: {}'.format(
+                thing_name, cert_arn
+            ),
+            get_attached_policies, c_iot_primary, cert_arn
+        )
+
+    return cache_cert_policies(thing_name, cert_arn, policies, cache)
+
+
+def cache_cert_policies(thing_name, cert_arn, policies, cache):
+    """Names of the policies attached to cert_arn, a certificate without
+    policies is an error."""
+    if not policies:
+        logger.error(
+            'thing_name: {}: no policies attached to cert_arn: {}'.format(
+                thing_name, cert_arn
+            )
+        )
+        raise DeviceReplicationCreateThingException(
+            'no policies attached to cert_arn: {}'.format(cert_arn))
+    cache['attached_policies'].put(cert_arn, policies)
+
+    return [policy['policyName'] for policy in policies]
+
+
+def replicate_policy(c_iot, c_iot_primary, thing_name, policy_name, cache):
+    logger.info('thing_name: {}: policy_name: {}'.format(thing_name, policy_name))
+    if policy_name not in cache['policies_secondary']:
+        if not policy_exists_cached(c_iot, policy_name):
+            logger.info('thing_name: {}: get_and_create_policy'.format(thing_name))
+            get_and_create_policy(c_iot, c_iot_primary, policy_name)
+        cache['policies_secondary'].add(policy_name)
+
+
+def attach_policy(c_iot, thing_name, policy_name, cert_arn_secondary_region):
+    response = c_iot.attach_policy(
+        policyName=policy_name,
+        target=cert_arn_secondary_region
+    )
+    logger.info(
+        'thing_name: {}: policy_name: {}: response attach_policy: {}'.format(
+            thing_name, policy_name, response
+        )
+    )
+
+
+def attach_thing_principal(c_iot, thing_name, cert_arn_secondary_region):
+    response = c_iot.attach_thing_principal(
+        thingName=thing_name,
+        principal=cert_arn_secondary_region
+    )
+    logger.info(
+        'thing_name: {} response attach_thing_principal: {}'.format(
+            thing_name, response
+        )
+    )
+
+
+def get_policy_attachments(thing_name, primary_region, secondary_region, cert_arns, cert_policy_names):
+    """Certificate arns in the secondary region, (policy_name, cert_arn)
+    pairs to attach and the distinct policy names of the certificates
+    cert_arns of the primary region with their policy names."""
+    cert_arns_secondary_region = []
+    cert_policies = []
+    policy_names = []
+    for cert_arn, policies in zip(cert_arns, cert_policy_names):
+        cert_arn_secondary_region = cert_arn.replace(primary_region, secondary_region)
+        logger.info(
+            'thing_name: {}: cert_arn_secondary_region: {}'.format(
+                thing_name, cert_arn_secondary_region
+            )
+        )
+        cert_arns_secondary_region.append(cert_arn_secondary_region)
+        for policy_name in policies:
+            cert_policies.append((policy_name, cert_arn_secondary_region))
+            if policy_name not in policy_names:
+                policy_names.append(policy_name)
+
+    return cert_arns_secondary_region, cert_policies, policy_names
+
+
 def create_thing_with_cert_and_policy(
-    c_iot, c_iot_primary, thing_name, thing_type_name, attrs, retries, wait):
+    c_iot, c_iot_primary, thing_name, thing_type_name, attrs, retries, wait,
+    cache=None, deadline=None):
+    """Replicate a thing with its certificates and policies.
+
+    Independent steps run in parallel, dependent ones in stages:
+    1. create thing | get principals
+    2. per principal: register certificate | get attached policies
+    3. per policy: create policy | per principal: attach thing principal
+    4. per principal and policy: attach policy"""
+    if cache is None:
+        cache = new_replication_cache()
+    retry_policy = RetryPolicy(retries, wait, deadline)
+
     primary_region = c_iot_primary.meta.region_name
     secondary_region = c_iot.meta.region_name
     logger.info(
@@ -283,28 +984,26 @@ def create_thing_with_cert_and_policy(
                     format(thing_name, primary_region
                 )
             )
-            return
+            return False
 
         logger.debug('calling create_thing: c_iot: {} c_iot_primary: {} \
         thing_name: {} thing_type_name: {} attrs: {}'.
             format(c_iot, c_iot_primary, thing_name, thing_type_name, attrs))
-        create_thing(c_iot, c_iot_primary, thing_name, thing_type_name, attrs)
-
-        principals = []
-        retries = retries
-        wait = wait
-        i = 1
-        while not principals and i <= retries:
-            logger.info('{}: get_thing_principals for thing_name: {}'.format(i, thing_name))
-            i += 1
-            principals = get_thing_principals(c_iot_primary, thing_name)
-            time.sleep(wait*i)
+        _, principals = run_parallel([
+            (create_thing, (c_iot, c_iot_primary, thing_name, thing_type_name, attrs, cache)),
+            (retry_policy.call, (
+                'get_thing_principals for thing_name: {}'.format(thing_name),
+                get_thing_principals, c_iot_primary, thing_name
+            ))
+        ])
 
         if not principals:
             logger.error('thing_name: {}: no principals attached'.format(thing_name))
             raise DeviceReplicationCreateThingException(
                 'no principals attached to thing_name: {}'.format(thing_name))
 
+        # the principal is the certificate arn in the primary region
+        calls = []
         for principal in principals:
             cert_id = principal.split('/')[-1]
             logger.info(
@@ -312,81 +1011,96 @@ def create_thing_with_cert_and_policy(
                     thing_name, principal, cert_id
                 )
             )
+            calls.append((replicate_certificate, (c_iot, c_iot_primary, thing_name, cert_id, cache)))
+            calls.append((get_cert_policies, (c_iot_primary, thing_name, principal, retry_policy, cache)))
+        results = run_parallel(calls)
+
+        cert_arns_secondary_region, cert_policies, policy_names = get_policy_attachments(
+            thing_name, primary_region, secondary_region, results[0::2], results[1::2])
+
+        run_parallel(
+            [(replicate_policy, (c_iot, c_iot_primary, thing_name, policy_name, cache))
+                for policy_name in policy_names] +
+            [(attach_thing_principal, (c_iot, thing_name, cert_arn_secondary_region))
+                for cert_arn_secondary_region in cert_arns_secondary_region]
+        )
 
-            response = c_iot_primary.describe_certificate(certificateId=cert_id)
-            cert_arn = response['certificateDescription']['certificateArn']
-            cert_pem = response['certificateDescription']['certificatePem']
-            logger.info('thing_name: {}: cert_arn: {}'.format(thing_name, cert_arn))
-            cert_arn_secondary_region = cert_arn.replace(primary_region, secondary_region)
-            logger.info(
-                'thing_name: {}: cert_arn_secondary_region: {}'.format(
-                    thing_name, cert_arn_secondary_region
-                )
-            )
+        run_parallel(
+            [(attach_policy, (c_iot, thing_name, policy_name, cert_arn_secondary_region))
+                for policy_name, cert_arn_secondary_region in cert_policies]
+        )
 
-            if not certificate_exists(c_iot, cert_id):
-                logger.info('thing_name: {}: register certificate without CA'.format(thing_name))
-                register_cert(c_iot, cert_pem)
+        return True
 
-            policies = []
-            retries = retries
-            wait = wait
-            i = 1
-            while not policies and i <= retries:
-                logger.info(
-                    'thing_name: {}: {}: get_attached_policies for cert_arn: {}'.format(
-                        thing_name, i, cert_arn
-                    )
-                )
-                i += 1
-                policies = get_attached_policies(c_iot_primary, cert_arn)
-                time.sleep(wait*i)
-
-            if not policies:
-                logger.error(
-                    'thing_name: {}: no policies attached to cert_arn: {}'.format(
-                        thing_name, cert_arn
-                    )
-                )
-                raise DeviceReplicationCreateThingException(
-                    'no policies attached to cert_arn: {}'.format(cert_arn))
+    except Exception as e:
+        logger.error('thing_name: {}: create_thing_with_cert_and_policy: {}'.format(thing_name, e))
+        raise DeviceReplicationCreateThingException(e)
 
-            for policy in policies:
-                policy_name = policy['policyName']
-                logger.info('thing_name: {}: policy_name: {}'.format(thing_name, policy_name))
 
-                if not policy_exists(c_iot, policy_name):
-                    logger.info('thing_name: {}: get_and_create_policy'.format(thing_name))
-                    get_and_create_policy(c_iot, c_iot_primary, policy_name)
+def get_attribute_payload(thing):
+    attrs = {}
+    if 'attributes' in thing and thing['attributes']:
+        attrs = {'attributes': {}, 'merge': False}
+        for key in thing['attributes']:
+            attrs['attributes'][key] = thing['attributes'][key]
 
-                response2 = c_iot.attach_policy(
-                    policyName=policy_name,
-                    target=cert_arn_secondary_region
-                )
-                logger.info(
-                    'thing_name: {}: response attach_policy: {}'.format(
-                        thing_name, response2
-                    )
-                )
+    return attrs
 
-            response3 = c_iot.attach_thing_principal(
-                thingName=thing_name,
-                principal=cert_arn_secondary_region
-            )
-            logger.info(
-                'thing_name: {} response attach_thing_principal: {}'.format(
-                    thing_name, response3
-                )
-            )
 
-    except Exception as e:
-        logger.error('thing_name: {}: create_thing_with_cert_and_policy: {}'.format(thing_name, e))
-        raise DeviceReplicationCreateThingException(e)
+def replicate_things(c_iot, c_iot_primary, things, retries, wait, cache=None, deadline=None):
+    """Replicate a batch of things including certificates and policies.
+
+    things is an iterable of thing descriptors like returned by
+    search_index or list_things: {'thingName': ..., 'thingTypeName': ...,
+    'attributes': {...}}. Shared certificates, policies and thing types
+    are resolved once for the whole batch. Things not started before
+    the deadline (epoch seconds) are reported as errors.
+
+    Returns a dict thing_name -> {'status': 'replicated'|'not_in_primary'|'error'}
+    with an additional 'error' message for failed things."""
+    if cache is None:
+        cache = new_replication_cache()
+
+    results = {}
+    for thing in things:
+        thing_name = thing['thingName']
+        if thing_name in results:
+            logger.info('thing_name: {}: duplicate in batch - ignoring'.format(thing_name))
+            continue
+
+        if deadline is not None and time.time() >= deadline:
+            results[thing_name] = {'status': 'error', 'error': 'time budget exhausted'}
+            continue
+
+        thing_type_name = thing.get('thingTypeName', '')
+        attrs = get_attribute_payload(thing)
+
+        try:
+            if create_thing_with_cert_and_policy(
+                c_iot, c_iot_primary, thing_name, thing_type_name, attrs,
+                retries, wait, cache=cache, deadline=deadline):
+                results[thing_name] = {'status': 'replicated'}
+            else:
+                results[thing_name] = {'status': 'not_in_primary'}
+        except DeviceReplicationCreateThingException as e:
+            results[thing_name] = {'status': 'error', 'error': '{}'.format(e)}
+
+    log_replication_summary(len(results), cache)
+    return results
+
+
+def log_replication_summary(num_things, cache):
+    logger.info(
+        'replicate_things: things: {} certificates: {} policies: {} thing_types: {}'.format(
+            num_things, len(cache['certificates']),
+            len(cache['policies_secondary']), len(cache['thing_types_secondary'])
+        )
+    )
 
 
 def delete_shadow(thing_name, iot_data_endpoint):
     try:
-        c_iot_data =  boto3.client('iot-data', endpoint_url='https://{}'.format(iot_data_endpoint))
+        c_iot_data = get_client('iot-data', endpoint_url='https://{}'.format(iot_data_endpoint))
         response = c_iot_data.delete_thing_shadow(thingName=thing_name)
         logger.info(
             'thing_name: {}: delete_thing_shadow: response: {}'.format(
@@ -403,11 +1117,11 @@ def delete_shadow(thing_name, iot_data_endpoint):
 def delete_policy(c_iot, policy_name):
     logger.info('policy_name: {}'.format(policy_name))
     try:
-        response = c_iot.list_targets_for_policy(policyName=policy_name, pageSize=10)
-        targets = response['targets']
-        logger.debug('targets: {}'.format(targets))
+        # a single attached target is enough to keep the policy
+        target = next(iter_targets_for_policy(c_iot, policy_name), None)
+        logger.debug('target: {}'.format(target))
 
-        if targets:
+        if target:
             logger.info(
                 'policy_name: {}: targets attached, policy will not be deleted'.format(
                     policy_name
@@ -430,9 +1144,11 @@ def delete_policy(c_iot, policy_name):
                     policyVersionId=version['versionId'])
         logger.info('deleting policy: policy_name: {}'.format(policy_name))
         c_iot.delete_policy(policyName=policy_name)
+        POLICIES_SECONDARY.delete((c_iot.meta.region_name, policy_name))
 
     except c_iot.exceptions.ResourceNotFoundException:
         logger.info('policy_name: {}: does not exist'.format(policy_name))
+        POLICIES_SECONDARY.delete((c_iot.meta.region_name, policy_name))
 
     except Exception as e:
         logger.error('delete_policy: {}'.format(e))
@@ -450,10 +1166,10 @@ def delete_thing(c_iot, thing_name, iot_data_endpoint):
             logger.warning('delete_thing: thing does not exist: {}'.format(thing_name))
             return
 
-        r_principals = c_iot.list_thing_principals(thingName=thing_name)
-        logger.info('thing_name: {} principals: {}'.format(thing_name, r_principals['principals']))
+        principals = list(iter_thing_principals(c_iot, thing_name))
+        logger.info('thing_name: {} principals: {}'.format(thing_name, principals))
 
-        for arn in r_principals['principals']:
+        for arn in principals:
             cert_id = arn.split('/')[-1]
             logger.info(
                 'detach_thing_principal: thing_name: {} principal arn: {} cert_id: {}'.format(
@@ -481,12 +1197,12 @@ def delete_thing(c_iot, thing_name, iot_data_endpoint):
 
             # still things attached to the principal?
             # If yes, don't deactivate cert or detach policies
-            things = get_principal_things(c_iot, arn)
-            if things:
+            thing = next(iter_principal_things(c_iot, arn), None)
+            if thing:
                 logger.info(
-                    'still things {} attached to principal {} - \
+                    'still things e.g. {} attached to principal {} - \
                     certificate will not be inactvated, policies will not be removed'.format(
-                        things, arn
+                        thing, arn
                     )
                 )
             else:
@@ -496,10 +1212,10 @@ def delete_thing(c_iot, thing_name, iot_data_endpoint):
                 logger.info('update_certificate: cert_id: {} response: {}'.format(
                     cert_id, r_upd_cert))
 
-                r_policies = c_iot.list_principal_policies(principal=arn)
-                logger.info('cert arn: {} policies: {}'.format(arn, r_policies['policies']))
+                policies = list(iter_principal_policies(c_iot, arn))
+                logger.info('cert arn: {} policies: {}'.format(arn, policies))
 
-                for policy in r_policies['policies']:
+                for policy in policies:
                     policy_name = policy['policyName']
                     logger.info('detaching policy policy_name: {}'.format(policy_name))
                     r_detach_pol = c_iot.detach_policy(policyName=policy_name,target=arn)
@@ -553,6 +1269,43 @@ def update_thing(c_iot, c_iot_primary, thing_name, thing_type_name, attrs, merge
         raise DeviceReplicationUpdateThingException(e)
 
 
+def update_drifted_thing(c_iot, thing):
+    """Set thing type and attributes of an existing thing in the region
+    of c_iot to the ones of thing, a thing descriptor of the primary
+    region. Attributes the primary thing does not have are removed."""
+    thing_name = thing['thingName']
+    logger.info('update_drifted_thing: thing_name: {}'.format(thing_name))
+    try:
+        response = c_iot.describe_thing(thingName=thing_name)
+        logger.debug('response: {}'.format(response))
+
+        attrs = dict(thing.get('attributes') or {})
+        for key in response.get('attributes', {}):
+            if key not in attrs:
+                # an empty value removes an attribute
+                attrs[key] = ''
+
+        kwargs = {
+            'thingName': thing_name,
+            'attributePayload': {'attributes': attrs, 'merge': True},
+            'expectedVersion': response['version']
+        }
+        thing_type_name = thing.get('thingTypeName')
+        if thing_type_name:
+            if thing_type_name != response.get('thingTypeName'):
+                create_thing_type(c_iot, thing_type_name)
+            kwargs['thingTypeName'] = thing_type_name
+        elif response.get('thingTypeName'):
+            kwargs['removeThingType'] = True
+
+        response = c_iot.update_thing(**kwargs)
+        logger.info('update_drifted_thing: response: {}'.format(response))
+
+    except Exception as e:
+        logger.error('update_drifted_thing: thing_name: {}: {}'.format(thing_name, e))
+        raise DeviceReplicationUpdateThingException(e)
+
+
 def delete_thing_create_error(c_dynamo, thing_name, table_name):
     logger.info('delete_thing_create_error: thing_name: {}'.format(thing_name))
     try:
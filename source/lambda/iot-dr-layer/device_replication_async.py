@@ -0,0 +1,754 @@
+#!/usr/bin/env python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# device registry - asyncio variant of the layer functions
+#
+"""IoT DR: device registry functions for asyncio.
+Same functions as device_replication as coroutines on
+aiobotocore clients, so that thousands of requests can be
+in flight on one event loop. Requires aiobotocore.
+Will be deployed as Lambda layer."""
+
+import asyncio
+import logging
+import random
+import time
+
+from contextlib import AsyncExitStack
+
+from botocore.config import Config
+
+import rate_limiter
+
+from device_replication import (
+    DeviceReplicationCreateThingException,
+    DeviceReplicationDeleteThingException,
+    DeviceReplicationGeneralException,
+    DeviceReplicationUpdateThingException,
+    MAX_PAGE_SIZE, POLICIES_SECONDARY, POLICY_DOCUMENTS, RetryPolicy,
+    cache_cert_policies, create_failed, get_attribute_payload,
+    get_policy_attachments, log_replication_summary, new_replication_cache,
+    optimistic_writes, put_translated_policy, round_trip_saved
+)
+
+logger = logging.getLogger()
+
+MAX_IN_FLIGHT = 500
+
+
+async def get_clients(exit_stack, regions, max_in_flight=MAX_IN_FLIGHT, **config):
+    """Create one aiobotocore iot client per region. The clients are
+    closed when exit_stack is closed. Calls go through the shared
+    rate limiter. config is passed to
+    botocore.config.Config, e.g. retries={'max_attempts': 10, 'mode': 'standard'}."""
+    # aiobotocore is only needed by the asyncio engine
+    from aiobotocore.session import get_session
+
+    session = get_session()
+    clients = []
+    for region in regions:
+        logger.info('creating async client: region: {} max_pool_connections: {} config: {}'.format(
+            region, max_in_flight, config))
+        client = await exit_stack.enter_async_context(
+            session.create_client(
+                'iot',
+                region_name=region,
+                config=Config(max_pool_connections=max_in_flight, **config)
+            )
+        )
+        rate_limiter.register_async(client, 'iot')
+        clients.append(client)
+
+    return clients
+
+
+async def gather_all(*aws):
+    """asyncio.gather which cancels the other awaitables when one of
+    them fails and waits for them before raising the first exception,
+    so no call of a failed step is left running."""
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def retry_call(retry_policy, description, func, *args):
+    """RetryPolicy.call for coroutines, waits without blocking the loop."""
+    result = None
+    for attempt in range(1, retry_policy.retries+1):
+        logger.info('{}: {}'.format(attempt, description))
+        result = await func(*args)
+        if result or attempt == retry_policy.retries:
+            break
+
+        backoff = random.uniform(0, retry_policy.wait*2**(attempt-1))
+        time_left = retry_policy.time_left()
+        if time_left is not None and backoff >= time_left:
+            logger.warning('{}: time budget exhausted, not retrying'.format(description))
+            break
+
+        logger.info('{}: empty result, retrying in {:.3f}s'.format(description, backoff))
+        await asyncio.sleep(backoff)
+
+    return result
+
+
+async def thing_exists(c_iot, thing_name):
+    logger.debug("entering thing_exists: thing_name: {}".format(thing_name))
+    try:
+        response = await c_iot.describe_thing(thingName=thing_name)
+        logger.debug('response: {}'.format(response))
+        logger.info('thing_name "{}" exists'.format(thing_name))
+        return True
+
+    except c_iot.exceptions.ResourceNotFoundException:
+        logger.info('thing_name "{}" does not exist'.format(thing_name))
+        return False
+
+    except Exception as e:
+        logger.error('{}'.format(e))
+        raise DeviceReplicationGeneralException(e)
+
+
+async def policy_exists(c_iot, policy_name):
+    logger.info("policy_exists: policy_name: {}".format(policy_name))
+    try:
+        response = await c_iot.get_policy(policyName=policy_name)
+        logger.debug('response: {}'.format(response))
+        logger.info('policy_name: {}: exists'.format(policy_name))
+        return True
+
+    except c_iot.exceptions.ResourceNotFoundException:
+        logger.info('policy_name: {}: does not exist'.format(policy_name))
+        return False
+
+    except Exception as e:
+        logger.error('{}'.format(e))
+        raise DeviceReplicationGeneralException(e)
+
+
+async def certificate_exists(c_iot, cert_id):
+    logger.info("certificate_exists: cert_id: {}".format(cert_id))
+    try:
+        response = await c_iot.describe_certificate(certificateId=cert_id)
+        logger.debug('response: {}'.format(response))
+        logger.info('cert id "{}" exists'.format(cert_id))
+        return True
+
+    except c_iot.exceptions.ResourceNotFoundException:
+        logger.info('cert_id "{}" does not exist'.format(cert_id))
+        return False
+
+    except Exception as e:
+        logger.error('{}'.format(e))
+        raise DeviceReplicationGeneralException(e)
+
+
+async def thing_type_exists(c_iot, thing_type_name):
+    logger.info("thing_type_exists: thing_type_name: {}".format(thing_type_name))
+    try:
+        response = await c_iot.describe_thing_type(thingTypeName=thing_type_name)
+        logger.debug('response: {}'.format(response))
+        logger.info('thing_type_name "{}" exists'.format(thing_type_name))
+        return True
+
+    except c_iot.exceptions.ResourceNotFoundException:
+        logger.info('thing_type_name "{}" does not exist'.format(thing_type_name))
+        return False
+
+    except Exception as e:
+        logger.error('{}'.format(e))
+        raise DeviceReplicationGeneralException(e)
+
+
+async def create_thing_type(c_iot, thing_type_name, cache=None):
+    logger.info('create_thing_type: thing_type_name: {}'.format(thing_type_name))
+    try:
+        if cache is not None and thing_type_name in cache['thing_types_secondary']:
+            logger.info('thing_type_name "{}" exists (cached)'.format(thing_type_name))
+            return
+
+        if optimistic_writes():
+            response = await c_iot.create_thing_type(thingTypeName=thing_type_name)
+            logger.info('create_thing_type: response: {}'.format(response))
+            round_trip_saved()
+        elif not await thing_type_exists(c_iot, thing_type_name):
+            response = await c_iot.create_thing_type(thingTypeName=thing_type_name)
+            logger.info('create_thing_type: response: {}'.format(response))
+
+        if cache is not None:
+            cache['thing_types_secondary'].add(thing_type_name)
+    except c_iot.exceptions.ResourceAlreadyExistsException:
+        logger.info('thing_type_name "{}" exists already'.format(thing_type_name))
+        if optimistic_writes():
+            create_failed()
+        if cache is not None:
+            cache['thing_types_secondary'].add(thing_type_name)
+    except Exception as e:
+        logger.error('create_thing_type: {}'.format(e))
+        raise DeviceReplicationCreateThingException(e)
+
+
+async def create_thing(c_iot, c_iot_primary, thing_name, thing_type_name, attrs, cache=None):
+    logger.info('create_thing: thing_name: {} thing_type_name: {} attrs: {}'.
+        format(thing_name, thing_type_name, attrs))
+    try:
+        if not await thing_exists(c_iot_primary, thing_name):
+            logger.warning(
+                'thing_name "{}" does not exist in primary region "{}", will not being created'.
+                format(thing_name, c_iot_primary.meta.region_name))
+            return
+
+        if optimistic_writes() or not await thing_exists(c_iot, thing_name):
+            kwargs = {'thingName': thing_name}
+            if thing_type_name:
+                await create_thing_type(c_iot, thing_type_name, cache=cache)
+                kwargs['thingTypeName'] = thing_type_name
+            if attrs:
+                kwargs['attributePayload'] = attrs
+            response = await c_iot.create_thing(**kwargs)
+            logger.info('thing_name: {}: create_thing: response: {}'.format(thing_name, response))
+            if optimistic_writes():
+                round_trip_saved()
+        else:
+            logger.info('thing_name: {}: thing exists already'.format(thing_name))
+    except c_iot.exceptions.ResourceAlreadyExistsException:
+        logger.info('thing_name: {}: thing exists already'.format(thing_name))
+        if optimistic_writes():
+            create_failed()
+    except Exception as e:
+        logger.error('thing_name: {}: create_thing: {}'.format(thing_name, e))
+        raise DeviceReplicationCreateThingException(e)
+
+
+async def paginate(operation, result_key, page_size_key, token_key, next_token_key, **kwargs):
+    """Async generator over the items of all pages of an IoT list operation."""
+    kwargs[page_size_key] = MAX_PAGE_SIZE
+    while True:
+        response = await operation(**kwargs)
+        logger.debug(response)
+        for item in response[result_key]:
+            yield item
+
+        next_token = response.get(next_token_key)
+        if not next_token:
+            return
+        kwargs[token_key] = next_token
+
+
+def iter_thing_principals(c_iot, thing_name):
+    return paginate(
+        c_iot.list_thing_principals, 'principals', 'maxResults', 'nextToken', 'nextToken',
+        thingName=thing_name
+    )
+
+
+def iter_principal_things(c_iot, principal):
+    return paginate(
+        c_iot.list_principal_things, 'things', 'maxResults', 'nextToken', 'nextToken',
+        principal=principal
+    )
+
+
+def iter_attached_policies(c_iot, target):
+    return paginate(
+        c_iot.list_attached_policies, 'policies', 'pageSize', 'marker', 'nextMarker',
+        target=target, recursive=False
+    )
+
+
+def iter_principal_policies(c_iot, principal):
+    return paginate(
+        c_iot.list_principal_policies, 'policies', 'pageSize', 'marker', 'nextMarker',
+        principal=principal
+    )
+
+
+def iter_targets_for_policy(c_iot, policy_name):
+    return paginate(
+        c_iot.list_targets_for_policy, 'targets', 'pageSize', 'marker', 'nextMarker',
+        policyName=policy_name
+    )
+
+
+async def first(items):
+    """First item of an async generator or None, stops paginating."""
+    async for item in items:
+        await items.aclose()
+        return item
+    return None
+
+
+async def get_thing_principals(c_iot_primary, thing_name):
+    try:
+        principals = [p async for p in iter_thing_principals(c_iot_primary, thing_name)]
+        logger.info('thing_name: {}: principals: {}'.format(thing_name, principals))
+        return principals
+    except Exception as e:
+        logger.error('thing_name: {}: get_thing_principals: {}'.format(thing_name, e))
+        raise DeviceReplicationGeneralException(e)
+
+
+async def get_attached_policies(c_iot_primary, cert_arn):
+    try:
+        policies = [p async for p in iter_attached_policies(c_iot_primary, cert_arn)]
+        logger.info('cert_arn: {}: policies: {}'.format(cert_arn, policies))
+        return policies
+    except Exception as e:
+        logger.error('cert_arn: {}: get_attached_policies: {}'.format(cert_arn, e))
+        raise DeviceReplicationGeneralException(e)
+
+
+async def get_translated_policy(c_iot, c_iot_primary, policy_name):
+    primary_region = c_iot_primary.meta.region_name
+    secondary_region = c_iot.meta.region_name
+    key = (primary_region, secondary_region, policy_name)
+
+    policy = POLICY_DOCUMENTS.get(key)
+    if policy is not None:
+        logger.info('policy_name: {}: default_version_id: {}: translated policy cached'.format(
+            policy_name, policy['default_version_id']))
+        return policy
+
+    response = await c_iot_primary.get_policy(policyName=policy_name)
+    logger.debug(response)
+    return put_translated_policy(key, response)
+
+
+async def policy_exists_cached(c_iot, policy_name):
+    key = (c_iot.meta.region_name, policy_name)
+    if POLICIES_SECONDARY.get(key):
+        logger.info('policy_name: {}: exists (cached)'.format(policy_name))
+        return True
+
+    if await policy_exists(c_iot, policy_name):
+        POLICIES_SECONDARY.put(key, True)
+        return True
+
+    return False
+
+
+async def get_and_create_policy(c_iot, c_iot_primary, policy_name):
+    secondary_region = c_iot.meta.region_name
+    try:
+        policy = await get_translated_policy(c_iot, c_iot_primary, policy_name)
+        response = await c_iot.create_policy(
+            policyName=policy_name,
+            policyDocument=policy['policy_document']
+        )
+        logger.info('policy_name: {}: create_policy: response: {}'.format(policy_name, response))
+        POLICIES_SECONDARY.put((secondary_region, policy_name), True)
+    except c_iot.exceptions.ResourceAlreadyExistsException:
+        logger.warning(
+            'policy_name {}: exists already - might have been created in a parallel task'.format(
+                policy_name
+            )
+        )
+        POLICIES_SECONDARY.put((secondary_region, policy_name), True)
+    except Exception as e:
+        logger.error('policy_name: {}: get_and_create_policy: {}'.format(policy_name, e))
+        raise DeviceReplicationCreateThingException(e)
+
+
+async def register_cert(c_iot, cert_pem):
+    try:
+        response = await c_iot.register_certificate_without_ca(certificatePem=cert_pem, status='ACTIVE')
+        logger.info(response)
+        if optimistic_writes():
+            round_trip_saved()
+    except c_iot.exceptions.ResourceAlreadyExistsException:
+        logger.warning(
+            'certificate exists already - might be created in another task'
+        )
+        if optimistic_writes():
+            create_failed()
+    except Exception as e:
+        logger.error('register_cert: {}'.format(e))
+        raise DeviceReplicationCreateThingException(e)
+
+
+async def replicate_certificate(c_iot, c_iot_primary, thing_name, cert_id, cache):
+    certificate = cache['certificates'].get(cert_id)
+    if certificate is not None:
+        cert_arn, cert_pem = certificate
+    else:
+        response = await c_iot_primary.describe_certificate(certificateId=cert_id)
+        cert_arn = response['certificateDescription']['certificateArn']
+        cert_pem = response['certificateDescription']['certificatePem']
+        cache['certificates'].put(cert_id, (cert_arn, cert_pem))
+    logger.info('thing_name: {}: cert_arn: {}'.format(thing_name, cert_arn))
+
+    if not cache['certificates_secondary'].get(cert_id):
+        if optimistic_writes() or not await certificate_exists(c_iot, cert_id):
+            logger.info('thing_name: {}: register certificate without CA'.format(thing_name))
+            await register_cert(c_iot, cert_pem)
+        cache['certificates_secondary'].put(cert_id, True)
+
+    return cert_arn
+
+
+async def get_cert_policies(c_iot_primary, thing_name, cert_arn, retry_policy, cache):
+    policies = cache['attached_policies'].get(cert_arn)
+    if not policies:
+        policies = await retry_call(
+            retry_policy,
+            'thing_name: {}: get_attached_policies for cert_arn: {}'.format(
+                thing_name, cert_arn
+            ),
+            get_attached_policies, c_iot_primary, cert_arn
+        )
+
+    return cache_cert_policies(thing_name, cert_arn, policies, cache)
+
+
+async def replicate_policy(c_iot, c_iot_primary, thing_name, policy_name, cache):
+    logger.info('thing_name: {}: policy_name: {}'.format(thing_name, policy_name))
+    if policy_name not in cache['policies_secondary']:
+        if not await policy_exists_cached(c_iot, policy_name):
+            logger.info('thing_name: {}: get_and_create_policy'.format(thing_name))
+            await get_and_create_policy(c_iot, c_iot_primary, policy_name)
+        cache['policies_secondary'].add(policy_name)
+
+
+async def attach_policy(c_iot, thing_name, policy_name, cert_arn_secondary_region):
+    response = await c_iot.attach_policy(
+        policyName=policy_name,
+        target=cert_arn_secondary_region
+    )
+    logger.info(
+        'thing_name: {}: policy_name: {}: response attach_policy: {}'.format(
+            thing_name, policy_name, response
+        )
+    )
+
+
+async def attach_thing_principal(c_iot, thing_name, cert_arn_secondary_region):
+    response = await c_iot.attach_thing_principal(
+        thingName=thing_name,
+        principal=cert_arn_secondary_region
+    )
+    logger.info(
+        'thing_name: {} response attach_thing_principal: {}'.format(
+            thing_name, response
+        )
+    )
+
+
+async def create_thing_with_cert_and_policy(
+    c_iot, c_iot_primary, thing_name, thing_type_name, attrs, retries, wait,
+    cache=None, deadline=None):
+    """Same stages as device_replication.create_thing_with_cert_and_policy,
+    independent steps of a stage are gathered on the event loop."""
+    if cache is None:
+        cache = new_replication_cache()
+    # RetryPolicy only holds the parameters, waits are done by retry_call
+    retry_policy = RetryPolicy(retries, wait, deadline)
+
+    primary_region = c_iot_primary.meta.region_name
+    secondary_region = c_iot.meta.region_name
+    logger.info(
+        'thing_name: {} primary_region: {} secondary_region: {}'.format(
+            thing_name, primary_region, secondary_region
+        )
+    )
+
+    try:
+        if not await thing_exists(c_iot_primary, thing_name):
+            logger.warning(
+                'thing_name "{}" does not exist in primary region "{}", will not be created'.
+                    format(thing_name, primary_region
+                )
+            )
+            return False
+
+        _, principals = await gather_all(
+            create_thing(c_iot, c_iot_primary, thing_name, thing_type_name, attrs, cache=cache),
+            retry_call(
+                retry_policy,
+                'get_thing_principals for thing_name: {}'.format(thing_name),
+                get_thing_principals, c_iot_primary, thing_name
+            )
+        )
+
+        if not principals:
+            logger.error('thing_name: {}: no principals attached'.format(thing_name))
+            raise DeviceReplicationCreateThingException(
+                'no principals attached to thing_name: {}'.format(thing_name))
+
+        # certificates and their policies are one stage
+        results = await gather_all(*[
+            coro for principal in principals for coro in (
+                replicate_certificate(c_iot, c_iot_primary, thing_name, principal.split('/')[-1], cache),
+                get_cert_policies(c_iot_primary, thing_name, principal, retry_policy, cache)
+            )
+        ])
+
+        cert_arns_secondary_region, cert_policies, policy_names = get_policy_attachments(
+            thing_name, primary_region, secondary_region, results[0::2], results[1::2])
+
+        await gather_all(
+            *[replicate_policy(c_iot, c_iot_primary, thing_name, policy_name, cache)
+                for policy_name in policy_names],
+            *[attach_thing_principal(c_iot, thing_name, cert_arn_secondary_region)
+                for cert_arn_secondary_region in cert_arns_secondary_region]
+        )
+
+        await gather_all(*[
+            attach_policy(c_iot, thing_name, policy_name, cert_arn_secondary_region)
+            for policy_name, cert_arn_secondary_region in cert_policies
+        ])
+
+        return True
+
+    except Exception as e:
+        logger.error('thing_name: {}: create_thing_with_cert_and_policy: {}'.format(thing_name, e))
+        raise DeviceReplicationCreateThingException(e)
+
+
+async def replicate_things(c_iot, c_iot_primary, things, retries, wait, cache=None,
+    deadline=None, max_in_flight=MAX_IN_FLIGHT, on_result=None):
+    """Replicate things from an iterable or async iterable of thing
+    descriptors by max_in_flight workers. Only the names of the things
+    in flight are kept, the result of a thing is passed to
+    on_result(thing_name, result) with result like in the dict returned
+    by device_replication.replicate_things. Returns the number of things
+    by status."""
+    if cache is None:
+        cache = new_replication_cache()
+
+    counts = {'replicated': 0, 'not_in_primary': 0, 'error': 0}
+    in_flight = set()
+    queue = asyncio.Queue(maxsize=max_in_flight)
+
+    def report(thing_name, result):
+        counts[result['status']] += 1
+        if on_result is not None:
+            on_result(thing_name, result)
+
+    async def replicate(thing):
+        thing_name = thing['thingName']
+        if thing_name in in_flight:
+            logger.info('thing_name: {}: duplicate in flight - ignoring'.format(thing_name))
+            return
+
+        if deadline is not None and time.time() >= deadline:
+            report(thing_name, {'status': 'error', 'error': 'time budget exhausted'})
+            return
+
+        in_flight.add(thing_name)
+        try:
+            if await create_thing_with_cert_and_policy(
+                c_iot, c_iot_primary, thing_name, thing.get('thingTypeName', ''),
+                get_attribute_payload(thing), retries, wait, cache=cache, deadline=deadline):
+                report(thing_name, {'status': 'replicated'})
+            else:
+                report(thing_name, {'status': 'not_in_primary'})
+        except DeviceReplicationCreateThingException as e:
+            report(thing_name, {'status': 'error', 'error': '{}'.format(e)})
+        finally:
+            in_flight.discard(thing_name)
+
+    async def worker():
+        while True:
+            thing = await queue.get()
+            if thing is None:
+                return
+            await replicate(thing)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(max_in_flight)]
+    try:
+        # blocks while the queue is full, things are read as workers get free
+        if hasattr(things, '__aiter__'):
+            async for thing in things:
+                await queue.put(thing)
+        else:
+            for thing in things:
+                await queue.put(thing)
+        for _ in workers:
+            await queue.put(None)
+        await gather_all(*workers)
+    finally:
+        # workers left by a failing iterator of things are cancelled and awaited
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    log_replication_summary(sum(counts.values()), cache)
+    return counts
+
+
+async def delete_policy(c_iot, policy_name):
+    logger.info('policy_name: {}'.format(policy_name))
+    try:
+        target = await first(iter_targets_for_policy(c_iot, policy_name))
+        if target:
+            logger.info(
+                'policy_name: {}: targets attached, policy will not be deleted'.format(
+                    policy_name
+                )
+            )
+            return
+
+        response = await c_iot.list_policy_versions(policyName=policy_name)
+        for version in response["policyVersions"]:
+            if not version['isDefaultVersion']:
+                logger.info(
+                    'policy_name: {} deleting policy version: {}'.format(
+                        policy_name, version['versionId']
+                    )
+                )
+                await c_iot.delete_policy_version(policyName=policy_name,
+                    policyVersionId=version['versionId'])
+        logger.info('deleting policy: policy_name: {}'.format(policy_name))
+        await c_iot.delete_policy(policyName=policy_name)
+        POLICIES_SECONDARY.delete((c_iot.meta.region_name, policy_name))
+
+    except c_iot.exceptions.ResourceNotFoundException:
+        logger.info('policy_name: {}: does not exist'.format(policy_name))
+        POLICIES_SECONDARY.delete((c_iot.meta.region_name, policy_name))
+
+    except Exception as e:
+        logger.error('delete_policy: {}'.format(e))
+        raise DeviceReplicationGeneralException(e)
+
+
+async def delete_shadow(c_iot_data, thing_name):
+    try:
+        response = await c_iot_data.delete_thing_shadow(thingName=thing_name)
+        logger.info(
+            'thing_name: {}: delete_thing_shadow: response: {}'.format(
+                thing_name, response
+            )
+        )
+    except c_iot_data.exceptions.ResourceNotFoundException:
+        logger.info('thing_name: {}: shadow does not exist'.format(thing_name))
+    except Exception as e:
+        logger.error('thing_name: {}: delete_shadow: {}'.format(thing_name, e))
+        raise DeviceReplicationGeneralException(e)
+
+
+async def delete_thing(c_iot, thing_name, c_iot_data=None):
+    """Delete a thing like device_replication.delete_thing. The shadow is
+    deleted with the aiobotocore iot-data client c_iot_data if given."""
+    logger.info('delete_thing: thing_name: {}'.format(thing_name))
+    try:
+        if not await thing_exists(c_iot, thing_name):
+            logger.warning('delete_thing: thing does not exist: {}'.format(thing_name))
+            return
+
+        principals = [p async for p in iter_thing_principals(c_iot, thing_name)]
+        logger.info('thing_name: {} principals: {}'.format(thing_name, principals))
+
+        for arn in principals:
+            cert_id = arn.split('/')[-1]
+            r_detach_thing = await c_iot.detach_thing_principal(thingName=thing_name, principal=arn)
+            status_code = r_detach_thing['ResponseMetadata']['HTTPStatusCode']
+            if status_code != 200:
+                error_message = 'thing_name: {} arn: {} \
+                detach_thing_principal_status_code not equal 200: {} '.format(
+                    thing_name, arn, status_code
+                )
+                logger.error(error_message)
+                raise Exception(error_message)
+
+            thing = await first(iter_principal_things(c_iot, arn))
+            if thing:
+                logger.info(
+                    'still things e.g. {} attached to principal {} - \
+                    certificate will not be inactvated, policies will not be removed'.format(
+                        thing, arn
+                    )
+                )
+                continue
+
+            logger.info('inactivate cert: thing_name: {} cert_id: {}'.format(thing_name, cert_id))
+            await c_iot.update_certificate(certificateId=cert_id, newStatus='INACTIVE')
+
+            policies = [p async for p in iter_principal_policies(c_iot, arn)]
+            logger.info('cert arn: {} policies: {}'.format(arn, policies))
+            for policy in policies:
+                policy_name = policy['policyName']
+                await c_iot.detach_policy(policyName=policy_name, target=arn)
+                await delete_policy(c_iot, policy_name)
+
+            r_del_cert = await c_iot.delete_certificate(certificateId=cert_id, forceDelete=True)
+            logger.info('delete_certificate: cert_id: {} response: {}'.format(cert_id, r_del_cert))
+
+        r_del_thing = await c_iot.delete_thing(thingName=thing_name)
+        logger.info('delete_thing: thing_name: {} response: {}'.format(thing_name, r_del_thing))
+        if c_iot_data is not None:
+            await delete_shadow(c_iot_data, thing_name)
+    except Exception as e:
+        logger.error('delete_thing: thing_name: {}: {}'.format(thing_name, e))
+        raise DeviceReplicationDeleteThingException(e)
+
+
+async def update_thing(c_iot, c_iot_primary, thing_name, thing_type_name, attrs, merge):
+    logger.info('update_thing: thing_name: {}'.format(thing_name))
+    try:
+        await create_thing(c_iot, c_iot_primary, thing_name, "", {})
+
+        kwargs = {
+            'thingName': thing_name,
+            'attributePayload': {'attributes': attrs, 'merge': merge}
+        }
+        if thing_type_name:
+            await create_thing_type(c_iot, thing_type_name)
+            kwargs['thingTypeName'] = thing_type_name
+
+        response = await c_iot.update_thing(**kwargs)
+        logger.info('update_thing: response: {}'.format(response))
+
+    except Exception as e:
+        logger.error('update_thing: {}'.format(e))
+        raise DeviceReplicationUpdateThingException(e)
+
+
+async def iter_registry(c_iot, use_search_index, query_string='thingName:*'):
+    """Async generator over the thing descriptors of a registry,
+    from search_index or from list_things."""
+    if use_search_index:
+        things = paginate(
+            c_iot.search_index, 'things', 'maxResults', 'nextToken', 'nextToken',
+            indexName='AWS_Things', queryString=query_string
+        )
+    else:
+        things = paginate(
+            c_iot.list_things, 'things', 'maxResults', 'nextToken', 'nextToken'
+        )
+
+    async for thing in things:
+        yield thing
+
+
+def run(coro):
+    """Run a coroutine from synchronous code on a new event loop."""
+    return asyncio.run(coro)
+
+
+async def replicate_registry(primary_region, secondary_region, use_search_index,
+    query_string='thingName:*', thing_filter=None, retries=2, wait=1,
+    max_in_flight=MAX_IN_FLIGHT, on_result=None, **config):
+    """Replicate all things of the primary registry matching query_string
+    to the secondary region on one event loop. Things for which
+    thing_filter(thing) returns False are skipped. Returns the number of
+    things by status, see replicate_things for on_result."""
+    async with AsyncExitStack() as exit_stack:
+        c_iot_p, c_iot_s = await get_clients(
+            exit_stack, [primary_region, secondary_region], max_in_flight, **config)
+
+        async def things():
+            async for thing in iter_registry(c_iot_p, use_search_index, query_string):
+                if thing_filter is None or thing_filter(thing):
+                    yield thing
+
+        return await replicate_things(
+            c_iot_s, c_iot_p, things(), retries, wait, max_in_flight=max_in_flight,
+            on_result=on_result)
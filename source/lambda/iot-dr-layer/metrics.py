@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# metrics - thread safe counters, latency histograms and progress
+#
+"""IoT DR: counters and latency histograms updated from many
+threads without contention and periodic progress reports.
+Will be deployed as Lambda layer."""
+
+import bisect
+import logging
+import threading
+import time
+
+logger = logging.getLogger()
+
+# upper bounds of the latency buckets in seconds, the last bucket is unbounded
+LATENCY_BUCKETS = [
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+]
+
+
+class _Sharded(object):
+    """Per thread shards, a thread only writes to its own shard so
+    updates need no lock. Shards are merged on read."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def _new_shard(self):
+        raise NotImplementedError
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._new_shard()
+            with self._lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+
+    def _get_shards(self):
+        with self._lock:
+            return list(self._shards)
+
+
+class Counter(_Sharded):
+
+    def __init__(self, name):
+        super(Counter, self).__init__()
+        self.name = name
+        self._base = 0
+
+    def _new_shard(self):
+        return [0]
+
+    def inc(self, n=1):
+        self._shard()[0] += n
+
+    def value(self):
+        return self._base + sum([shard[0] for shard in self._get_shards()])
+
+    def set(self, value):
+        """Set the counter, e.g. to a value restored from a checkpoint.
+        Not to be called while other threads update the counter."""
+        with self._lock:
+            for shard in self._shards:
+                shard[0] = 0
+            self._base = value
+
+
+class Histogram(_Sharded):
+    """Latencies in seconds counted in the buckets of LATENCY_BUCKETS."""
+
+    def __init__(self, name):
+        super(Histogram, self).__init__()
+        self.name = name
+
+    def _new_shard(self):
+        # counts per bucket, sum and max
+        return {'counts': [0] * (len(LATENCY_BUCKETS) + 1), 'sum': 0.0, 'max': 0.0}
+
+    def observe(self, latency):
+        shard = self._shard()
+        shard['counts'][bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        shard['sum'] += latency
+        if latency > shard['max']:
+            shard['max'] = latency
+
+    def snapshot(self):
+        counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        total = 0.0
+        maximum = 0.0
+        for shard in self._get_shards():
+            for i, count in enumerate(shard['counts']):
+                counts[i] += count
+            total += shard['sum']
+            maximum = max(maximum, shard['max'])
+        return counts, total, maximum
+
+    def percentile(self, p, counts=None):
+        """Upper bound of the bucket with the p-th percentile, the max
+        latency if it falls into the unbounded bucket."""
+        if counts is None:
+            counts = self.snapshot()[0]
+        num = sum(counts)
+        if not num:
+            return None
+        rank = p / 100.0 * num
+        seen = 0
+        for i, count in enumerate(counts):
+            seen += count
+            if seen >= rank and count:
+                if i < len(LATENCY_BUCKETS):
+                    return LATENCY_BUCKETS[i]
+                break
+        return self.snapshot()[2]
+
+    def stats(self):
+        counts, total, maximum = self.snapshot()
+        num = sum(counts)
+        if not num:
+            return '{}: count: 0'.format(self.name)
+        return '{}: count: {} avg: {:.3f}s p50: <={}s p90: <={}s p99: <={}s max: {:.3f}s'.format(
+            self.name, num, total / num,
+            self.percentile(50, counts), self.percentile(90, counts), self.percentile(99, counts),
+            maximum
+        )
+
+
+class Metrics(object):
+    """Named counters and histograms, created on first use."""
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name):
+        counter = self._counters.get(name)
+        if counter is None:
+            with self._lock:
+                counter = self._counters.setdefault(name, Counter(name))
+        return counter
+
+    def histogram(self, name):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, Histogram(name))
+        return histogram
+
+    def inc(self, name, n=1):
+        self.counter(name).inc(n)
+
+    def observe(self, name, latency):
+        self.histogram(name).observe(latency)
+
+    def value(self, name):
+        return self.counter(name).value()
+
+    def set(self, name, value):
+        self.counter(name).set(value)
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+
+    def values(self):
+        with self._lock:
+            counters = list(self._counters.values())
+        return {counter.name: counter.value() for counter in counters}
+
+    def histogram_stats(self):
+        with self._lock:
+            histograms = list(self._histograms.values())
+        return [histogram.stats() for histogram in histograms]
+
+
+class ProgressReporter(object):
+    """Logs every interval seconds the sum of the counters names of
+    metrics, the throughput since start and, with a total, the ETA.
+    total can be a number or a function returning a number or None.
+    Counts from before start, e.g. restored from a checkpoint, count
+    as done but not for the throughput."""
+
+    def __init__(self, metrics, names, total=None, interval=60, name='progress'):
+        self.metrics = metrics
+        self.names = names
+        self.total = total
+        self.interval = interval
+        self.name = name
+        self.start_time = None
+        self.start_done = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def get_done(self):
+        return sum([self.metrics.value(name) for name in self.names])
+
+    def start(self):
+        self.start_time = time.monotonic()
+        self.start_done = self.get_done()
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.report()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self):
+        done = self.get_done()
+        elapsed = time.monotonic() - self.start_time
+        rate = (done - self.start_done) / elapsed if elapsed > 0 else 0
+        total = self.total() if callable(self.total) else self.total
+        eta = ''
+        if total is not None and rate > 0:
+            eta = ' total: {} eta: {}s'.format(total, int(max(total - done, 0) / rate))
+        logger.info('{}: done: {} elapsed: {}s rate: {:.1f}/s{}'.format(
+            self.name, done, int(elapsed), rate, eta))
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# rate limiter - token buckets for the IoT control plane APIs
+#
+"""IoT DR: process wide token bucket per region and API.
+Calls are delayed to stay at the IoT Core API limits instead
+of being throttled and retried.
+Will be deployed as Lambda layer."""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger()
+
+# requests per second per account and region, defaults of the
+# AWS IoT Core API throttling limits. Overridden by the env var
+# IOT_RATE_LIMITS, e.g. "CreateThing=50,DescribeThing=200",
+# a rate of 0 disables limiting for an API.
+DEFAULT_RATE_LIMITS = {
+    # device registry
+    'AttachThingPrincipal': 100,
+    'CreateThing': 100,
+    'CreateThingGroup': 25,
+    'CreateThingType': 15,
+    'DeleteThing': 100,
+    'DeleteThingGroup': 100,
+    'DeleteThingType': 15,
+    'DeprecateThingType': 15,
+    'DescribeThing': 350,
+    'DescribeThingGroup': 100,
+    'DescribeThingType': 50,
+    'DetachThingPrincipal': 100,
+    'ListPrincipalThings': 10,
+    'ListThingPrincipals': 20,
+    'ListThings': 10,
+    'SearchIndex': 15,
+    'UpdateThing': 100,
+    'UpdateThingGroup': 100,
+    # security and identity
+    'AttachPolicy': 15,
+    'CreatePolicy': 10,
+    'DeleteCertificate': 10,
+    'DeletePolicy': 10,
+    'DeletePolicyVersion': 10,
+    'DescribeCertificate': 10,
+    'DetachPolicy': 15,
+    'GetPolicy': 15,
+    'ListAttachedPolicies': 15,
+    'ListPolicyVersions': 10,
+    'ListPrincipalPolicies': 15,
+    'ListTargetsForPolicy': 10,
+    'RegisterCertificateWithoutCA': 10,
+    'UpdateCertificate': 10,
+    # device shadow
+    'DeleteThingShadow': 400,
+    'GetThingShadow': 400,
+    'UpdateThingShadow': 400
+}
+
+# services whose clients are rate limited
+RATE_LIMITED_SERVICES = ['iot', 'iot-data']
+
+
+def get_rate_limits():
+    rate_limits = dict(DEFAULT_RATE_LIMITS)
+    for limit in os.environ.get('IOT_RATE_LIMITS', '').split(','):
+        if not limit.strip():
+            continue
+        try:
+            api, rate = limit.split('=')
+            rate_limits[api.strip()] = float(rate)
+        except ValueError:
+            logger.error('IOT_RATE_LIMITS: invalid entry ignored: "{}" expected: API=rate'.format(limit.strip()))
+
+    return rate_limits
+
+
+RATE_LIMITS = get_rate_limits()
+
+
+class TokenBucket(object):
+    """Token bucket with rate tokens per second and a burst of one
+    second. reserve() takes a token, possibly from the future, and
+    returns the seconds the caller has to wait before using it."""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+
+            return -self.tokens / self.rate
+
+
+_BUCKETS = {}
+_LOCK = threading.Lock()
+
+
+def get_bucket(region_name, api_name):
+    """Shared bucket for region and API, None if the API is not limited."""
+    key = (region_name, api_name)
+    bucket = _BUCKETS.get(key)
+    if bucket is not None:
+        return bucket
+
+    rate = RATE_LIMITS.get(api_name)
+    if not rate:
+        return None
+
+    with _LOCK:
+        bucket = _BUCKETS.get(key)
+        if bucket is None:
+            logger.info('rate limit: region: {} api: {} rate: {}/s'.format(region_name, api_name, rate))
+            bucket = TokenBucket(rate)
+            _BUCKETS[key] = bucket
+
+    return bucket
+
+
+def reserve(region_name, api_name):
+    bucket = get_bucket(region_name, api_name)
+    if bucket is None:
+        return 0
+    return bucket.reserve()
+
+
+def acquire(region_name, api_name):
+    """Block until a call of api_name in region_name is allowed."""
+    wait = reserve(region_name, api_name)
+    if wait > 0:
+        logger.debug('rate limit: region: {} api: {} wait: {:.3f}s'.format(region_name, api_name, wait))
+        time.sleep(wait)
+    return wait
+
+
+def get_api_name(event_name):
+    # e.g. before-send.iot.CreateThing
+    return event_name.split('.')[-1]
+
+
+def register(client, service):
+    """Rate limit every HTTP request of a boto3 client. The limiter runs
+    before each attempt, so retries of a call take a token as well."""
+    if service not in RATE_LIMITED_SERVICES:
+        return
+
+    region_name = client.meta.region_name
+
+    def before_send(event_name, **kwargs):
+        acquire(region_name, get_api_name(event_name))
+        # a return value would be used as response instead of sending the request
+
+    client.meta.events.register('before-send', before_send)
+
+
+def register_async(client, service):
+    """Rate limit every HTTP request of an aiobotocore client without
+    blocking the event loop."""
+    if service not in RATE_LIMITED_SERVICES:
+        return
+
+    region_name = client.meta.region_name
+
+    async def before_send(event_name, **kwargs):
+        wait = reserve(region_name, get_api_name(event_name))
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    client.meta.events.register('before-send', before_send)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# registry digest - merkle tree over the things of a registry
+#
+"""IoT DR: digest of a device registry as merkle tree over buckets
+of things with the same name prefix. Two regions are compared by
+their roots, only the things of buckets with different digests are
+compared name by name.
+Will be deployed as Lambda layer."""
+
+import collections
+import hashlib
+import logging
+
+from concurrent import futures
+
+from device_replication import get_shard_query_strings, get_thing_content_digest
+
+logger = logging.getLogger()
+
+
+class RegistryDigestException(Exception): pass
+
+
+def get_bucket_key(thing_name, depth):
+    return thing_name[:depth]
+
+
+def get_item_digest(thing_name, content_digest):
+    content = '{}\0{:016x}'.format(thing_name, content_digest)
+    return int.from_bytes(hashlib.blake2b(content.encode(), digest_size=16).digest(), 'big')
+
+
+class RegistryDigest(object):
+    """Things are hashed into buckets by the first depth characters of
+    their names. A bucket digest is the count and the sum modulo 2**128
+    of the digests of name, thing type and attributes of its things, so
+    things can be added in any order and digests of shards merged. The
+    hash of a node of the prefix tree covers its own bucket and the
+    hashes of its children. The content digests of the things of a
+    bucket are kept by thing name, so buckets with different digests
+    can be compared without listing their things again."""
+
+    def __init__(self, depth=2):
+        self.depth = depth
+        self.buckets = {}
+        self.things = {}
+        self._children = None
+        self._hashes = None
+
+    def add(self, thing):
+        thing_name = thing['thingName']
+        content_digest = get_thing_content_digest(thing)
+        key = get_bucket_key(thing_name, self.depth)
+        bucket = self.buckets.setdefault(key, [0, 0])
+        bucket[0] += 1
+        bucket[1] = (bucket[1] + get_item_digest(thing_name, content_digest)) % 2**128
+        self.things.setdefault(key, {})[thing_name] = content_digest
+        self._children = None
+
+    def merge(self, other):
+        for key, (count, total) in other.buckets.items():
+            bucket = self.buckets.setdefault(key, [0, 0])
+            bucket[0] += count
+            bucket[1] = (bucket[1] + total) % 2**128
+        for key, things in other.things.items():
+            self.things.setdefault(key, {}).update(things)
+        self._children = None
+
+    def _build(self):
+        if self._children is not None:
+            return
+        self._children = collections.defaultdict(set)
+        for key in self.buckets:
+            for i in range(len(key)):
+                self._children[key[:i]].add(key[:i+1])
+        self._hashes = {}
+
+    def children(self, prefix):
+        self._build()
+        return self._children.get(prefix, set())
+
+    def bucket(self, key):
+        return tuple(self.buckets.get(key, (0, 0)))
+
+    def node_hash(self, prefix=''):
+        self._build()
+        if prefix not in self._hashes:
+            h = hashlib.blake2b(digest_size=16)
+            if prefix in self.buckets:
+                count, total = self.buckets[prefix]
+                h.update('{}:{}:{:032x};'.format(prefix, count, total).encode())
+            for child in sorted(self.children(prefix)):
+                h.update('{}:{};'.format(child, self.node_hash(child)).encode())
+            self._hashes[prefix] = h.hexdigest()
+        return self._hashes[prefix]
+
+    def root(self):
+        return self.node_hash('')
+
+    def num_things(self):
+        return sum([count for count, _ in self.buckets.values()])
+
+    def bucket_things(self, keys):
+        """Content digests by thing name of the things in buckets keys."""
+        things = {}
+        for key in keys:
+            things.update(self.things.get(key, {}))
+        return things
+
+
+def iter_things(c_iot, use_search_index, query_string):
+    kwargs = {}
+    while True:
+        if use_search_index:
+            response = c_iot.search_index(
+                indexName='AWS_Things', queryString=query_string, maxResults=500, **kwargs
+            )
+        else:
+            response = c_iot.list_things(maxResults=250, **kwargs)
+
+        for thing in response['things']:
+            yield thing
+
+        if not response.get('nextToken'):
+            return
+        kwargs = {'nextToken': response['nextToken']}
+
+
+def build_registry_digest(c_iot, use_search_index, query_string='thingName:*', depth=2, shards=1):
+    """Digest of the things in the region of c_iot. With search_index the
+    registry is scanned by shards concurrent cursors."""
+    logger.info('region: {} use_search_index: {} depth: {} shards: {}'.format(
+        c_iot.meta.region_name, use_search_index, depth, shards))
+
+    def build(query_string):
+        digest = RegistryDigest(depth)
+        for thing in iter_things(c_iot, use_search_index, query_string):
+            digest.add(thing)
+        return digest
+
+    try:
+        if not use_search_index or shards == 1:
+            digest = build(query_string)
+        else:
+            query_strings = get_shard_query_strings(query_string, shards=shards, c_iot=c_iot)
+            digest = RegistryDigest(depth)
+            with futures.ThreadPoolExecutor(max_workers=len(query_strings)) as executor:
+                for shard_digest in executor.map(build, query_strings):
+                    digest.merge(shard_digest)
+
+        logger.info('region: {} things: {} buckets: {} root: {}'.format(
+            c_iot.meta.region_name, digest.num_things(), len(digest.buckets), digest.root()))
+        return digest
+    except Exception as e:
+        logger.error('build_registry_digest: {}'.format(e))
+        raise RegistryDigestException(e)
+
+
+def diff_digests(digest_a, digest_b):
+    """Keys of the buckets with different digests and the number of
+    tree nodes compared. Subtrees with equal hashes are skipped."""
+    if digest_a.depth != digest_b.depth:
+        raise RegistryDigestException('depth mismatch: {} != {}'.format(digest_a.depth, digest_b.depth))
+
+    keys = []
+    num_nodes = 0
+    prefixes = ['']
+    while prefixes:
+        prefix = prefixes.pop()
+        num_nodes += 1
+        if digest_a.node_hash(prefix) == digest_b.node_hash(prefix):
+            continue
+        if prefix and digest_a.bucket(prefix) != digest_b.bucket(prefix):
+            keys.append(prefix)
+        prefixes.extend(digest_a.children(prefix) | digest_b.children(prefix))
+
+    return sorted(keys), num_nodes
+
+
+def diff_things(things_primary, things_secondary):
+    """Thing names missing in the secondary region, only existing in
+    the secondary region and with different type or attributes."""
+    missing = sorted(set(things_primary) - set(things_secondary))
+    extra = sorted(set(things_secondary) - set(things_primary))
+    drifted = sorted([
+        thing_name for thing_name in set(things_primary) & set(things_secondary)
+        if things_primary[thing_name] != things_secondary[thing_name]
+    ])
+    return missing, extra, drifted
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# registry events - events replicated to the secondary region
+#
+"""IoT DR: registry and shadow events from the DynamoDB stream
+of the global table, coalesced to their net operation and sharded
+by the resource they change.
+Will be deployed as Lambda layer."""
+
+import logging
+
+logger = logging.getLogger()
+
+# event types with CREATED, UPDATED and DELETED operations and the
+# attribute with the name of the resource
+COALESCED_EVENT_TYPES = {
+    'THING_EVENT': 'thingName',
+    'THING_GROUP_EVENT': 'thingGroupName',
+    'THING_TYPE_EVENT': 'thingTypeName'
+}
+
+# event types, kind and attribute with the name of the resource whose
+# events are replicated in order
+SHARD_KEYS = {
+    'THING_EVENT': ('thing', 'thingName'),
+    'THING_TYPE_ASSOCIATION_EVENT': ('thing', 'thingName'),
+    'THING_GROUP_MEMBERSHIP_EVENT': ('thing', 'thingArn'),
+    'SHADOW_EVENT': ('thing', 'thing_name'),
+    'THING_GROUP_EVENT': ('group', 'thingGroupName'),
+    'THING_GROUP_HIERARCHY_EVENT': ('group', 'childGroupName'),
+    'THING_TYPE_EVENT': ('type', 'thingTypeName')
+}
+
+
+def get_value(image, name):
+    value = image.get(name, {})
+    return value.get('S') if isinstance(value, dict) else None
+
+
+def get_timestamp(image):
+    """Timestamp of an event in milliseconds and whether it has
+    millisecond precision. Registry events have epoch milliseconds,
+    shadow events epoch seconds."""
+    try:
+        timestamp = int(image['timestamp']['N'])
+    except (KeyError, TypeError, ValueError):
+        return 0, False
+    # epoch milliseconds have more than 11 digits since 1973
+    if timestamp < 10**11:
+        return timestamp * 1000, False
+    return timestamp, True
+
+
+def get_referenced_names(image):
+    """(event_type, name) of the resources an event of another type
+    than COALESCED_EVENT_TYPES refers to."""
+    names = []
+    for event_type, name in [
+            ('THING_EVENT', get_value(image, 'thingName')),
+            ('THING_EVENT', get_value(image, 'thing_name')),
+            ('THING_EVENT', (get_value(image, 'thingArn') or '').split('/')[-1]),
+            ('THING_TYPE_EVENT', get_value(image, 'thingTypeName')),
+            ('THING_GROUP_EVENT', (get_value(image, 'groupArn') or '').split('/')[-1]),
+            ('THING_GROUP_EVENT', get_value(image, 'parentGroupName')),
+            ('THING_GROUP_EVENT', get_value(image, 'childGroupName'))]:
+        if name:
+            names.append((event_type, name))
+    return names
+
+
+def coalesce_operations(events):
+    """Net events of (operation, event) of one resource in the order
+    they happened. A CREATED followed by a DELETED cancel out, an
+    UPDATED replaces the UPDATED before it and a DELETED the UPDATED
+    and DELETED before it."""
+    net = []
+    for operation, event in events:
+        if operation == 'UPDATED':
+            if net and net[-1][0] == 'UPDATED':
+                net.pop()
+        elif operation == 'DELETED':
+            if net and net[-1][0] == 'UPDATED':
+                net.pop()
+            if net and net[-1][0] == 'CREATED':
+                net.pop()
+                continue
+            if net and net[-1][0] == 'DELETED':
+                net.pop()
+        elif operation != 'CREATED':
+            # unknown operation, events before it are kept
+            net = [(None, e) for _, e in net]
+        net.append((operation, event))
+
+    return [event for _, event in net]
+
+
+def coalesce_events(items):
+    """Items of DynamoDB stream records, i.e. record['dynamodb'], left
+    after coalescing the events of a thing, thing group or thing type
+    to their net operation, in the order of items. Events of a resource
+    are ordered by their timestamp. Resources referred to by events of
+    other types, e.g. a thing added to a group, are not coalesced."""
+    events = {}
+    pinned = set()
+    for i, item in enumerate(items):
+        image = item.get('NewImage', {})
+        event_type = get_value(image, 'eventType')
+        if event_type in COALESCED_EVENT_TYPES:
+            name = get_value(image, COALESCED_EVENT_TYPES[event_type])
+            if name:
+                events.setdefault((event_type, name), []).append(
+                    (get_timestamp(image)[0], i, get_value(image, 'operation'), item))
+                continue
+        pinned.update(get_referenced_names(image))
+
+    dropped = set()
+    for key, resource_events in events.items():
+        if key in pinned or len(resource_events) < 2:
+            continue
+        resource_events.sort(key=lambda e: (e[0], e[1]))
+        kept = coalesce_operations([(e[2], e[1]) for e in resource_events])
+        if len(kept) < len(resource_events):
+            logger.info('coalesced: {}: {}: operations: {} kept: {}'.format(
+                key[0], key[1], [e[2] for e in resource_events], len(kept)))
+        dropped.update(set([e[1] for e in resource_events]) - set(kept))
+
+    return [item for i, item in enumerate(items) if i not in dropped]
+
+
+def get_shard_key(image):
+    """(kind, name) of the resource an event changes, None for unknown
+    event types."""
+    event_type = get_value(image, 'eventType')
+    if event_type not in SHARD_KEYS:
+        return None
+    kind, name = SHARD_KEYS[event_type]
+    value = get_value(image, name)
+    if not value:
+        return None
+    return kind, value.split('/')[-1]
+
+
+def get_shards(items):
+    """Items of DynamoDB stream records split into shards of events of
+    the same thing, thing group or thing type ordered by their timestamp.
+    A shard with events of second precision, e.g. a shadow update with
+    thing events, is ordered by the second and the stream order within
+    a second. Events of one resource have to be replicated one after
+    the other, shards can be replicated in parallel. Events without a
+    key are a shard of their own. Shards are in the order of their
+    first item.
+
+    The order only holds within the items passed in, i.e. one trigger
+    invocation: the items of the global table are keyed by a random
+    uuid, so events of a resource can be on different stream shards and
+    be replicated by concurrent invocations."""
+    shards = {}
+    for i, item in enumerate(items):
+        image = item.get('NewImage', {})
+        key = get_shard_key(image)
+        if key is None:
+            key = ('item', i)
+        timestamp, precise = get_timestamp(image)
+        shards.setdefault(key, []).append((timestamp, precise, i, item))
+
+    result = []
+    for shard in sorted(shards.values(), key=lambda events: min([e[2] for e in events])):
+        if all([e[1] for e in shard]):
+            shard.sort(key=lambda e: (e[0], e[2]))
+        else:
+            shard.sort(key=lambda e: (e[0] // 1000, e[2]))
+        result.append([e[3] for e in shard])
+
+    return result
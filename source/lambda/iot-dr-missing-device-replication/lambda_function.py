@@ -16,7 +16,8 @@ import time
 import boto3
 
 from boto3.dynamodb.conditions import Key
-from device_replication import thing_exists, create_thing_with_cert_and_policy, delete_thing_create_error
+from client_pool import get_client
+from device_replication import replicate_things, delete_thing_create_error, get_deadline
 from dynamodb_json import json_util as ddb_json
 
 logger = logging.getLogger(__name__)
@@ -27,32 +28,34 @@ SECONDARY_REGION = os.environ['AWS_REGION']
 
 logger.info('DYNAMODB_ERROR_TABLE: {} SECONDARY_REGION: {}'.format(DYNAMODB_ERROR_TABLE, SECONDARY_REGION))
 
-def post_provision_thing(c_iot, c_dynamo, item):
+def post_provision_things(c_iot, c_dynamo, primary_region, thing_names, deadline):
     try:
         start_time = int(time.time()*1000)
-        thing_name = item['thing_name']
-        primary_region = item['primary_region']
-        logger.info('thing_name: {} primary_region: {}'.format(thing_name, primary_region))
-        c_iot_p = boto3.client('iot', region_name = primary_region)
-
-        # thing must exist in primary region
-        if not thing_exists(c_iot_p, thing_name):
-            logger.warn('thing_name "{}" does not exist in primary region: {}'.format(thing_name, primary_region))
-            return 'thing_name "{}" does not exist in primary region {}'.format(thing_name, primary_region)
-
-        logger.info('trying to post provision thing_name: {}'.format(thing_name))
-        create_thing_with_cert_and_policy(c_iot, c_iot_p, thing_name, "", {}, primary_region, SECONDARY_REGION, 1, 0)
-
-        delete_thing_create_error(c_dynamo, thing_name, DYNAMODB_ERROR_TABLE)
+        logger.info('primary_region: {} thing_names: {}'.format(primary_region, thing_names))
+        c_iot_p = get_client('iot', region_name=primary_region)
+
+        logger.info('trying to post provision things: {}'.format(len(thing_names)))
+        results = replicate_things(
+            c_iot, c_iot_p, [{'thingName': thing_name} for thing_name in thing_names], 1, 0,
+            deadline=deadline
+        )
+
+        for thing_name, result in results.items():
+            if result['status'] == 'replicated':
+                delete_thing_create_error(c_dynamo, thing_name, DYNAMODB_ERROR_TABLE)
+            elif result['status'] == 'not_in_primary':
+                logger.warn('thing_name "{}" does not exist in primary region: {}'.format(thing_name, primary_region))
+            else:
+                logger.error('thing_name: {}: post provisioning failed: {}'.format(thing_name, result['error']))
 
         end_time = int(time.time()*1000)
         duration = end_time - start_time
-        logger.info('post_provision_thing duration: {}ms'.format(duration))
+        logger.info('post_provision_things duration: {}ms'.format(duration))
     except Exception as e:
-        logger.error('post_provision_thing: {}'.format(e))
+        logger.error('post_provision_things: {}'.format(e))
 
 
-def find_orphaned_things(c_dynamo, c_dynamo_resource, c_iot):
+def find_orphaned_things(c_dynamo, c_dynamo_resource, c_iot, deadline):
     table = c_dynamo_resource.Table(DYNAMODB_ERROR_TABLE)
     while True:
         if not table.global_secondary_indexes or table.global_secondary_indexes[0]['IndexStatus'] != 'ACTIVE':
@@ -69,21 +72,26 @@ def find_orphaned_things(c_dynamo, c_dynamo_resource, c_iot):
     )
     logger.debug('response: {}'.format(response))
 
+    # group by primary region to replicate shared certificates and policies only once
+    thing_names_by_region = {}
     for item in response['Items']:
         item = ddb_json.loads(item)
         logger.info('item: {}'.format(item))
         if 'primary_region' in item:
-            post_provision_thing(c_iot, c_dynamo, item)
+            thing_names_by_region.setdefault(item['primary_region'], []).append(item['thing_name'])
         else:
             logger.warn('cannot post provision device {} - primary region unknown'.format(item['thing_name']))
 
+    for primary_region, thing_names in thing_names_by_region.items():
+        post_provision_things(c_iot, c_dynamo, primary_region, thing_names, deadline)
+
 
 def lambda_handler(event, context):
     logger.info('event: {}'.format(event))
 
-    c_dynamo = boto3.client('dynamodb')
+    c_dynamo = get_client('dynamodb')
     c_dynamo_resource = boto3.resource('dynamodb')
-    c_iot = boto3.client('iot')
-    find_orphaned_things(c_dynamo, c_dynamo_resource, c_iot)
+    c_iot = get_client('iot')
+    find_orphaned_things(c_dynamo, c_dynamo_resource, c_iot, get_deadline(context))
 
     return True
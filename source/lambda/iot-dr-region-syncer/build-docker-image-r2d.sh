@@ -9,7 +9,7 @@ ECR="AWS_ACCOUNT.dkr.ecr.AWS_REGION.amazonaws.com/$IMG"
 
 echo "building docker image \"$TAG\""
 
-cp ../iot-dr-layer/device_replication.py .
+cp ../iot-dr-layer/*.py .
 
 docker build --no-cache --tag $IMG:$TAG -f Dockerfile-r2d .
 
@@ -11,15 +11,24 @@ import hashlib
 import json
 import logging
 import os
+import random
 import sys
+import threading
 import time
 import uuid
 
-import boto3
+from concurrent import futures
 
-from botocore.config import Config
-from device_replication import thing_exists
+from checkpoint import (
+    get_checkpoint, get_cursors_counts, get_cursors_state, get_sync_id, get_trackers, iter_pages
+)
+from client_pool import get_client
+from concurrency import Pipeline
+from device_replication import (
+    build_thing_index, count_things, get_shard_query_strings, get_thing_content_digest
+)
 from dynamodb_json import json_util as ddb_json
+from metrics import Metrics, ProgressReporter
 
 logger = logging.getLogger()
 for h in logger.handlers:
@@ -33,44 +42,168 @@ logger.setLevel(logging.INFO)
 
 PRIMARY_REGION = os.environ['PRIMARY_REGION']
 SECONDARY_REGION = os.environ['SECONDARY_REGION']
+# full: events for all things, smart: events for missing things,
+# drift: also update events for things with other type or attributes
 SYNC_MODE = os.environ.get('SYNC_MODE', 'smart')
+SYNC_MODES = ['full', 'smart', 'drift']
 QUERY_STRING = os.environ.get('QUERY_STRING', 'thingName:*')
 DYNAMODB_GLOBAL_TABLE = os.environ['DYNAMODB_GLOBAL_TABLE']
-
-NUM_THINGS_TO_SYNC = 0
-NUM_THINGS_EXIST = 0
-NUM_ERRORS = 0
+# shard of this task out of SHARD_COUNT tasks, SHARDS cursors within the task
+SHARD_INDEX = int(os.environ.get('SHARD_INDEX', 0))
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', 1))
+SHARDS = int(os.environ.get('SHARDS', 1))
+# threads creating registry events
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 10))
+# things read from the primary region waiting for a worker
+QUEUE_SIZE = int(os.environ.get('QUEUE_SIZE', 1000))
+# concurrent BatchWriteItem requests of up to 25 events
+BATCH_WRITERS = int(os.environ.get('BATCH_WRITERS', 4))
+
+# seconds between progress reports
+PROGRESS_INTERVAL = int(os.environ.get('PROGRESS_INTERVAL', 60))
+
+# counters things_to_sync, things_to_update, things_exist and errors
+METRICS = Metrics()
 
 logger.info('PRIMARY_REGION: {} SECONDARY_REGION: {} SYNC_MODE: {} QUERY_STRING: {}'.
     format(PRIMARY_REGION, SECONDARY_REGION, SYNC_MODE, QUERY_STRING))
+logger.info('SHARD_INDEX: {} SHARD_COUNT: {} SHARDS: {}'.format(SHARD_INDEX, SHARD_COUNT, SHARDS))
+logger.info('MAX_WORKERS: {} QUEUE_SIZE: {} BATCH_WRITERS: {}'.format(MAX_WORKERS, QUEUE_SIZE, BATCH_WRITERS))
 logger.info('__name__: {}'.format(__name__))
 
 
-def update_event(c_dynamodb, event):
-    global NUM_THINGS_TO_SYNC, NUM_ERRORS
-    try:
-        response = c_dynamodb.put_item(
-            TableName=DYNAMODB_GLOBAL_TABLE,
-            Item=event
-        )
-        logger.info('response: {}'.format(response))
-        NUM_THINGS_TO_SYNC += 1
-    except Exception as e:
-        logger.error("update_table_create_thing_error: {}".format(e))
-        NUM_ERRORS += 1
-
-
-def create_registry_event(c_iot_s, c_dynamodb, thing, account_id):
-    global NUM_THINGS_EXIST, NUM_ERRORS
+class BatchWriter(object):
+    """Writes items with BatchWriteItem in batches of batch_size items
+    with up to max_batches requests in flight. put() blocks while
+    twice as many batches are waiting. Unprocessed items are retried
+    with exponential backoff and full jitter."""
+
+    def __init__(self, c_dynamodb, table_name, max_batches, batch_size=25, retries=8, wait=0.05):
+        self.c_dynamodb = c_dynamodb
+        self.table_name = table_name
+        self.batch_size = batch_size
+        self.retries = retries
+        self.wait = wait
+        self.items = {}
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_batches*2)
+        self.executor = futures.ThreadPoolExecutor(max_workers=max_batches)
+        self.num_requests = 0
+
+    def put(self, item, on_done):
+        """Queue item, on_done(success) is called when it has been written."""
+        batch = None
+        with self.lock:
+            # keys must be unique within a batch, the last event wins
+            key = item['uuid']['S']
+            if key in self.items:
+                # superseded by the later event of the same thing
+                self.items[key][1](True)
+            self.items[key] = (item, on_done)
+            if len(self.items) >= self.batch_size:
+                batch = self.items
+                self.items = {}
+        if batch:
+            self.submit(batch)
+
+    def submit(self, batch):
+        self.slots.acquire()
+        self.executor.submit(self.write_batch, list(batch.values()))
+
+    def flush(self):
+        with self.lock:
+            batch = self.items
+            self.items = {}
+        if batch:
+            self.submit(batch)
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown(wait=True)
+        logger.info('batch writer: requests: {}'.format(self.num_requests))
+
+    def write_batch(self, batch):
+        pending = {item['uuid']['S']: (item, on_done) for item, on_done in batch}
+        try:
+            for attempt in range(1, self.retries+1):
+                with self.lock:
+                    self.num_requests += 1
+                try:
+                    response = self.c_dynamodb.batch_write_item(
+                        RequestItems={
+                            self.table_name: [
+                                {'PutRequest': {'Item': item}} for item, _ in pending.values()
+                            ]
+                        }
+                    )
+                except Exception as e:
+                    # the whole batch is retried like unprocessed items
+                    logger.warning('batch writer: {}'.format(e))
+                    unprocessed = set(pending)
+                else:
+                    unprocessed = {
+                        request['PutRequest']['Item']['uuid']['S']
+                        for request in response.get('UnprocessedItems', {}).get(self.table_name, [])
+                    }
+                for key in list(pending):
+                    if key not in unprocessed:
+                        pending.pop(key)[1](True)
+                if not pending:
+                    return
+
+                if attempt < self.retries:
+                    backoff = random.uniform(0, self.wait*2**(attempt-1))
+                    logger.warning('batch writer: unprocessed items: {} retrying in {:.3f}s'.format(
+                        len(pending), backoff))
+                    time.sleep(backoff)
+
+            logger.error('batch writer: items not written after {} attempts: {}'.format(
+                self.retries, len(pending)))
+            for _, on_done in pending.values():
+                on_done(False)
+        except Exception as e:
+            logger.error('batch writer: {}'.format(e))
+            for _, on_done in pending.values():
+                on_done(False)
+        finally:
+            self.slots.release()
+
+
+def update_event(writer, event, done):
+    def on_done(success):
+        if not success:
+            outcome = 'errors'
+        elif event['operation']['S'] == 'UPDATED':
+            outcome = 'things_to_update'
+        else:
+            outcome = 'things_to_sync'
+        METRICS.inc(outcome)
+        # an item not written keeps its page from being committed
+        done(outcome, failed=not success)
+
+    writer.put(event, on_done)
+
+
+def create_registry_event(c_iot_s, writer, thing, account_id, thing_index, done):
+    """done(outcome, failed=False) is called with the name of the counter
+    incremented when the thing has been processed, failed when its event
+    could not be written."""
     logger.info('thing: {}'.format(thing))
     try:
         thing_name = thing['thingName']
 
-        if SYNC_MODE == "smart":
-            if thing_exists(c_iot_s, thing_name):
-                logger.info('thing_name {} exists already in secondary region {}'.format(thing_name, c_iot_s.meta.region_name))
-                NUM_THINGS_EXIST += 1
-                return
+        operation = "CREATED"
+        if SYNC_MODE in ["smart", "drift"]:
+            if thing_name in thing_index:
+                if SYNC_MODE == "drift" and \
+                    thing_index.get_content_digest(thing_name) != get_thing_content_digest(thing):
+                    logger.info('thing_name {} drifted in secondary region {}'.format(thing_name, c_iot_s.meta.region_name))
+                    operation = "UPDATED"
+                else:
+                    logger.info('thing_name {} exists already in secondary region {}'.format(thing_name, c_iot_s.meta.region_name))
+                    METRICS.inc('things_exist')
+                    done('things_exist')
+                    return
 
         # "uuid": "{}".format(uuid.uuid4()),
         event = {
@@ -80,7 +213,7 @@ def create_registry_event(c_iot_s, c_dynamodb, thing, account_id):
             "eventType" : "THING_EVENT",
             "eventId" : "{}".format(uuid.uuid4()),
             "timestamp" : int(time.time()*1000),
-            "operation" : "CREATED"
+            "operation" : operation
         }
 
         event['thingName'] = thing_name
@@ -89,6 +222,10 @@ def create_registry_event(c_iot_s, c_dynamodb, thing, account_id):
         if 'thingTypeName' in thing:
             thing_type_name = thing['thingTypeName']
             event['thingTypeName'] = thing_type_name
+        if operation == "UPDATED":
+            # thing type and attributes of the primary thing replace the
+            # ones of the drifted thing, missing ones are removed
+            event['fullReplace'] = True
 
         attrs = {}
         if 'attributes' in thing:
@@ -98,62 +235,68 @@ def create_registry_event(c_iot_s, c_dynamodb, thing, account_id):
 
         logger.info('thing_name: {} thing_type_name: {} attrs: {}'.format(thing_name, thing_type_name, attrs))
 
-        update_event(c_dynamodb, json.loads(ddb_json.dumps(event)))
+        update_event(writer, json.loads(ddb_json.dumps(event)), done)
     except Exception as e:
         logger.error("update_table_create_thing_error: {}".format(e))
-        NUM_ERRORS += 1
-
-
-def get_next_token(response):
-    next_token = None
-    if 'nextToken' in response:
-        next_token = response['nextToken']
-
-    #logger.info('next_token: {}'.format(next_token))
-    return next_token
+        METRICS.inc('errors')
+        done('errors')
+
+
+def get_sync_state(trackers):
+    return {
+        'cursors': get_cursors_state(trackers),
+        'num_things_to_sync': METRICS.value('things_to_sync'),
+        'num_things_to_update': METRICS.value('things_to_update'),
+        'num_things_exist': METRICS.value('things_exist'),
+        'num_errors': METRICS.value('errors')
+    }
+
+
+def restore_sync_state(state):
+    # counts of the things before the resume tokens, things after them are processed again
+    counts = get_cursors_counts(state['cursors'])
+    if counts is None:
+        counts = {
+            'things_to_sync': state['num_things_to_sync'],
+            'things_to_update': state.get('num_things_to_update', 0),
+            'things_exist': state['num_things_exist'],
+            'errors': state['num_errors']
+        }
+    for name in ['things_to_sync', 'things_to_update', 'things_exist', 'errors']:
+        METRICS.set(name, counts.get(name, 0))
+    return state['cursors']
 
 
-def get_search_things(c_iot_p, c_iot_s, c_dynamodb, account_id, query_string, max_results):
-    logger.info('query_string: {} max_results: {}'.format(query_string, max_results))
+def create_registry_events(pipeline, tracker, save_checkpoint, pages):
+    """Queue the things of pages for the workers of pipeline.
+    Returns True if all pages have been read."""
     try:
-        response = c_iot_p.search_index(
-            indexName='AWS_Things',
-            queryString=query_string,
-            maxResults=max_results
-        )
-
-        for thing in response['things']:
-            create_registry_event(c_iot_s, c_dynamodb, thing, account_id)
-
-        next_token = get_next_token(response)
-
-        while next_token:
-            response = c_iot_p.search_index(
-                indexName='AWS_Things',
-                nextToken=next_token,
-                queryString=query_string,
-                maxResults=max_results
-            )
-            next_token = get_next_token(response)
-
-            for thing in response['things']:
-                create_registry_event(c_iot_s, c_dynamodb, thing, account_id)
+        for token, things, next_token in pages:
+            page = tracker.add_page(token, len(things), next_token)
+            for thing in things:
+                pipeline.put((tracker, page, thing))
 
+            save_checkpoint()
+        tracker.complete()
+        return True
     except Exception as e:
         logger.error('{}'.format(e))
+        return False
 
 
-def get_list_things(c_iot_p, c_iot_s, c_dynamodb, account_id):
-    try:
-        paginator = c_iot_p.get_paginator("list_things")
+def get_search_things(c_iot_p, query_string, max_results, pipeline, tracker, save_checkpoint):
+    logger.info('query_string: {} max_results: {} start_token: {}'.format(
+        query_string, max_results, tracker.next_token))
+    pages = iter_pages(
+        c_iot_p.search_index, tracker.next_token,
+        indexName='AWS_Things', queryString=query_string, maxResults=max_results
+    )
+    return create_registry_events(pipeline, tracker, save_checkpoint, pages)
 
-        for page in paginator.paginate():
-            logger.debug('page: {}'.format(page))
-            logger.debug('things: {}'.format(page['things']))
-            for thing in page['things']:
-                create_registry_event(c_iot_s, c_dynamodb, thing, account_id)
-    except Exception as e:
-        logger.error('{}'.format(e))
+
+def get_list_things(c_iot_p, pipeline, tracker, save_checkpoint):
+    pages = iter_pages(c_iot_p.list_things, tracker.next_token, maxResults=250)
+    return create_registry_events(pipeline, tracker, save_checkpoint, pages)
 
 
 def registry_indexing_enabled(c_iot_p):
@@ -173,35 +316,135 @@ def registry_indexing_enabled(c_iot_p):
 
 def lambda_handler(event, context):
     logger.info('syncer: start')
-    global NUM_THINGS_TO_SYNC, NUM_THINGS_EXIST, NUM_ERRORS
     logger.info('event: {}'.format(event))
 
-    NUM_THINGS_TO_SYNC = 0
-    NUM_THINGS_EXIST = 0
-    NUM_ERRORS = 0
+    METRICS.reset()
 
-    boto3_config = Config(
-        max_pool_connections = 20,
-        retries = {'max_attempts': 10, 'mode': 'standard'}
-    )
+    if SYNC_MODE not in SYNC_MODES:
+        logger.error('invalid sync mode: {} allowed: {}'.format(SYNC_MODE, ', '.join(SYNC_MODES)))
+        raise Exception('invalid sync mode: {} allowed: {}'.format(SYNC_MODE, ', '.join(SYNC_MODES)))
 
-    c_iot_p = boto3.client('iot', config=boto3_config, region_name=PRIMARY_REGION)
-    c_iot_s = boto3.client('iot', config=boto3_config, region_name=SECONDARY_REGION)
-    c_dynamodb = boto3.client('dynamodb', region_name=PRIMARY_REGION)
+    retries = {'max_attempts': 10, 'mode': 'standard'}
+    c_iot_p = get_client('iot', region_name=PRIMARY_REGION, retries=retries)
+    c_iot_s = get_client('iot', region_name=SECONDARY_REGION, retries=retries)
+    c_dynamodb = get_client('dynamodb', region_name=PRIMARY_REGION, max_workers=BATCH_WRITERS)
 
-    account_id = boto3.client('sts').get_caller_identity()['Account']
+    account_id = get_client('sts').get_caller_identity()['Account']
 
-    if registry_indexing_enabled(c_iot_p):
+    # resume an interrupted sync from its checkpoint
+    checkpoint = get_checkpoint(
+        get_sync_id(
+            'region-to-ddb', PRIMARY_REGION, SECONDARY_REGION, SYNC_MODE, QUERY_STRING,
+            SHARD_INDEX, SHARD_COUNT, SHARDS
+        ),
+        region_name=PRIMARY_REGION
+    )
+    state = None
+    if checkpoint:
+        state = checkpoint.load()
+
+    # cursors over the primary registry: query strings of the shards of this task,
+    # split by the counts of the fleet index, list_things can't be sharded and is
+    # read by the first task only. A resumed sync keeps the cursors of its
+    # checkpoint, the counts may have changed since
+    use_search_index = registry_indexing_enabled(c_iot_p)
+    if use_search_index:
         logger.info('registry indexing enabled - using search_index to get things')
-        get_search_things(c_iot_p, c_iot_s, c_dynamodb, account_id, QUERY_STRING, 100)
     else:
         logger.info('registry indexing disabled - using list_things to get things')
-        get_list_things(c_iot_p, c_iot_s, c_dynamodb, account_id)
+    if state and use_search_index == ('list_things' in state['cursors']):
+        logger.info('registry indexing changed since the checkpoint - sync starts over')
+        state = None
+    if state:
+        cursors = list(state['cursors'])
+    elif use_search_index:
+        cursors = get_shard_query_strings(
+            QUERY_STRING, SHARD_INDEX, SHARD_COUNT, SHARDS, c_iot=c_iot_p)
+    else:
+        cursors = ['list_things'] if SHARD_INDEX == 0 else []
+    logger.info('cursors: {}'.format(cursors))
+
+    trackers = get_trackers(cursors)
+    if state:
+        trackers = get_trackers(cursors, restore_sync_state(state))
+        logger.info('resuming sync: state: {}'.format(state))
+
+    def save_checkpoint():
+        if checkpoint:
+            checkpoint.save_due(lambda: get_sync_state(trackers))
+
+    # one scan of the secondary registry instead of a describe_thing per thing
+    thing_index = None
+    if SYNC_MODE in ["smart", "drift"]:
+        thing_index = build_thing_index(
+            c_iot_s, registry_indexing_enabled(c_iot_s), with_contents=SYNC_MODE == "drift"
+        )
+
+    writer = BatchWriter(c_dynamodb, DYNAMODB_GLOBAL_TABLE, BATCH_WRITERS)
+
+    # things of this task for the ETA, list_things can't count things
+    total = count_things(c_iot_p, cursors) if use_search_index else None
+    progress = ProgressReporter(
+        METRICS, ['things_to_sync', 'things_to_update', 'things_exist', 'errors'], total=total,
+        interval=PROGRESS_INTERVAL, name='syncer: progress'
+    ).start()
+
+    def create_page_thing_event(item):
+        tracker, page, thing = item
+        # a page is done when the events of all its things are written
+        create_registry_event(
+            c_iot_s, writer, thing, account_id, thing_index,
+            lambda outcome, failed=False: tracker.done(page, outcome, failed)
+        )
 
-    if SYNC_MODE == "smart":
-        logger.info('syncer: stats: NUM_THINGS_TO_SYNC: {} NUM_THINGS_EXIST: {} NUM_ERRORS: {}'.format(NUM_THINGS_TO_SYNC, NUM_THINGS_EXIST, NUM_ERRORS))
+    # the paginators block while QUEUE_SIZE things are waiting
+    pipeline = Pipeline(create_page_thing_event, MAX_WORKERS, QUEUE_SIZE, name='syncer')
+
+    cursors = [cursor for cursor in cursors if not trackers[cursor].finished()]
+    completed = True
+    if cursors:
+        # one thread per cursor
+        with futures.ThreadPoolExecutor(max_workers=len(cursors)) as executor:
+            if use_search_index:
+                results = executor.map(
+                    lambda cursor: get_search_things(
+                        c_iot_p, cursor, 100, pipeline, trackers[cursor], save_checkpoint),
+                    cursors
+                )
+            else:
+                results = executor.map(
+                    lambda cursor: get_list_things(
+                        c_iot_p, pipeline, trackers[cursor], save_checkpoint),
+                    cursors
+                )
+            completed = all(list(results))
+
+    logger.info('pipeline: waiting to finish')
+    pipeline.close()
+    writer.close()
+    progress.stop()
+
+    # pages with events not written keep the checkpoint at their resume token
+    if completed and not all(tracker.finished() for tracker in trackers.values()):
+        logger.error('syncer: events not written, run the sync again to resume at the first page with failed things')
+        completed = False
+
+    if checkpoint:
+        if completed:
+            checkpoint.delete()
+        else:
+            checkpoint.save(get_sync_state(trackers))
+
+    if SYNC_MODE == "drift":
+        logger.info('syncer: stats: NUM_THINGS_TO_SYNC: {} NUM_THINGS_TO_UPDATE: {} NUM_THINGS_EXIST: {} NUM_ERRORS: {}'.format(
+            METRICS.value('things_to_sync'), METRICS.value('things_to_update'),
+            METRICS.value('things_exist'), METRICS.value('errors')))
+    elif SYNC_MODE == "smart":
+        logger.info('syncer: stats: NUM_THINGS_TO_SYNC: {} NUM_THINGS_EXIST: {} NUM_ERRORS: {}'.format(
+            METRICS.value('things_to_sync'), METRICS.value('things_exist'), METRICS.value('errors')))
     else:
-        logger.info('syncer: stats: NUM_THINGS_TO_SYNC: {} NUM_ERRORS: {}'.format(NUM_THINGS_TO_SYNC, NUM_ERRORS))
+        logger.info('syncer: stats: NUM_THINGS_TO_SYNC: {} NUM_ERRORS: {}'.format(
+            METRICS.value('things_to_sync'), METRICS.value('errors')))
 
     logger.info('syncer: stop')
     return True
@@ -15,10 +15,18 @@ import traceback
 
 from concurrent import futures
 
-import boto3
-
-from botocore.config import Config
-from device_replication import thing_exists, create_thing_with_cert_and_policy
+from checkpoint import (
+    get_checkpoint, get_cursors_counts, get_cursors_state, get_sync_id, get_trackers, iter_pages
+)
+from client_pool import get_client
+from concurrency import AIMDController, Pipeline, prefetch, watch_latency, watch_throttling
+from device_replication import (
+    build_thing_index, count_things, create_thing_with_cert_and_policy,
+    get_attribute_payload, get_failed_creates, get_round_trips_saved, get_shard_query_strings,
+    get_thing_content_digest, new_replication_cache, set_write_mode,
+    update_drifted_thing
+)
+from metrics import Metrics, ProgressReporter
 
 logger = logging.getLogger()
 for h in logger.handlers:
@@ -32,108 +40,143 @@ logger.setLevel(logging.INFO)
 
 PRIMARY_REGION = os.environ['PRIMARY_REGION']
 SECONDARY_REGION = os.environ['SECONDARY_REGION']
+# full: sync all things, smart: sync missing things,
+# drift: sync missing things and update things with other type or attributes
 SYNC_MODE = os.environ.get('SYNC_MODE', 'smart')
+SYNC_MODES = ['full', 'smart', 'drift']
+WRITE_MODE = os.environ.get('WRITE_MODE', 'check_first')
 QUERY_STRING = os.environ.get('QUERY_STRING', 'thingName:*')
+# initial and maximum number of things synced concurrently
 MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 10))
-
-NUM_THINGS_SYNCED = 0
-NUM_THINGS_EXIST = 0
-NUM_ERRORS = 0
-
-logger.info('PRIMARY_REGION: {} SECONDARY_REGION: {} SYNC_MODE: {} QUERY_STRING: {} MAX_WORKERS: {}'.
-    format(PRIMARY_REGION, SECONDARY_REGION, SYNC_MODE, QUERY_STRING, MAX_WORKERS))
+MAX_CONCURRENCY = int(os.environ.get('MAX_CONCURRENCY', 200))
+# things read from the primary region waiting to be synced
+QUEUE_SIZE = int(os.environ.get('QUEUE_SIZE', 1000))
+# pages read ahead of the page being queued
+PREFETCH_PAGES = int(os.environ.get('PREFETCH_PAGES', 1))
+# threads: boto3 on a thread pool, asyncio: aiobotocore on one event loop
+ENGINE = os.environ.get('ENGINE', 'threads')
+MAX_IN_FLIGHT = int(os.environ.get('MAX_IN_FLIGHT', 500))
+# shard of this task out of SHARD_COUNT tasks, SHARDS cursors within the task
+SHARD_INDEX = int(os.environ.get('SHARD_INDEX', 0))
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', 1))
+SHARDS = int(os.environ.get('SHARDS', 1))
+# seconds between progress reports
+PROGRESS_INTERVAL = int(os.environ.get('PROGRESS_INTERVAL', 60))
+
+# counters things_synced, things_updated, things_exist, errors and latencies of sync_thing
+METRICS = Metrics()
+
+logger.info('PRIMARY_REGION: {} SECONDARY_REGION: {} SYNC_MODE: {} QUERY_STRING: {} MAX_WORKERS: {} MAX_CONCURRENCY: {} ENGINE: {}'.
+    format(PRIMARY_REGION, SECONDARY_REGION, SYNC_MODE, QUERY_STRING, MAX_WORKERS, MAX_CONCURRENCY, ENGINE))
+logger.info('SHARD_INDEX: {} SHARD_COUNT: {} SHARDS: {}'.format(SHARD_INDEX, SHARD_COUNT, SHARDS))
 logger.info('__name__: {}'.format(__name__))
 
+set_write_mode(WRITE_MODE)
 
-def sync_thing(c_iot_p, c_iot_s, thing):
-    global NUM_THINGS_SYNCED, NUM_THINGS_EXIST, NUM_ERRORS
+
+def sync_thing(c_iot_p, c_iot_s, thing, cache, thing_index):
+    """Returns the counter of the outcome."""
     try:
         logger.info('thing: {}'.format(thing))
         start_time = int(time.time()*1000)
         thing_name = thing['thingName']
 
-        if SYNC_MODE == "smart":
-            if thing_exists(c_iot_s, thing_name):
+        if SYNC_MODE in ["smart", "drift"]:
+            if thing_name in thing_index:
+                if SYNC_MODE == "drift" and \
+                    thing_index.get_content_digest(thing_name) != get_thing_content_digest(thing):
+                    logger.info('thing_name {} drifted in secondary region {}'.format(thing_name, SECONDARY_REGION))
+                    update_drifted_thing(c_iot_s, thing)
+                    duration = int(time.time()*1000) - start_time
+                    METRICS.inc('things_updated')
+                    METRICS.observe('update_drifted_thing', duration / 1000.0)
+                    return 'things_updated'
+
                 logger.info('thing_name {} exists already in secondary region {}'.format(thing_name, SECONDARY_REGION))
-                NUM_THINGS_EXIST += 1
-                return
+                METRICS.inc('things_exist')
+                return 'things_exist'
 
         thing_type_name = ""
         if 'thingTypeName' in thing:
             thing_type_name = thing['thingTypeName']
 
-        attrs = {}
-        if 'attributes' in thing:
-            attrs = {'attributes': {}}
-            for key in thing['attributes']:
-                attrs['attributes'][key] = thing['attributes'][key]
-
-        if 'attributes' in attrs:
-            attrs['merge'] = False
+        attrs = get_attribute_payload(thing)
 
         logger.info('thing_name: {} thing_type_name: {} attrs: {}'.format(thing_name, thing_type_name, attrs))
 
-        create_thing_with_cert_and_policy(c_iot_s, c_iot_p, thing_name, thing_type_name, attrs, 2, 1)
+        create_thing_with_cert_and_policy(c_iot_s, c_iot_p, thing_name, thing_type_name, attrs, 2, 1, cache=cache)
         end_time = int(time.time()*1000)
         duration = end_time - start_time
-        NUM_THINGS_SYNCED += 1
+        METRICS.inc('things_synced')
+        METRICS.observe('sync_thing', duration / 1000.0)
         logger.info('sync thing: thing_name: {} duration: {}ms'.format(thing_name, duration))
+        return 'things_synced'
     except Exception as e:
         logger.error('{}'.format(e))
-        NUM_ERRORS += 1
+        METRICS.inc('errors')
         traceback.print_stack()
-
-
-def get_next_token(response):
-    next_token = None
-    if 'nextToken' in response:
-        next_token = response['nextToken']
-
-    #logger.info('next_token: {}'.format(next_token))
-    return next_token
-
-
-def get_search_things(c_iot_p, c_iot_s, query_string, max_results, executor):
-    logger.info('query_string: {} max_results: {}'.format(query_string, max_results))
+        return 'errors'
+
+
+def get_sync_state(trackers):
+    return {
+        'cursors': get_cursors_state(trackers),
+        'num_things_synced': METRICS.value('things_synced'),
+        'num_things_updated': METRICS.value('things_updated'),
+        'num_things_exist': METRICS.value('things_exist'),
+        'num_errors': METRICS.value('errors')
+    }
+
+
+def restore_sync_state(state):
+    # counts of the things before the resume tokens, things after them are synced again
+    counts = get_cursors_counts(state['cursors'])
+    if counts is None:
+        counts = {
+            'things_synced': state['num_things_synced'],
+            'things_updated': state.get('num_things_updated', 0),
+            'things_exist': state['num_things_exist'],
+            'errors': state['num_errors']
+        }
+    for name in ['things_synced', 'things_updated', 'things_exist', 'errors']:
+        METRICS.set(name, counts.get(name, 0))
+    return state['cursors']
+
+
+def queue_things(pages, pipeline, tracker, save_checkpoint):
+    """Queue the things of pages for the workers of pipeline, the next
+    PREFETCH_PAGES pages are read while a page is queued.
+    Returns True if all pages have been read."""
     try:
-        response = c_iot_p.search_index(
-            indexName='AWS_Things',
-            queryString=query_string,
-            maxResults=max_results
-        )
-
-        for thing in response['things']:
-            executor.submit(sync_thing, c_iot_p, c_iot_s, thing)
-
-        next_token = get_next_token(response)
-
-        while next_token:
-            response = c_iot_p.search_index(
-                indexName='AWS_Things',
-                nextToken=next_token,
-                queryString=query_string,
-                maxResults=max_results
-            )
-            next_token = get_next_token(response)
-
-            for thing in response['things']:
-                executor.submit(sync_thing, c_iot_p, c_iot_s, thing)
-                #sync_thing(c_iot_p, c_iot_s, thing)
+        if PREFETCH_PAGES > 0:
+            pages = prefetch(pages, PREFETCH_PAGES)
+        for token, things, next_token in pages:
+            logger.debug('things: {}'.format(things))
+            page = tracker.add_page(token, len(things), next_token)
+            for thing in things:
+                pipeline.put((tracker, page, thing))
+
+            save_checkpoint()
+        tracker.complete()
+        return True
     except Exception as e:
         logger.error('{}'.format(e))
+        return False
 
 
-def get_list_things(c_iot_p, c_iot_s):
-    try:
-        paginator = c_iot_p.get_paginator("list_things")
+def get_search_things(c_iot_p, query_string, max_results, pipeline, tracker, save_checkpoint):
+    logger.info('query_string: {} max_results: {} start_token: {}'.format(
+        query_string, max_results, tracker.next_token))
+    pages = iter_pages(
+        c_iot_p.search_index, tracker.next_token,
+        indexName='AWS_Things', queryString=query_string, maxResults=max_results
+    )
+    return queue_things(pages, pipeline, tracker, save_checkpoint)
 
-        for page in paginator.paginate():
-            logger.debug('page: {}'.format(page))
-            logger.debug('things: {}'.format(page['things']))
-            for thing in page['things']:
-                sync_thing(c_iot_p, c_iot_s, thing)
-    except Exception as e:
-        logger.error('{}'.format(e))
+
+def get_list_things(c_iot_p, pipeline, tracker, save_checkpoint):
+    pages = iter_pages(c_iot_p.list_things, tracker.next_token, maxResults=250)
+    return queue_things(pages, pipeline, tracker, save_checkpoint)
 
 
 def registry_indexing_enabled(c_iot_p):
@@ -151,51 +194,194 @@ def registry_indexing_enabled(c_iot_p):
         raise Exception(e)
 
 
-def lambda_handler(event, context):
-    logger.info('syncer: start')
-    global NUM_THINGS_SYNCED, NUM_THINGS_EXIST, NUM_ERRORS
-    logger.info('event: {}'.format(event))
-
-    NUM_THINGS_SYNCED = 0
-    NUM_THINGS_EXIST = 0
-    NUM_ERRORS = 0
-
-    if MAX_WORKERS > 50:
-        logger.error('max allowed workers is 50 defined: {}'.format(MAX_WORKERS))
-        raise Exception('max allowed workers is 50 defined: {}'.format(MAX_WORKERS))
+def sync_things_asyncio(use_search_index, query_strings, thing_index):
+    # aiobotocore is only needed by the asyncio engine
+    from device_replication_async import replicate_registry, run
 
-    max_pool_connections = 10
-    if MAX_WORKERS >= 10:
-        max_pool_connections = round(MAX_WORKERS*1.2)
+    def thing_filter(thing):
+        if SYNC_MODE == "smart" and thing['thingName'] in thing_index:
+            logger.info('thing_name {} exists already in secondary region {}'.format(
+                thing['thingName'], SECONDARY_REGION))
+            METRICS.inc('things_exist')
+            return False
+        return True
 
-    logger.info('max_pool_connections: {}'.format(max_pool_connections))
+    def on_result(thing_name, result):
+        if result['status'] == 'replicated':
+            METRICS.inc('things_synced')
+        elif result['status'] == 'error':
+            logger.error('thing_name: {}: {}'.format(thing_name, result['error']))
+            METRICS.inc('errors')
 
-    boto3_config = Config(
-        max_pool_connections = max_pool_connections,
-        retries = {'max_attempts': 10, 'mode': 'standard'}
-    )
+    for query_string in query_strings:
+        counts = run(replicate_registry(
+            PRIMARY_REGION, SECONDARY_REGION, use_search_index,
+            query_string=query_string, thing_filter=thing_filter,
+            max_in_flight=MAX_IN_FLIGHT, on_result=on_result,
+            retries={'max_attempts': 10, 'mode': 'standard'}
+        ))
+        logger.info('query_string: {}: {}'.format(query_string, counts))
 
-    c_iot_p = boto3.client('iot', config=boto3_config, region_name=PRIMARY_REGION)
-    c_iot_s = boto3.client('iot', config=boto3_config, region_name=SECONDARY_REGION)
 
-    executor = futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
-    logger.info('executor: started: {}'.format(executor))
+def lambda_handler(event, context):
+    logger.info('syncer: start')
+    logger.info('event: {}'.format(event))
 
-    if registry_indexing_enabled(c_iot_p):
+    METRICS.reset()
+
+    if SYNC_MODE not in SYNC_MODES:
+        logger.error('invalid sync mode: {} allowed: {}'.format(SYNC_MODE, ', '.join(SYNC_MODES)))
+        raise Exception('invalid sync mode: {} allowed: {}'.format(SYNC_MODE, ', '.join(SYNC_MODES)))
+
+    if SYNC_MODE == 'drift' and ENGINE == 'asyncio':
+        logger.error('sync mode drift not supported by the asyncio engine')
+        raise Exception('sync mode drift not supported by the asyncio engine')
+
+    if ENGINE not in ['threads', 'asyncio']:
+        logger.error('invalid engine: {} allowed: threads, asyncio'.format(ENGINE))
+        raise Exception('invalid engine: {} allowed: threads, asyncio'.format(ENGINE))
+
+    if MAX_WORKERS > MAX_CONCURRENCY:
+        logger.error('MAX_WORKERS: {} greater than MAX_CONCURRENCY: {}'.format(MAX_WORKERS, MAX_CONCURRENCY))
+        raise Exception('MAX_WORKERS: {} greater than MAX_CONCURRENCY: {}'.format(MAX_WORKERS, MAX_CONCURRENCY))
+
+    retries = {'max_attempts': 10, 'mode': 'standard'}
+    c_iot_p = get_client('iot', region_name=PRIMARY_REGION, max_workers=MAX_CONCURRENCY, retries=retries)
+    c_iot_s = get_client('iot', region_name=SECONDARY_REGION, max_workers=MAX_CONCURRENCY, retries=retries)
+    watch_throttling(c_iot_p)
+    watch_throttling(c_iot_s)
+    watch_latency(c_iot_p)
+    watch_latency(c_iot_s)
+
+    # certificates, policies and thing types shared by things are resolved once per run
+    cache = new_replication_cache()
+
+    # resume an interrupted sync from its checkpoint, not supported by the asyncio engine
+    checkpoint = None
+    if ENGINE == 'threads':
+        checkpoint = get_checkpoint(
+            get_sync_id(
+                'region-to-region', PRIMARY_REGION, SECONDARY_REGION, SYNC_MODE, QUERY_STRING,
+                SHARD_INDEX, SHARD_COUNT, SHARDS
+            ),
+            region_name=PRIMARY_REGION
+        )
+    state = None
+    if checkpoint:
+        state = checkpoint.load()
+
+    # cursors over the primary registry: query strings of the shards of this task,
+    # split by the counts of the fleet index, list_things can't be sharded and is
+    # read by the first task only. A resumed sync keeps the cursors of its
+    # checkpoint, the counts may have changed since
+    use_search_index = registry_indexing_enabled(c_iot_p)
+    if use_search_index:
         logger.info('registry indexing enabled - using search_index to get things')
-        get_search_things(c_iot_p, c_iot_s, QUERY_STRING, 100, executor)
     else:
         logger.info('registry indexing disabled - using list_things to get things')
-        get_list_things(c_iot_p, c_iot_s)
+    if state and use_search_index == ('list_things' in state['cursors']):
+        logger.info('registry indexing changed since the checkpoint - sync starts over')
+        state = None
+    if state:
+        cursors = list(state['cursors'])
+    elif use_search_index:
+        cursors = get_shard_query_strings(
+            QUERY_STRING, SHARD_INDEX, SHARD_COUNT, SHARDS, c_iot=c_iot_p)
+    else:
+        cursors = ['list_things'] if SHARD_INDEX == 0 else []
+    logger.info('cursors: {}'.format(cursors))
+
+    trackers = get_trackers(cursors)
+    if state:
+        trackers = get_trackers(cursors, restore_sync_state(state))
+        logger.info('resuming sync: state: {}'.format(state))
+
+    def save_checkpoint():
+        if checkpoint:
+            checkpoint.save_due(lambda: get_sync_state(trackers))
+
+    # one scan of the secondary registry instead of a describe_thing per thing
+    thing_index = None
+    if SYNC_MODE in ["smart", "drift"]:
+        thing_index = build_thing_index(
+            c_iot_s, registry_indexing_enabled(c_iot_s), with_contents=SYNC_MODE == "drift"
+        )
 
-    logger.info('executor: waiting to finish')
-    executor.shutdown(wait=True)
-    logger.info('executor: shutted down')
+    # things of this task for the ETA, list_things can't count things
+    total = count_things(c_iot_p, cursors) if use_search_index else None
+    progress = ProgressReporter(
+        METRICS, ['things_synced', 'things_updated', 'things_exist', 'errors'], total=total,
+        interval=PROGRESS_INTERVAL, name='syncer: progress'
+    ).start()
 
-    if SYNC_MODE == "smart":
-        logger.info('syncer: stats: NUM_THINGS_SYNCED: {} NUM_THINGS_EXIST: {} NUM_ERRORS: {}'.format(NUM_THINGS_SYNCED, NUM_THINGS_EXIST, NUM_ERRORS))
+    if ENGINE == 'asyncio':
+        logger.info('asyncio engine: max_in_flight: {}'.format(MAX_IN_FLIGHT))
+        sync_things_asyncio(use_search_index, cursors, thing_index)
     else:
-        logger.info('syncer: stats: NUM_THINGS_SYNCED: {} NUM_ERRORS: {}'.format(NUM_THINGS_SYNCED, NUM_ERRORS))
+        # starts with MAX_WORKERS things in flight and adapts up to MAX_CONCURRENCY
+        controller = AIMDController(MAX_WORKERS, maximum=MAX_CONCURRENCY, name='syncer').start()
+        def sync_page_thing(item):
+            tracker, page, thing = item
+            outcome = None
+            try:
+                outcome = sync_thing(c_iot_p, c_iot_s, thing, cache, thing_index)
+                # things without API calls to the secondary region don't grow the window
+                return outcome in ['things_synced', 'things_updated']
+            finally:
+                tracker.done(page, outcome)
+
+        # the paginators block while QUEUE_SIZE things are waiting
+        pipeline = Pipeline(
+            sync_page_thing, MAX_CONCURRENCY, QUEUE_SIZE, controller=controller, name='syncer'
+        )
+
+        cursors = [cursor for cursor in cursors if not trackers[cursor].finished()]
+        completed = True
+        if cursors:
+            # one thread per cursor
+            with futures.ThreadPoolExecutor(max_workers=len(cursors)) as executor:
+                if use_search_index:
+                    results = executor.map(
+                        lambda cursor: get_search_things(
+                            c_iot_p, cursor, 100, pipeline, trackers[cursor], save_checkpoint),
+                        cursors
+                    )
+                else:
+                    results = executor.map(
+                        lambda cursor: get_list_things(
+                            c_iot_p, pipeline, trackers[cursor], save_checkpoint),
+                        cursors
+                    )
+                completed = all(list(results))
+
+        logger.info('pipeline: waiting to finish')
+        pipeline.close()
+        controller.stop()
+        logger.info('syncer: stats: concurrency: {}'.format(controller.stats()))
+
+        if checkpoint:
+            if completed:
+                checkpoint.delete()
+            else:
+                checkpoint.save(get_sync_state(trackers))
+
+    progress.stop()
+    for histogram_stats in METRICS.histogram_stats():
+        logger.info('syncer: stats: latency: {}'.format(histogram_stats))
+
+    if SYNC_MODE == "drift":
+        logger.info('syncer: stats: NUM_THINGS_SYNCED: {} NUM_THINGS_UPDATED: {} NUM_THINGS_EXIST: {} NUM_ERRORS: {}'.format(
+            METRICS.value('things_synced'), METRICS.value('things_updated'),
+            METRICS.value('things_exist'), METRICS.value('errors')))
+    elif SYNC_MODE == "smart":
+        logger.info('syncer: stats: NUM_THINGS_SYNCED: {} NUM_THINGS_EXIST: {} NUM_ERRORS: {}'.format(
+            METRICS.value('things_synced'), METRICS.value('things_exist'), METRICS.value('errors')))
+    else:
+        logger.info('syncer: stats: NUM_THINGS_SYNCED: {} NUM_ERRORS: {}'.format(
+            METRICS.value('things_synced'), METRICS.value('errors')))
+
+    logger.info('syncer: stats: WRITE_MODE: {} round trips saved: {} failed creates: {}'.format(
+        WRITE_MODE, get_round_trips_saved(), get_failed_creates()))
 
     logger.info('syncer: stop')
     return True
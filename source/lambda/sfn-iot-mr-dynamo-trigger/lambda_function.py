@@ -8,10 +8,16 @@
 #
 
 import boto3
+import importlib
 import json
 import logging
 import os
 import sys
+import time
+
+from concurrent import futures
+
+from registry_events import coalesce_events, get_shards
 
 logger = logging.getLogger()
 for h in logger.handlers:
@@ -25,38 +31,230 @@ logger.setLevel(logging.INFO)
 logger.debug('boto3 version: {}'.format(boto3.__version__))
 
 STATEMACHINE_ARN = os.environ['STATEMACHINE_ARN']
+# shards of records are replicated by one state machine execution with up
+# to BATCH_MAX_ITEMS items, the input of an execution is limited to 256 KB
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 100))
+BATCH_MAX_BYTES = int(os.environ.get('BATCH_MAX_BYTES', 200000))
+# executions started concurrently
+START_WORKERS = int(os.environ.get('START_WORKERS', 10))
+# direct: records are replicated by the replication functions packaged
+# with the trigger, records failing are replicated by the state machine
+# statemachine: all records are replicated by the state machine
+DISPATCH_MODE = os.environ.get('DISPATCH_MODE', 'statemachine')
+# milliseconds of the invocation left for starting executions
+DIRECT_RESERVE_MS = int(os.environ.get('DIRECT_RESERVE_MS', 15000))
+# shards replicated directly in parallel
+DIRECT_WORKERS = int(os.environ.get('DIRECT_WORKERS', 10))
+# events of a thing, thing group or thing type within the records of an
+# invocation are coalesced to their net operation, the window is the
+# batching window of the event source mapping
+COALESCE_EVENTS = os.environ.get('COALESCE_EVENTS', 'false').lower() == 'true'
+
+# event type prefix and module of the replication function
+DIRECT_HANDLERS = [
+    ('THING_EVENT', 'thing_crud'),
+    ('THING_GROUP_', 'thing_group_crud'),
+    ('THING_TYPE', 'thing_type_crud'),
+    ('SHADOW_EVENT', 'shadow_syncer')
+]
+HANDLERS = {}
 
 c_sfn = boto3.client('stepfunctions')
 
+
+def get_batches(shards):
+    """Pack shards of (sequence_number, item) records into lists of
+    shards with at most BATCH_MAX_ITEMS records and BATCH_MAX_BYTES of
+    JSON items. A shard is only split if it exceeds a batch on its own,
+    its parts are not replicated in order."""
+    batches = []
+    batch = []
+    num_items = 0
+    size = 0
+    for shard in shards:
+        # parts of the shard and their sizes
+        parts = [[[], 16]]
+        for record in shard:
+            item_size = len(json.dumps(record[1])) + 2
+            if parts[-1][0] and (len(parts[-1][0]) >= BATCH_MAX_ITEMS or parts[-1][1] + item_size > BATCH_MAX_BYTES):
+                parts.append([[], 16])
+            parts[-1][0].append(record)
+            parts[-1][1] += item_size
+        if len(parts) > 1:
+            logger.warning('shard split: records: {} parts: {}'.format(len(shard), len(parts)))
+
+        for part, part_size in parts:
+            if batch and (num_items + len(part) > BATCH_MAX_ITEMS or size + part_size > BATCH_MAX_BYTES):
+                batches.append(batch)
+                batch = []
+                num_items = 0
+                size = 0
+            batch.append(part)
+            num_items += len(part)
+            size += part_size
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def get_direct_handler(event_type):
+    """lambda_handler of the replication function for event_type, None
+    if there is none or it can't be imported."""
+    for prefix, module_name in DIRECT_HANDLERS:
+        if not event_type.startswith(prefix):
+            continue
+        if module_name not in HANDLERS:
+            try:
+                HANDLERS[module_name] = importlib.import_module(module_name).lambda_handler
+            except Exception as e:
+                logger.error('import: module_name: {}: {}'.format(module_name, e))
+                HANDLERS[module_name] = None
+        return HANDLERS[module_name]
+
+    return None
+
+
+def replicate_shard(shard, context):
+    """Replicate the (event_type, sequence_number, item) records of a
+    shard in order by the replication functions. Returns the records left
+    for the state machine starting with the first record without a
+    function, failing or left when the invocation runs out of time, so a
+    later event of a resource is never applied before an earlier one."""
+    for i, (event_type, sequence_number, item) in enumerate(shard):
+        if context is not None and context.get_remaining_time_in_millis() < DIRECT_RESERVE_MS:
+            logger.warning('time left below: {}ms: records left for the state machine: {}'.format(
+                DIRECT_RESERVE_MS, len(shard) - i))
+            return shard[i:]
+
+        handler = get_direct_handler(event_type)
+        if handler is None:
+            return shard[i:]
+
+        try:
+            handler(item, context)
+        except Exception as e:
+            logger.error('direct: event_type: {} sequence_number: {}: {}: records left for the state machine: {}'.format(
+                event_type, sequence_number, e, len(shard) - i))
+            return shard[i:]
+
+    return []
+
+
+def replicate_direct(shards, context):
+    """Replicate shards in parallel, returns the shards of the records
+    left for the state machine."""
+    # import the replication functions before the threads start
+    for event_type in set([event_type for shard in shards for event_type, _, _ in shard]):
+        get_direct_handler(event_type)
+    # the replication functions are packaged with the trigger by the build
+    # scripts, without them DISPATCH_MODE direct falls back to the state machine
+    missing = sorted([module_name for module_name, handler in HANDLERS.items() if handler is None])
+    if missing:
+        logger.error('direct: replication functions not packaged with the trigger: {}: records are replicated by the state machine'.format(
+            missing))
+
+    left = []
+    start_time = time.time()
+    num_records = sum([len(shard) for shard in shards])
+    if shards:
+        with futures.ThreadPoolExecutor(max_workers=min(DIRECT_WORKERS, len(shards))) as executor:
+            for shard in executor.map(lambda shard: replicate_shard(shard, context), shards):
+                if shard:
+                    left.append(shard)
+
+    logger.info('direct: shards: {} records replicated: {} duration: {}ms'.format(
+        len(shards), num_records - sum([len(shard) for shard in left]),
+        int((time.time() - start_time)*1000)))
+    return left
+
+
+def start_execution(shards):
+    input = json.dumps({'shards': [{'items': items} for items in shards]})
+    logger.debug(input)
+
+    logger.info('starting statemachine execution: STATEMACHINE_ARN: {} shards: {} items: {}'.format(
+        STATEMACHINE_ARN, len(shards), sum([len(items) for items in shards])))
+    response = c_sfn.start_execution(
+        stateMachineArn=STATEMACHINE_ARN,
+        input=input
+    )
+    logger.info('response: {}'.format(response))
+
+
+def start_batch_execution(batch):
+    """Returns the sequence numbers of the records of batch if the
+    execution could not be started."""
+    try:
+        start_execution([[item for _, item in shard] for shard in batch])
+        return []
+    except Exception as e:
+        logger.error('shards: {}: {}'.format(len(batch), e))
+        return [sequence_number for shard in batch for sequence_number, _ in shard]
+
+
 def lambda_handler(event, context):
+    """Returns the records to be retried as batchItemFailures, the event
+    source mapping reports partial batch failures."""
     logger.info('event: {}'.format(event))
     logger.debug(json.dumps(event, indent=4))
 
+    logger.info('length Records: {}'.format(len(event['Records'])))
+    failed = []
     try:
-        logger.info('length Records: {}'.format(len(event['Records'])))
-
+        # records in stream order
+        records = []
         for record in event['Records']:
-            logger.info('event type: {}'.format(record['dynamodb']['NewImage']['eventType']['S']))
             item = record['dynamodb']
             logger.info('item: {}'.format(item))
-            logger.info('event type: {}'.format(item['NewImage']['eventType']['S']))
-            logger.info('region: {} update region: {}'.format(os.environ['AWS_REGION'], item['NewImage']['aws:rep:updateregion']['S']))
+            try:
+                event_type = item['NewImage']['eventType']['S']
+                update_region = item['NewImage']['aws:rep:updateregion']['S']
+            except KeyError as e:
+                # a retry would fail the same way
+                logger.error('invalid record: missing key: {}: ignoring: {}'.format(e, record))
+                continue
+            logger.info('event type: {}'.format(event_type))
+            logger.info('region: {} update region: {}'.format(os.environ['AWS_REGION'], update_region))
 
-            if os.environ['AWS_REGION'] == item['NewImage']['aws:rep:updateregion']['S']:
+            if os.environ['AWS_REGION'] == update_region:
                 logger.info('item has been created in the same region and is not to be considered as replication - ignoring')
-                return {'message': 'item has been created in the same region and is not to be considered as replication - ignoring'}
+                continue
 
-            input = json.dumps(item)
-            logger.debug(input)
+            records.append((event_type, item['SequenceNumber'], item))
 
-            logger.info('starting statemachine execution: STATEMACHINE_ARN: {}'.format(STATEMACHINE_ARN))
-            response = c_sfn.start_execution(
-                stateMachineArn=STATEMACHINE_ARN,
-                input=input
-            )
-            logger.info('response: {}'.format(response))
+        logger.info('COALESCE_EVENTS: {}'.format(COALESCE_EVENTS))
+        if COALESCE_EVENTS:
+            num_records = len(records)
+            kept = set([id(item) for item in coalesce_events([item for _, _, item in records])])
+            records = [record for record in records if id(record[2]) in kept]
+            logger.info('coalesced: records: {} left: {}'.format(num_records, len(records)))
 
-        return {'message': 'statemachine started'}
+        # records of a thing, thing group or thing type in timestamp order
+        by_item = {id(record[2]): record for record in records}
+        shards = [
+            [by_item[id(item)] for item in shard]
+            for shard in get_shards([item for _, _, item in records])
+        ]
+        logger.info('records: {} shards: {}'.format(len(records), len(shards)))
+
+        logger.info('DISPATCH_MODE: {}'.format(DISPATCH_MODE))
+        if DISPATCH_MODE == 'direct':
+            shards = replicate_direct(shards, context)
+
+        batches = get_batches([
+            [(sequence_number, item) for _, sequence_number, item in shard] for shard in shards
+        ])
+        if batches:
+            with futures.ThreadPoolExecutor(max_workers=min(START_WORKERS, len(batches))) as executor:
+                for sequence_numbers in executor.map(start_batch_execution, batches):
+                    failed.extend(sequence_numbers)
+
+        logger.info('records: {} executions: {} records failed: {}'.format(
+            len(event['Records']), len(batches), len(failed)))
     except Exception as e:
         logger.error('{}'.format(e))
-        return {'message': 'error: {}'.format(e)}
+        # the whole batch is retried
+        failed = [record['dynamodb']['SequenceNumber'] for record in event['Records']]
+
+    return {'batchItemFailures': [{'itemIdentifier': sequence_number} for sequence_number in failed]}
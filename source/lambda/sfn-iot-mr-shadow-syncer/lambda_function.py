@@ -14,9 +14,7 @@ import logging
 import os
 import sys
 
-import boto3
-
-from botocore.config import Config
+from client_pool import get_client
 from dynamodb_json import json_util as ddb_json
 
 logger = logging.getLogger()
@@ -28,7 +26,6 @@ h.setFormatter(logging.Formatter(FORMAT))
 logger.addHandler(h)
 logger.setLevel(logging.INFO)
 
-ERRORS = []
 IOT_ENDPOINT_PRIMARY = os.environ['IOT_ENDPOINT_PRIMARY']
 IOT_ENDPOINT_SECONDARY = os.environ['IOT_ENDPOINT_SECONDARY']
 
@@ -47,7 +44,7 @@ def get_iot_data_endpoint(region, iot_endpoints):
 
         if iot_data_endpoint is None:
             logger.info('iot_data_endpoint not found calling describe_endpoint')
-            iot_data_endpoint = boto3.client('iot').describe_endpoint(endpointType='iot:Data-ATS')['endpointAddress']
+            iot_data_endpoint = get_client('iot').describe_endpoint(endpointType='iot:Data-ATS')['endpointAddress']
             logger.info('iot_data_endpoint from describe_endpoint: {}'.format(iot_data_endpoint))
         else:
             logger.info('iot_data_endpoint from iot_endpoints: {}'.format(iot_data_endpoint))
@@ -59,7 +56,6 @@ def get_iot_data_endpoint(region, iot_endpoints):
 
 
 def update_shadow(c_iot_data, thing_name, shadow):
-    global ERRORS
     try:
         logger.info('update thing shadow: thing_name: {} payload: {}'.format(thing_name, shadow))
 
@@ -71,23 +67,26 @@ def update_shadow(c_iot_data, thing_name, shadow):
         logger.info('response: {}'.format(response))
     except Exception as e:
         logger.error('update_shadow: {}'.format(e))
-        ERRORS.append('update_shadow: {}'.format(e))
+        raise ShadowSyncerException('update_shadow: {}'.format(e))
 
 
 def lambda_handler(event, context):
-    global ERRORS
+    errors = []
+
     logger.info('event: {}'.format(event))
     logger.debug('context: {}'.format(context))
 
     try:
-        boto3_config = Config(retries = {'max_attempts': 12, 'mode': 'standard'})
-
         iot_data_endpoint = get_iot_data_endpoint(
             os.environ['AWS_REGION'],
             [IOT_ENDPOINT_PRIMARY, IOT_ENDPOINT_SECONDARY]
         )
 
-        c_iot_data = boto3.client('iot-data', config=boto3_config, endpoint_url='https://{}'.format(iot_data_endpoint))
+        c_iot_data = get_client(
+            'iot-data',
+            endpoint_url='https://{}'.format(iot_data_endpoint),
+            retries={'max_attempts': 12, 'mode': 'standard'}
+        )
 
         event = ddb_json.loads(event)
         logger.info('cleaned event: {}'.format(event))
@@ -102,10 +101,10 @@ def lambda_handler(event, context):
 
     except Exception as e:
         logger.error('{}'.format(e))
-        ERRORS.append('lambda_handler: {}'.format(e))
+        errors.append('lambda_handler: {}'.format(e))
 
-    if ERRORS:
-        error_message = ', '.join(ERRORS)
+    if errors:
+        error_message = ', '.join(errors)
         logger.error('{}'.format(error_message))
         raise ShadowSyncerException('{}'.format(error_message))
 
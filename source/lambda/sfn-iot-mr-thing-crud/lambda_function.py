@@ -14,15 +14,15 @@ import os
 import sys
 import time
 
-import boto3
-
 import device_replication
 
-from botocore.config import Config
+from client_pool import get_client
 from device_replication import (
     create_thing, create_thing_with_cert_and_policy,
     delete_thing_create_error, delete_thing,
-    get_iot_data_endpoint
+    get_deadline, get_failed_creates, get_iot_data_endpoint,
+    get_round_trips_saved, set_write_mode,
+    update_drifted_thing, update_thing
 )
 from dynamodb_json import json_util as ddb_json
 
@@ -35,16 +35,20 @@ h.setFormatter(logging.Formatter(FORMAT))
 logger.addHandler(h)
 logger.setLevel(logging.INFO)
 
-ERRORS = []
 DYNAMODB_ERROR_TABLE = os.environ['DYNAMODB_ERROR_TABLE']
 CREATE_MODE = os.environ.get('CREATE_MODE', 'complete')
+WRITE_MODE = os.environ.get('WRITE_MODE', 'check_first')
 IOT_ENDPOINT_PRIMARY = os.environ['IOT_ENDPOINT_PRIMARY']
 IOT_ENDPOINT_SECONDARY = os.environ['IOT_ENDPOINT_SECONDARY']
+BOTO3_RETRIES = {'max_attempts': 12, 'mode': 'standard'}
 
 
 class ThingCrudException(Exception): pass
 
 
+set_write_mode(WRITE_MODE)
+
+
 def update_table_create_thing_error(c_dynamo, thing_name, primary_region, error_message):
     logger.info('update_table_create_thing_error: thing_name: {}'.format(thing_name))
     try:
@@ -63,8 +67,7 @@ def update_table_create_thing_error(c_dynamo, thing_name, primary_region, error_
 
 
 def lambda_handler(event, context):
-    global ERRORS
-    ERRORS = []
+    errors = []
 
     logger.info('event: {}'.format(event))
 
@@ -72,10 +75,8 @@ def lambda_handler(event, context):
         event = ddb_json.loads(event)
         logger.info('cleaned event: {}'.format(event))
 
-        boto3_config = Config(retries = {'max_attempts': 12, 'mode': 'standard'})
-
-        c_iot = boto3.client('iot', config=boto3_config)
-        c_dynamo = boto3.client('dynamodb')
+        c_iot = get_client('iot', retries=BOTO3_RETRIES)
+        c_dynamo = get_client('dynamodb')
 
         secondary_region = os.environ['AWS_REGION']
         logger.info('secondary_region: {}'.format(secondary_region))
@@ -102,13 +103,16 @@ def lambda_handler(event, context):
             logger.info('primary_region: {}'.format(primary_region))
             logger.info('CREATE_MODE: {}'.format(CREATE_MODE))
 
-            c_iot_p = boto3.client('iot', config=boto3_config, region_name = primary_region)
+            c_iot_p = get_client('iot', region_name=primary_region, retries=BOTO3_RETRIES)
 
             start_time = int(time.time()*1000)
             if CREATE_MODE == 'thing_only':
                 create_thing(c_iot, c_iot_p, thing_name, thing_type_name, attrs)
             else:
-                create_thing_with_cert_and_policy(c_iot, c_iot_p, thing_name, thing_type_name, attrs, 3, 2)
+                create_thing_with_cert_and_policy(
+                    c_iot, c_iot_p, thing_name, thing_type_name, attrs, 3, 2,
+                    deadline=get_deadline(context)
+                )
             end_time = int(time.time()*1000)
             duration = end_time - start_time
             logger.info('thing created: thing_name: {}: duration: {}ms'.format(thing_name, duration))
@@ -123,10 +127,10 @@ def lambda_handler(event, context):
             primary_region = event['NewImage']['aws:rep:updateregion']
             logger.info('primary_region: {}'.format(primary_region))
 
-            c_iot_p = boto3.client('iot', config=boto3_config, region_name = primary_region)
+            c_iot_p = get_client('iot', region_name=primary_region, retries=BOTO3_RETRIES)
 
             attrs = {}
-            if 'attributes' in event['NewImage']:
+            if event['NewImage'].get('attributes'):
                 for key in event['NewImage']['attributes']:
                     attrs[key] = event['NewImage']['attributes'][key]
 
@@ -134,13 +138,22 @@ def lambda_handler(event, context):
             if attrs:
                 merge = False
 
-            thing_type_name = ""
-            if 'S' in event['NewImage']['thingTypeName']:
-                thing_type_name = event['NewImage']['thingTypeName']['S']
+            thing_type_name = event['NewImage'].get('thingTypeName') or ""
+            if isinstance(thing_type_name, dict):
+                # events written by earlier versions of the region syncer
+                thing_type_name = thing_type_name.get('S', "")
 
             logger.info("thing_name: {} thing_type_name: {} attrs: {}".
                 format(thing_name, thing_type_name, attrs))
-            update_thing(c_iot, c_iot_p, thing_name, thing_type_name, attrs, merge)
+            if event['NewImage'].get('fullReplace'):
+                # thing drifted in the secondary region: thing type and
+                # attributes are replaced by the ones of the primary region
+                thing = {'thingName': thing_name, 'attributes': attrs}
+                if thing_type_name:
+                    thing['thingTypeName'] = thing_type_name
+                update_drifted_thing(c_iot, thing)
+            else:
+                update_thing(c_iot, c_iot_p, thing_name, thing_type_name, attrs, merge)
 
         if event['NewImage']['operation'] == 'DELETED':
             logger.info('operation: {}'.format(event['NewImage']['operation']))
@@ -157,17 +170,20 @@ def lambda_handler(event, context):
 
     except device_replication.DeviceReplicationCreateThingException as e:
         logger.error(e)
-        ERRORS.append("lambda_handler: {}".format(e))
-        error_message = ', '.join(ERRORS)
+        errors.append("lambda_handler: {}".format(e))
+        error_message = ', '.join(errors)
         if event['NewImage']['operation'] == 'CREATED':
             update_table_create_thing_error(c_dynamo, thing_name, primary_region, error_message)
 
     except Exception as e:
         logger.error(e)
-        ERRORS.append('lambda_handler: {}'.format(e))
+        errors.append('lambda_handler: {}'.format(e))
+
+    logger.info('WRITE_MODE: {} round trips saved in this container: {} failed creates: {}'.format(
+        WRITE_MODE, get_round_trips_saved(), get_failed_creates()))
 
-    if ERRORS:
-        error_message = ', '.join(ERRORS)
+    if errors:
+        error_message = ', '.join(errors)
         logger.error('{}'.format(error_message))
         raise ThingCrudException('{}'.format(error_message))
 
@@ -8,14 +8,21 @@
 #
 
 import logging
+import os
 
-import boto3
+from client_pool import get_client
+from device_replication import (
+    create_failed, get_failed_creates, get_round_trips_saved,
+    optimistic_writes, round_trip_saved, set_write_mode
+)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-ERRORS = []
+WRITE_MODE = os.environ.get('WRITE_MODE', 'check_first')
+
+set_write_mode(WRITE_MODE)
 
 class ThingGroupCrudException(Exception): pass
 
@@ -38,9 +45,8 @@ def thing_group_exists(c_iot, thing_group_name):
 
 def create_thing_group(c_iot, thing_group_name, description, attrs, merge):
     logger.info("create thing group: thing_group_name: {}".format(thing_group_name))
-    global ERRORS
     try:
-        if not thing_group_exists(c_iot, thing_group_name):
+        if optimistic_writes() or not thing_group_exists(c_iot, thing_group_name):
             response = c_iot.create_thing_group(
                 thingGroupName=thing_group_name,
                 thingGroupProperties={
@@ -52,27 +58,31 @@ def create_thing_group(c_iot, thing_group_name, description, attrs, merge):
                 }
             )
             logger.info("create_thing_group: response: {}".format(response))
+            if optimistic_writes():
+                round_trip_saved()
         else:
             logger.info("thing group exists already: {}".format(thing_group_name))
+    except c_iot.exceptions.ResourceAlreadyExistsException:
+        logger.info("thing group exists already: {}".format(thing_group_name))
+        if optimistic_writes():
+            create_failed()
     except Exception as e:
         logger.error("create_thing_group: {}".format(e))
-        ERRORS.append("create_thing_group: {}".format(e))
+        raise ThingGroupCrudException("create_thing_group: {}".format(e))
 
 
 def delete_thing_group(c_iot, thing_group_name):
     logger.info("delete thing group: thing_group_name: {}".format(thing_group_name))
-    global ERRORS
     try:
         response = c_iot.delete_thing_group(thingGroupName=thing_group_name)
         logger.info('delete_thing_group: {}'.format(response))
     except Exception as e:
         logger.error("create_thing_group: {}".format(e))
-        ERRORS.append("create_thing_group: {}".format(e))
+        raise ThingGroupCrudException("create_thing_group: {}".format(e))
 
 
 def update_thing_group(c_iot, thing_group_name, description, attrs, merge):
     logger.info("update thing group: thing_group_name: {}".format(thing_group_name))
-    global ERRORS
     try:
         create_thing_group(c_iot, thing_group_name, "", {}, True)
         response = c_iot.update_thing_group(
@@ -88,13 +98,12 @@ def update_thing_group(c_iot, thing_group_name, description, attrs, merge):
         logger.info('update_thing_group: {}'.format(response))
     except Exception as e:
         logger.error("create_thing_group: {}".format(e))
-        ERRORS.append("create_thing_group: {}".format(e))
+        raise ThingGroupCrudException("create_thing_group: {}".format(e))
 
 
 
 def add_thing_to_group(c_iot, thing_group_name, thing_name):
     logger.info("add thing to group: thing_group_name: {} thing_name: {}".format(thing_group_name, thing_name))
-    global ERRORS
     try:
         create_thing_group(c_iot, thing_group_name, "", {}, True)
         response = c_iot.add_thing_to_thing_group(
@@ -104,12 +113,11 @@ def add_thing_to_group(c_iot, thing_group_name, thing_name):
         logger.info("add_thing_to_group: {}".format(response))
     except Exception as e:
         logger.error("add_thing_to_group: {}".format(e))
-        ERRORS.append("add_thing_to_group: {}".format(e))
+        raise ThingGroupCrudException("add_thing_to_group: {}".format(e))
 
 
 def remove_thing_from_group(c_iot, thing_group_name, thing_name):
     logger.info("remove thing from group: thing_group_name: {} thing_name: {}".format(thing_group_name, thing_name))
-    global ERRORS
     try:
         response = c_iot.remove_thing_from_thing_group(
             thingGroupName=thing_group_name,
@@ -117,17 +125,16 @@ def remove_thing_from_group(c_iot, thing_group_name, thing_name):
         logger.info("remove_thing_from_group: {}".format(response))
     except Exception as e:
         logger.error("add_thing_to_group: {}".format(e))
-        ERRORS.append("add_thing_to_group: {}".format(e))
+        raise ThingGroupCrudException("add_thing_to_group: {}".format(e))
 
 
 def lambda_handler(event, context):
-    global ERRORS
-    ERRORS = []
+    errors = []
 
     logger.info('event: {}'.format(event))
 
     try:
-        c_iot = boto3.client('iot')
+        c_iot = get_client('iot')
 
         if event['NewImage']['eventType']['S'] == 'THING_GROUP_EVENT':
             thing_group_name = event['NewImage']['thingGroupName']['S']
@@ -179,10 +186,13 @@ def lambda_handler(event, context):
 
     except Exception as e:
         logger.error(e)
-        ERRORS.append("lambda_handler: {}".format(e))
+        errors.append("lambda_handler: {}".format(e))
+
+    logger.info('WRITE_MODE: {} round trips saved in this container: {} failed creates: {}'.format(
+        WRITE_MODE, get_round_trips_saved(), get_failed_creates()))
 
-    if ERRORS:
-        error_message = ', '.join(ERRORS)
+    if errors:
+        error_message = ', '.join(errors)
         logger.error('{}'.format(error_message))
         raise ThingGroupCrudException('{}'.format(error_message))
 
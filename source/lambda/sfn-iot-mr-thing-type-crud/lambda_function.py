@@ -5,9 +5,14 @@
 thing type CreateUpdateDelete"""
 
 import logging
+import os
 import sys
 
-import boto3
+from client_pool import get_client
+from device_replication import (
+    create_failed, get_failed_creates, get_round_trips_saved,
+    optimistic_writes, round_trip_saved, set_write_mode
+)
 
 logger = logging.getLogger()
 for h in logger.handlers:
@@ -18,6 +23,10 @@ h.setFormatter(logging.Formatter(FORMAT))
 logger.addHandler(h)
 logger.setLevel(logging.INFO)
 
+WRITE_MODE = os.environ.get('WRITE_MODE', 'check_first')
+
+set_write_mode(WRITE_MODE)
+
 
 class ThingTypeCrudException(Exception): pass
 
@@ -88,13 +97,17 @@ def update_thing_type(c_iot, thing_name, thing_type_name):
 def create_thing_type(c_iot, thing_type_name):
     logger.info("create thing type: thing_type_name: {}".format(thing_type_name))
     try:
-        if not thing_type_exists(c_iot, thing_type_name):
+        if optimistic_writes() or not thing_type_exists(c_iot, thing_type_name):
             response = c_iot.create_thing_type(thingTypeName=thing_type_name)
             logger.info("create_thing_type: response: {}".format(response))
+            if optimistic_writes():
+                round_trip_saved()
         else:
             logger.info("thing type exists already: {}".format(thing_type_name))
     except c_iot.exceptions.ResourceAlreadyExistsException:
         logger.info('exists already thing_type_name: {}'.format(thing_type_name))
+        if optimistic_writes():
+            create_failed()
     except Exception as e:
         logger.error("create_thing_type: {}".format(e))
         raise(e)
@@ -103,7 +116,7 @@ def create_thing_type(c_iot, thing_type_name):
 def lambda_handler(event, context):
     logger.info('event: {}'.format(event))
     try:
-        c_iot = boto3.client('iot')
+        c_iot = get_client('iot')
 
         if event['NewImage']['eventType']['S'] == 'THING_TYPE_EVENT':
             if event['NewImage']['operation']['S'] == 'CREATED':
@@ -141,5 +154,8 @@ def lambda_handler(event, context):
     except Exception as e:
         logger.error(e)
         raise ThingTypeCrudException('{}'.format(e))
+    finally:
+        logger.info('WRITE_MODE: {} round trips saved in this container: {} failed creates: {}'.format(
+            WRITE_MODE, get_round_trips_saved(), get_failed_creates()))
 
     return {"message": "success"}
@@ -84,7 +84,7 @@ echo "$(dt): syncing jupyter to S3: $BUCKET_PRIMARY_REGION"
 aws s3 sync jupyter s3://$BUCKET_PRIMARY_REGION/jupyter/
 
 echo "$(dt): syncing tools to S3: $BUCKET_PRIMARY_REGION"
-cp lambda/iot-dr-layer/device_replication.py tools/
+cp lambda/iot-dr-layer/*.py tools/
 aws s3 sync tools s3://$BUCKET_PRIMARY_REGION/tools/
 
 echo "$(dt): syncing region syncers to S3: $BUCKET_PRIMARY_REGION"
@@ -15,9 +15,7 @@ import logging
 import sys
 import time
 
-import boto3
-import boto3.session
-
+from client_pool import get_client
 from device_replication import delete_thing
 
 logger = logging.getLogger()
@@ -50,8 +48,8 @@ POLICY_NAMES = {}
 THING_NAMES = []
 NUM_ERRORS = 0
 
-session = boto3.session.Session(region_name=args.region)
-c_iot = session.client('iot', region_name=args.region)
+# calls are paced by the rate limiter of the client pool
+c_iot = get_client('iot', region_name=args.region)
 iot_data_endpoint = c_iot.describe_endpoint(endpointType='iot:Data-ATS')['endpointAddress']
 
 logger.info("query_string: %s region: %s", args.query_string, args.region)
@@ -105,7 +103,6 @@ for thing_name in THING_NAMES:
             delete_thing(c_iot, thing_name, iot_data_endpoint)
             THING_DELETED = True
             NUM_THINGS_DELETED += 1
-            time.sleep(0.1) # avoid to run into api throttling
             break
         except Exception as delete_error:
             logger.error("delete thing thing_name: %s: %s", thing_name, delete_error)
@@ -21,6 +21,9 @@ import boto3.session
 
 from botocore.config import Config
 
+from device_replication import count_things
+from metrics import Metrics, ProgressReporter
+
 
 logger = logging.getLogger()
 for h in logger.handlers:
@@ -39,9 +42,8 @@ parser.add_argument('--max-workers', default=10, type=int, help="Maximum number
 parser.add_argument('--query-string', default='thingName:*', help="Query string.")
 args = parser.parse_args()
 
-NUM_THINGS_COMPARED = 0
-NUM_THINGS_NOTSYNCED = 0
-NUM_ERRORS = 0
+# counters things_compared, things_notsynced, errors and latencies of compare_device
+METRICS = Metrics()
 
 
 def print_response(response):
@@ -86,7 +88,6 @@ def get_device_status(c_iot, thing_name):
 
 
 def compare_device(thing_name):
-    global NUM_THINGS_COMPARED, NUM_THINGS_NOTSYNCED, NUM_ERRORS
     try:
         logger.info('thing_name: {}'.format(thing_name))
         start_time = int(time.time()*1000)
@@ -108,15 +109,16 @@ def compare_device(thing_name):
 
         if errors:
             logger.error('replication error: {}: primary: {} secondary: {}'.format(','.join(errors), device_status_primary, device_status_secondary))
-            NUM_ERRORS += 1
+            METRICS.inc('errors')
 
         end_time = int(time.time()*1000)
         duration = end_time - start_time
-        NUM_THINGS_COMPARED += 1
+        METRICS.inc('things_compared')
+        METRICS.observe('compare_device', duration / 1000.0)
         logger.info('compare device: thing_name: {} duration: {}ms'.format(thing_name, duration))
     except Exception as e:
         logger.error('{}'.format(e))
-        NUM_ERRORS += 1
+        METRICS.inc('errors')
         traceback.print_stack()
 
 
@@ -178,10 +180,6 @@ try:
         format(args.primary_region, args.secondary_region, args.query_string, args.max_workers))
     time.sleep(2)
 
-    NUM_THINGS_COMPARED = 0
-    NUM_THINGS_NOTSYNCED = 0
-    NUM_ERRORS = 0
-
     if args.max_workers > 50:
         logger.error('max allowed workers is 50 defined: {}'.format(args.max_workers))
         raise Exception('max allowed workers is 50 defined: {}'.format(args.max_workers))
@@ -209,14 +207,22 @@ try:
         logger.info('registry indexing enabled must be enabled in region: {}'.format(args.primary_region))
         raise Exception('indexing not enabled in region: {}'.format(args.primary_region))
 
+    progress = ProgressReporter(
+        METRICS, ['things_compared'], total=count_things(c_iot_p, [args.query_string]),
+        interval=10, name='cmp: progress'
+    ).start()
+
     get_search_things(args.query_string, 100)
 
 
     logger.info('executor: waiting to finish')
     executor.shutdown(wait=True)
     logger.info('executor: shutted down')
+    progress.stop()
 
-    logger.info('cmp: stats: NUM_THINGS_COMPARED: {} NUM_THINGS_NOTSYNCED: {} NUM_ERRORS: {}'.format(NUM_THINGS_COMPARED, NUM_THINGS_NOTSYNCED, NUM_ERRORS))
+    logger.info('cmp: stats: latency: {}'.format(METRICS.histogram('compare_device').stats()))
+    logger.info('cmp: stats: NUM_THINGS_COMPARED: {} NUM_THINGS_NOTSYNCED: {} NUM_ERRORS: {}'.format(
+        METRICS.value('things_compared'), METRICS.value('things_notsynced'), METRICS.value('errors')))
 
     logger.info('cmp: stop')
 except Exception as e:
@@ -26,6 +26,8 @@ import boto3.session
 
 from botocore.config import Config
 
+from metrics import Metrics, ProgressReporter
+
 
 logger = logging.getLogger()
 for h in logger.handlers:
@@ -44,9 +46,8 @@ parser.add_argument('--num-tests', default=10, type=int, help="Nunmber of tests
 parser.add_argument('--max-workers', default=10, type=int, help="Maximum number of worker threads. Allowed maximum is 50.")
 args = parser.parse_args()
 
-NUM_SHADOWS_COMPARED = 0
-NUM_SHADOWS_NOTSYNCED = 0
-NUM_ERRORS = 0
+# counters shadows_compared, shadows_notsynced, errors and latencies of compare_shadow
+METRICS = Metrics()
 
 THING_SHADOWS = {}
 
@@ -90,10 +91,10 @@ def get_shadow(i, c_iot_s, thing_name):
 
 
 def compare_shadow(i, c_iot_s, thing_name, shadow_payload):
-    global NUM_SHADOWS_COMPARED, NUM_SHADOWS_NOTSYNCED, NUM_ERRORS
     try:
         logger.info('i: {} thing_name: {} shadow_payload: {}'.format(i, thing_name, shadow_payload))
-        NUM_SHADOWS_COMPARED += 1
+        METRICS.inc('shadows_compared')
+        start_time = time.time()
         shadow_payload_secondary = {}
         retries = 5
         wait = 2
@@ -109,9 +110,10 @@ def compare_shadow(i, c_iot_s, thing_name, shadow_payload):
 
         if not shadow_payload_secondary:
             logger.error('replication: thing_name: {}: shadow not replicated to secondary region'.format(thing_name))
-            NUM_SHADOWS_NOTSYNCED += 1
+            METRICS.inc('shadows_notsynced')
             return
 
+        METRICS.observe('compare_shadow', time.time() - start_time)
         logger.info('i: {} thing_name: {} shadow_payload: {} shadow_payload_secondary: {}'.format(i, thing_name, shadow_payload, shadow_payload_secondary))
 
         errors = []
@@ -166,10 +168,6 @@ try:
         format(args.primary_region, args.secondary_region, args.num_tests, args.max_workers))
     time.sleep(2)
 
-    NUM_SHADOWS_COMPARED = 0
-    NUM_SHADOWS_NOTSYNCED = 0
-    NUM_ERRORS = 0
-
     if args.max_workers > 50:
         logger.error('max allowed workers is 50 defined: {}'.format(args.max_workers))
         raise Exception('max allowed workers is 50 defined: {}'.format(args.max_workers))
@@ -209,6 +207,9 @@ try:
     logger.info('executor compare_shadow: started: {}'.format(executor))
 
     logger.info(THING_SHADOWS)
+    progress = ProgressReporter(
+        METRICS, ['shadows_compared'], total=len(THING_SHADOWS), interval=10, name='cmp: progress'
+    ).start()
     y = 0
     for thing_name in THING_SHADOWS.keys():
         y += 1
@@ -217,6 +218,7 @@ try:
     logger.info('executor compare_shadow: waiting to finish')
     executor.shutdown(wait=True)
     logger.info('executor compare_shadow: shutted down')
+    progress.stop()
 
     executor = futures.ThreadPoolExecutor(max_workers=args.max_workers)
     logger.info('executor delete_shadow: started: {}'.format(executor))
@@ -230,7 +232,9 @@ try:
     executor.shutdown(wait=True)
     logger.info('executor delete_shadow: shutted down')
 
-    logger.info('cmp: stats: NUM_SHADOWS_COMPARED: {} NUM_SHADOWS_NOTSYNCED: {} NUM_ERRORS: {}'.format(NUM_SHADOWS_COMPARED, NUM_SHADOWS_NOTSYNCED, NUM_ERRORS))
+    logger.info('cmp: stats: latency: {}'.format(METRICS.histogram('compare_shadow').stats()))
+    logger.info('cmp: stats: NUM_SHADOWS_COMPARED: {} NUM_SHADOWS_NOTSYNCED: {} NUM_ERRORS: {}'.format(
+        METRICS.value('shadows_compared'), METRICS.value('shadows_notsynced'), METRICS.value('errors')))
 
     logger.info('cmp: stop')
 except Exception as e:
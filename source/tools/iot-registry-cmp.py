@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0.
+
+# iot-registry-cmp.py
+#
+# compares the device registries of two regions by merkle tree digests
+
+"""IoT DR: compare the things in primary and
+secondary region by registry digests. Only
+the things of buckets with different digests
+are compared thing by thing."""
+
+import argparse
+import logging
+import sys
+import time
+
+from concurrent import futures
+
+from client_pool import get_client
+from registry_digest import build_registry_digest, diff_digests, diff_things
+
+logger = logging.getLogger()
+for h in logger.handlers:
+    logger.removeHandler(h)
+h = logging.StreamHandler(sys.stdout)
+FORMAT = '%(asctime)s [%(levelname)s]: %(threadName)s-%(filename)s:%(lineno)s-%(funcName)s: %(message)s'
+h.setFormatter(logging.Formatter(FORMAT))
+logger.addHandler(h)
+logger.setLevel(logging.INFO)
+#logger.setLevel(logging.DEBUG)
+
+parser = argparse.ArgumentParser(description="Compare the device registries of two regions by digests")
+parser.add_argument('--primary-region', required=True, help="Primary aws region.")
+parser.add_argument('--secondary-region', required=True, help="Secondary aws region.")
+parser.add_argument('--query-string', default='thingName:*', help="Query string.")
+parser.add_argument('--depth', default=2, type=int, help="Length of the name prefix of a bucket, default 2.")
+parser.add_argument('--shards', default=4, type=int, help="Concurrent cursors per region scan, default 4.")
+args = parser.parse_args()
+
+
+def registry_indexing_enabled(c_iot):
+    try:
+        response = c_iot.get_indexing_configuration()
+        logger.debug('response: {}'.format(response))
+
+        logger.info('region: {} thingIndexingMode: {}'.format(
+            c_iot.meta.region_name, response['thingIndexingConfiguration']['thingIndexingMode']))
+        if response['thingIndexingConfiguration']['thingIndexingMode'] == 'OFF':
+            return False
+
+        return True
+    except Exception as e:
+        logger.error('{}'.format(e))
+        raise Exception(e)
+
+
+try:
+    logger.info('cmp: start')
+    logger.info('primary_region: {} secondary_region: {} query_string: {} depth: {} shards: {}'.
+        format(args.primary_region, args.secondary_region, args.query_string, args.depth, args.shards))
+
+    c_iot_p = get_client('iot', region_name=args.primary_region)
+    c_iot_s = get_client('iot', region_name=args.secondary_region)
+    use_search_index_p = registry_indexing_enabled(c_iot_p)
+    use_search_index_s = registry_indexing_enabled(c_iot_s)
+
+    start_time = int(time.time()*1000)
+    # both regions are scanned at the same time
+    with futures.ThreadPoolExecutor(max_workers=2) as executor:
+        future_p = executor.submit(
+            build_registry_digest, c_iot_p, use_search_index_p, args.query_string, args.depth, args.shards)
+        future_s = executor.submit(
+            build_registry_digest, c_iot_s, use_search_index_s, args.query_string, args.depth, args.shards)
+        digest_p = future_p.result()
+        digest_s = future_s.result()
+    logger.info('digests: duration: {}ms'.format(int(time.time()*1000) - start_time))
+
+    logger.info('root: primary: {} secondary: {}'.format(digest_p.root(), digest_s.root()))
+    keys, num_nodes = diff_digests(digest_p, digest_s)
+    logger.info('buckets: {} nodes compared: {} buckets different: {}'.format(
+        len(set(digest_p.buckets) | set(digest_s.buckets)), num_nodes, keys))
+
+    missing = extra = drifted = []
+    if keys:
+        # things of the buckets were kept while building the digests
+        missing, extra, drifted = diff_things(digest_p.bucket_things(keys), digest_s.bucket_things(keys))
+        for thing_name in missing:
+            logger.error('replication error: thing does not exist in secondary: thing_name: {}'.format(thing_name))
+        for thing_name in extra:
+            logger.error('replication error: thing does not exist in primary: thing_name: {}'.format(thing_name))
+        for thing_name in drifted:
+            logger.error('replication error: thing type or attributes missmatch: thing_name: {}'.format(thing_name))
+
+    logger.info('cmp: stats: NUM_THINGS_PRIMARY: {} NUM_THINGS_SECONDARY: {} NUM_BUCKETS_DIFFERENT: {} NUM_THINGS_MISSING: {} NUM_THINGS_EXTRA: {} NUM_THINGS_DRIFTED: {}'.format(
+        digest_p.num_things(), digest_s.num_things(), len(keys), len(missing), len(extra), len(drifted)))
+
+    logger.info('cmp: stop')
+except Exception as e:
+    logger.error('{}'.format(e))